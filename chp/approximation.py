@@ -0,0 +1,203 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import math
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+from pybkb.python_base.utils import get_operator, get_opposite_operator
+
+from chp.patient_store import PatientStore, NUMERIC
+from chp.patient_matrix import CONTINUOUS_TARGET_FEATURES
+
+logger = logging.getLogger(__name__)
+
+# Name of the source component used to attribute approximate contributions to patients. Handlers split
+# source state names on '_' and read the patient hashes from the last piece.
+APPROXIMATION_SOURCE_COMPONENT = '_Source_approximation'
+
+# Helper functions
+
+def _patient_matches(pat_dict, evidence, dynamic_evidence):
+    for feature, state in evidence.items():
+        # Interpolated genes are prefixed with an underscore
+        if feature[0] == '_':
+            feature = feature[1:]
+        has_feature = feature in pat_dict["gene_curies"] or feature in pat_dict["drug_curies"]
+        if has_feature != (str(state) == 'True'):
+            return False
+    if dynamic_evidence is not None:
+        for feature, prop in dynamic_evidence.items():
+            # Features the patient data does not hold can not be checked so they are ignored
+            if feature not in pat_dict:
+                continue
+            if not get_operator(prop["op"])(pat_dict[feature], prop["value"]):
+                return False
+    return True
+
+def _match_store_rows(patient_store, evidence, dynamic_evidence):
+    """ Same matching as _patient_matches over the columns of a patient store.
+    """
+    matches = np.ones(len(patient_store), dtype=bool)
+    for feature, state in evidence.items():
+        if feature[0] == '_':
+            feature = feature[1:]
+        has_feature = np.zeros(len(patient_store), dtype=bool)
+        for column in ["gene_curies", "drug_curies"]:
+            if patient_store.column_kind(column) is not None:
+                has_feature |= patient_store.has_value(column, feature)
+        matches &= has_feature if str(state) == 'True' else ~has_feature
+    if dynamic_evidence is not None:
+        for feature, prop in dynamic_evidence.items():
+            if patient_store.column_kind(feature) != NUMERIC:
+                continue
+            values = patient_store.numeric_column(feature)
+            with np.errstate(invalid='ignore'):
+                matches &= get_operator(prop["op"])(values, prop["value"]) | np.isnan(values)
+    return np.flatnonzero(matches)
+
+
+class EmpiricalUpdatingResult:
+    """ Approximate updating result computed by counting matching patients in the raw patient data.
+
+        Answers the same process_updates and process_inode_contributions calls as a pybkb updating
+        result so the TRAPI handlers can process it unchanged. Unnormalized updates and contributions
+        are joint probabilities over the whole cohort, normalized updates are conditioned on the evidence.
+
+        :param target_patients: Matching patient hashes for every (target, state).
+        :type target_patients: dict
+        :param num_matched: Number of patients the updates are conditioned on.
+        :type num_matched: int
+        :param num_patients: Number of patients in the cohort.
+        :type num_patients: int
+    """
+    partial = True
+
+    def __init__(self, target_patients, num_matched, num_patients):
+        self.target_patients = target_patients
+        self.num_matched = num_matched
+        self.num_patients = num_patients
+
+    def process_updates(self, normalize=False):
+        updates = defaultdict(dict)
+        for (target, state), patients in self.target_patients.items():
+            if normalize:
+                updates[target][state] = len(patients) / self.num_matched if self.num_matched > 0 else 0
+            else:
+                updates[target][state] = len(patients) / self.num_patients if self.num_patients > 0 else 0
+        return dict(updates)
+
+    def process_inode_contributions(self, include_srcs=True, **kwargs):
+        contributions = {}
+        for target_state, patients in self.target_patients.items():
+            contributions[target_state] = {}
+            if not include_srcs:
+                continue
+            for patient in patients:
+                contributions[target_state][(APPROXIMATION_SOURCE_COMPONENT, str(patient))] = 1 / self.num_patients
+        return contributions
+
+    def standard_errors(self):
+        """ Binomial standard error of every normalized update.
+        """
+        errors = {}
+        for target_state, prob in self._normalized_items():
+            if self.num_matched > 0:
+                errors[target_state] = math.sqrt(prob * (1 - prob) / self.num_matched)
+            else:
+                errors[target_state] = 0.5
+        return errors
+
+    def _normalized_items(self):
+        for target, state_dict in self.process_updates(normalize=True).items():
+            for state, prob in state_dict.items():
+                yield (target, state), prob
+
+
+def estimate_updates(raw_patient_data, evidence, dynamic_evidence, dynamic_targets):
+    """ Estimates the updates of a query from the fraction of matching patients that meet each dynamic target.
+
+        Only dynamic targets on patient features, e.g. survival time, can be estimated. Evidence on gene
+        and drug curies is matched against the gene and drug curies of each patient. If no patient
+        matches the evidence the cohort wide rates are returned with the largest possible error of 0.5.
+
+        :param raw_patient_data: Patient data keyed by patient hash.
+        :type raw_patient_data: dict
+        :param evidence: Standard evidence of the query.
+        :type evidence: dict
+        :param dynamic_evidence: Dynamic evidence of the query.
+        :type dynamic_evidence: dict
+        :param dynamic_targets: Dynamic targets of the query.
+        :type dynamic_targets: dict
+
+        :return: The approximate result and the largest standard error of its normalized updates.
+        :rtype: tuple
+    """
+    if isinstance(raw_patient_data, PatientStore):
+        return _estimate_store_updates(raw_patient_data, evidence, dynamic_evidence, dynamic_targets)
+    matched = [
+        patient for patient, pat_dict in raw_patient_data.items()
+        if _patient_matches(pat_dict, evidence if evidence is not None else {}, dynamic_evidence)
+    ]
+    num_matched = len(matched)
+    if num_matched == 0:
+        logger.info('No patients matched the evidence so the cohort rates are used as the approximation.')
+        matched = list(raw_patient_data.keys())
+    target_patients = {}
+    if dynamic_targets is not None:
+        for target, prop in dynamic_targets.items():
+            op = get_operator(prop["op"])
+            true_state = '{} {}'.format(prop["op"], prop["value"])
+            false_state = '{} {}'.format(get_opposite_operator(prop["op"]), prop["value"])
+            target_patients[(target, true_state)] = []
+            target_patients[(target, false_state)] = []
+            feature = CONTINUOUS_TARGET_FEATURES.get(target, target)
+            for patient in matched:
+                value = raw_patient_data[patient].get(feature)
+                if value is None:
+                    continue
+                if op(value, prop["value"]):
+                    target_patients[(target, true_state)].append(patient)
+                else:
+                    target_patients[(target, false_state)].append(patient)
+    result = EmpiricalUpdatingResult(target_patients, len(matched), len(raw_patient_data))
+    errors = result.standard_errors() if num_matched > 0 else {}
+    return result, max(errors.values()) if len(errors) > 0 else 0.5
+
+def _estimate_store_updates(patient_store, evidence, dynamic_evidence, dynamic_targets):
+    """ Same as estimate_updates with vectorized matching over the columns of a patient store.
+    """
+    rows = _match_store_rows(patient_store, evidence if evidence is not None else {}, dynamic_evidence)
+    num_matched = len(rows)
+    if num_matched == 0:
+        logger.info('No patients matched the evidence so the cohort rates are used as the approximation.')
+        rows = np.arange(len(patient_store))
+    patient_hashes = np.asarray(patient_store.patient_hashes)
+    target_patients = {}
+    if dynamic_targets is not None:
+        for target, prop in dynamic_targets.items():
+            true_state = '{} {}'.format(prop["op"], prop["value"])
+            false_state = '{} {}'.format(get_opposite_operator(prop["op"]), prop["value"])
+            feature = CONTINUOUS_TARGET_FEATURES.get(target, target)
+            if patient_store.column_kind(feature) != NUMERIC:
+                target_patients[(target, true_state)] = []
+                target_patients[(target, false_state)] = []
+                continue
+            values = patient_store.numeric_column(feature)[rows]
+            with np.errstate(invalid='ignore'):
+                meets = get_operator(prop["op"])(values, prop["value"])
+            present = ~np.isnan(values)
+            target_patients[(target, true_state)] = patient_hashes[rows[meets & present]].tolist()
+            target_patients[(target, false_state)] = patient_hashes[rows[~meets & present]].tolist()
+    result = EmpiricalUpdatingResult(target_patients, len(rows), len(patient_store))
+    errors = result.standard_errors() if num_matched > 0 else {}
+    return result, max(errors.values()) if len(errors) > 0 else 0.5
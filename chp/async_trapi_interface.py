@@ -0,0 +1,121 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from chp_data.bkb_handler import BkbDataHandler
+
+from chp.trapi_interface import TrapiInterface
+from chp.reasoner_registry import warmup
+
+logger = logging.getLogger(__name__)
+
+# Helper functions
+
+def answer_query(query, client_id=None, **settings):
+    """ Builds, runs and constructs the TRAPI response of a single or batch query in one call. This is
+        what runs in the worker when the interface offloads whole requests to a process pool.
+    """
+    interface = TrapiInterface(query=query, client_id=client_id, **settings)
+    interface.build_chp_queries()
+    interface.run_chp_queries()
+    return interface.construct_trapi_response()
+
+
+class AsyncTrapiInterface:
+    """ Asyncio front end of TrapiInterface meant to be shared by every request of a server.
+
+        All blocking work runs on the executor so the event loop is never blocked. With a thread executor
+        (or None for the default executor of the loop) requests share the warm reasoners of the process
+        registry, see chp.reasoner_registry, and the queries of a request run concurrently. With a
+        ProcessPoolExecutor whole requests are offloaded to the workers, which keep their own warm
+        reasoners, e.g. by passing chp.reasoner_registry.warmup as the initializer of the pool.
+
+        Cancelling the awaiting task, e.g. when the client disconnects, drops every queued step of the
+        request. Reasoning that is already running finishes in the background and its result is discarded.
+
+        :param executor: Executor that runs the reasoning. Defaults to the default executor of the loop.
+        :type executor: concurrent.futures.Executor
+        :param budget: Optional latency budget in seconds of every request, see TrapiInterface.
+        :type budget: float
+    """
+    def __init__(self,
+                 executor=None,
+                 hosts_filename=None,
+                 num_processes_per_host=0,
+                 max_results=100,
+                 bkb_handler=None,
+                 budget=None,
+                ):
+        self.executor = executor
+        self.hosts_filename = hosts_filename
+        self.num_processes_per_host = num_processes_per_host
+        self.max_results = max_results
+        self.bkb_handler = bkb_handler
+        self.budget = budget
+        self.num_cancelled = 0
+
+    def _get_settings(self):
+        return {
+            "hosts_filename": self.hosts_filename,
+            "num_processes_per_host": self.num_processes_per_host,
+            "max_results": self.max_results,
+            "bkb_handler": self.bkb_handler,
+            "budget": self.budget,
+        }
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def warmup(self):
+        """ Loads the reasoners and curies of the process ahead of the first request. Has no effect on
+            the workers of a process pool, which should warm up in the initializer of the pool.
+        """
+        if self.bkb_handler is None:
+            self.bkb_handler = BkbDataHandler(
+                bkb_major_version='coulomb',
+                bkb_minor_version='1.0'
+            )
+        await self._run(
+            warmup,
+            self.bkb_handler,
+            hosts_filename=self.hosts_filename,
+            num_processes_per_host=self.num_processes_per_host,
+        )
+
+    async def get_curies(self):
+        interface = await self._run(TrapiInterface)
+        return interface.get_curies()
+
+    async def get_predicates(self):
+        interface = await self._run(TrapiInterface)
+        return await self._run(interface.get_predicates)
+
+    async def query(self, query, client_id=None):
+        """ Answers a single or batch query like TrapiInterface.build_chp_queries, run_chp_queries and
+            construct_trapi_response would.
+
+            :return: The TRAPI response, or a list of them in the order of a batch query.
+        """
+        try:
+            if isinstance(self.executor, ProcessPoolExecutor):
+                return await self._run(answer_query, query, client_id=client_id, **self._get_settings())
+            interface = await self._run(TrapiInterface, query=query, client_id=client_id, executor=self.executor, **self._get_settings())
+            await self._run(interface.build_chp_queries)
+            await interface.arun_chp_queries()
+            return await self._run(interface.construct_trapi_response)
+        except asyncio.CancelledError:
+            self.num_cancelled += 1
+            logger.info('Query of client {} was cancelled.'.format(client_id))
+            raise
@@ -0,0 +1,237 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import sys
+import logging
+import itertools
+from collections import defaultdict
+
+from pybkb.common.bayesianKnowledgeBase import bayesianKnowledgeBase as BKB
+
+logger = logging.getLogger(__name__)
+
+# Attributes of the base bkb that are safe to read through an overlay as they do not depend on its contents.
+# Everything else, in particular any mutator the overlay does not implement, is refused so the shared base
+# can not be changed by accident and no read silently misses the delta layer.
+_BASE_READ_ATTRIBUTES = frozenset([
+    'name',
+    'getName',
+])
+
+class _LayeredSNodes:
+    """ Read only view over the S-nodes of a base BKB followed by the S-nodes of an overlay delta.
+        Nothing is copied, S-nodes are yielded straight from the two layers.
+    """
+    def __init__(self, base_snodes, delta_snodes, removed):
+        self._base_snodes = base_snodes
+        self._delta_snodes = delta_snodes
+        self._removed = removed
+
+    def __iter__(self):
+        if self._removed:
+            base_iter = (snode for snode in self._base_snodes if id(snode) not in self._removed)
+        else:
+            base_iter = iter(self._base_snodes)
+        return itertools.chain(base_iter, self._delta_snodes)
+
+    def __len__(self):
+        return len(self._base_snodes) - len(self._removed) + len(self._delta_snodes)
+
+    def __contains__(self, snode):
+        if snode in self._delta_snodes:
+            return True
+        return id(snode) not in self._removed and snode in self._base_snodes
+
+
+class BkbOverlay:
+    """ Copy-on-write view of a prelinked BKB.
+
+        The base BKB is never mutated. Any component, I-node or S-node that is added while linking
+        dynamic evidence and targets is written to a per query delta layer, and every read
+        goes through the delta first and then falls back to the base. Component and I-node indices
+        of the base are preserved, new components are appended after the last base component and
+        new I-nodes after the last I-node of their component, so index based S-nodes from either
+        layer stay valid.
+
+        :param base_bkb: The shared prelinked BKB that should be treated as read only.
+        :type base_bkb: pybkb.common.bayesianKnowledgeBase.bayesianKnowledgeBase
+        :param feature_index: Optional set of all component names in the base bkb. Used to answer
+            name lookups without touching the base.
+        :type feature_index: frozenset
+    """
+    def __init__(self, base_bkb, feature_index=None):
+        self._base = base_bkb
+        self._feature_index = feature_index
+        self._num_base_components = len(base_bkb.getAllComponentIndices())
+        # Delta layer
+        self._delta_component_names = []
+        self._delta_component_indices = {}
+        self._delta_states = defaultdict(list)
+        self._num_base_states = {}
+        self._delta_snodes = []
+        self._removed_snodes = set()
+
+    def __getattr__(self, attr):
+        # Only read only attributes that are not overridden are taken straight from the base bkb.
+        if attr not in _BASE_READ_ATTRIBUTES:
+            raise AttributeError("'BkbOverlay' has no attribute '{}', only read only attributes are taken from the base bkb.".format(attr))
+        return getattr(self._base, attr)
+
+    @property
+    def base(self):
+        return self._base
+
+    # Components
+
+    def _is_delta_component(self, comp_idx):
+        return comp_idx >= self._num_base_components
+
+    def getAllComponentIndices(self):
+        return list(range(self._num_base_components + len(self._delta_component_names)))
+
+    def getAllComponentNames(self):
+        return list(self._base.getAllComponentNames()) + self._delta_component_names
+
+    def getComponentIndex(self, comp_name):
+        comp_idx = self._delta_component_indices.get(comp_name)
+        if comp_idx is not None:
+            return comp_idx
+        if self._feature_index is not None and comp_name not in self._feature_index:
+            return -1
+        return self._base.getComponentIndex(comp_name)
+
+    def getComponentName(self, comp_idx):
+        if self._is_delta_component(comp_idx):
+            return self._delta_component_names[comp_idx - self._num_base_components]
+        return self._base.getComponentName(comp_idx)
+
+    def addComponent(self, comp_name):
+        comp_idx = self.getComponentIndex(comp_name)
+        if comp_idx != -1:
+            return comp_idx
+        comp_idx = self._num_base_components + len(self._delta_component_names)
+        self._delta_component_names.append(comp_name)
+        self._delta_component_indices[comp_name] = comp_idx
+        return comp_idx
+
+    def getSrcComponents(self):
+        src_components = list(self._base.getSrcComponents())
+        for comp_name in self._delta_component_names:
+            if '_Source_' in comp_name:
+                src_components.append(self._delta_component_indices[comp_name])
+        return src_components
+
+    # I-nodes
+
+    def _get_num_base_states(self, comp_idx):
+        if self._is_delta_component(comp_idx):
+            return 0
+        if comp_idx not in self._num_base_states:
+            self._num_base_states[comp_idx] = self._base.getNumberComponentINodes(comp_idx)
+        return self._num_base_states[comp_idx]
+
+    def getNumberComponentINodes(self, comp_idx):
+        return self._get_num_base_states(comp_idx) + len(self._delta_states.get(comp_idx, []))
+
+    def getAllComponentINodeIndices(self, comp_idx):
+        return list(range(self.getNumberComponentINodes(comp_idx)))
+
+    def getComponentINodeName(self, comp_idx, state_idx):
+        num_base_states = self._get_num_base_states(comp_idx)
+        if state_idx >= num_base_states:
+            return self._delta_states[comp_idx][state_idx - num_base_states]
+        return self._base.getComponentINodeName(comp_idx, state_idx)
+
+    def getComponentINodeIndex(self, comp_idx, state_name):
+        delta_states = self._delta_states.get(comp_idx)
+        if delta_states and state_name in delta_states:
+            return self._get_num_base_states(comp_idx) + delta_states.index(state_name)
+        if self._is_delta_component(comp_idx):
+            return -1
+        return self._base.getComponentINodeIndex(comp_idx, state_name)
+
+    def findINode(self, comp_idx, state_name, contains=False):
+        if not contains:
+            return self.getComponentINodeIndex(comp_idx, state_name)
+        for state_idx in self.getAllComponentINodeIndices(comp_idx):
+            if state_name in self.getComponentINodeName(comp_idx, state_idx):
+                return state_idx
+        return -1
+
+    def addComponentState(self, comp_idx, state_name):
+        state_idx = self.getComponentINodeIndex(comp_idx, state_name)
+        if state_idx != -1:
+            return state_idx
+        state_idx = self.getNumberComponentINodes(comp_idx)
+        self._delta_states[comp_idx].append(state_name)
+        return state_idx
+
+    # S-nodes
+
+    def addSNode(self, snode):
+        self._delta_snodes.append(snode)
+
+    def removeSNode(self, snode):
+        # S-nodes of the base are the same objects on every access, including those of a compact bkb
+        try:
+            self._delta_snodes.remove(snode)
+        except ValueError:
+            self._removed_snodes.add(id(snode))
+
+    def getAllSNodes(self):
+        return _LayeredSNodes(self._base.getAllSNodes(), self._delta_snodes, self._removed_snodes)
+
+    def constructSNodesByHead(self):
+        S_nodes_by_head = defaultdict(list)
+        for snode in self.getAllSNodes():
+            S_nodes_by_head[snode.getHead()].append(snode)
+        return S_nodes_by_head
+
+    # Whole bkb
+
+    def to_bkb(self):
+        """ Materializes a standard pybkb BKB with the components, I-nodes and S-nodes of both layers.
+        """
+        bkb = BKB(name=self._base.name)
+        for comp_idx in self.getAllComponentIndices():
+            new_comp_idx = bkb.addComponent(self.getComponentName(comp_idx))
+            for state_idx in self.getAllComponentINodeIndices(comp_idx):
+                bkb.addComponentState(new_comp_idx, self.getComponentINodeName(comp_idx, state_idx))
+        for snode in self.getAllSNodes():
+            bkb.addSNode(snode)
+        return bkb
+
+    # Serializing, graphing and listing go through a materialized bkb so they see the linked delta
+
+    def getINodeNames(self):
+        return self.to_bkb().getINodeNames()
+
+    def to_str(self, *args, **kwargs):
+        return self.to_bkb().to_str(*args, **kwargs)
+
+    def makeGraph(self, *args, **kwargs):
+        return self.to_bkb().makeGraph(*args, **kwargs)
+
+    def save(self, *args, **kwargs):
+        return self.to_bkb().save(*args, **kwargs)
+
+    # Overlay management
+
+    def delta_nbytes(self):
+        """ Approximate memory footprint of the delta layer in bytes.
+        """
+        nbytes = sys.getsizeof(self._delta_component_names) + sys.getsizeof(self._delta_snodes)
+        for comp_name in self._delta_component_names:
+            nbytes += sys.getsizeof(comp_name)
+        for states in self._delta_states.values():
+            nbytes += sys.getsizeof(states) + sum([sys.getsizeof(state) for state in states])
+        for snode in self._delta_snodes:
+            nbytes += sys.getsizeof(snode) + sys.getsizeof(getattr(snode, '__dict__', None))
+        return nbytes
@@ -0,0 +1,255 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import os
+import pickle
+import sqlite3
+import hashlib
+import logging
+import numbers
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Helper functions
+
+def canonicalize_feature_value(value):
+    """ Hashable form of a dynamic feature value. Numbers compare by value, so 970 and 970.0 are the
+        same, while other values keep their type, so 970 and '970' are not.
+    """
+    if isinstance(value, numbers.Number) and not isinstance(value, bool):
+        return ('number', float(value))
+    return (type(value).__name__, str(value))
+
+def canonicalize_feature_properties(feature_properties):
+    """ Turns a dictionary of dynamic feature properties, i.e. {feature: {"op": op, "value": value}},
+        into a hashable tuple that does not depend on insertion order.
+    """
+    if feature_properties is None:
+        return tuple()
+    canonical = []
+    for feature, prop in feature_properties.items():
+        canonical.append((feature, prop["op"], canonicalize_feature_value(prop["value"])))
+    return tuple(sorted(canonical))
+
+def canonicalize_query(query):
+    """ Hashable representation of everything in a CHP query that changes the reasoning result.
+    """
+    evidence = tuple(sorted(query.evidence.items())) if query.evidence is not None else tuple()
+    targets = tuple(sorted(query.targets)) if query.targets is not None else tuple()
+    return (
+        evidence,
+        targets,
+        canonicalize_feature_properties(query.dynamic_evidence),
+        canonicalize_feature_properties(query.dynamic_targets),
+    )
+
+def get_artifact_version(*paths):
+    """ Fingerprints a set of artifact files by their path, size and modification time. Returns None
+        if any of the files is missing.
+    """
+    fingerprint = hashlib.sha256()
+    for path in paths:
+        if path is None or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        fingerprint.update('{}:{}:{}\n'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return fingerprint.hexdigest()
+
+def get_artifact_scope(*paths):
+    """ Identifies a set of artifact files by their paths alone, so it stays the same when the files
+        change. See ResultCache.prune.
+    """
+    return hashlib.sha256('\n'.join([os.path.abspath(path) for path in paths if path is not None]).encode('utf-8')).hexdigest()
+
+
+class LinkedBkbCache:
+    """ Bounded, memory aware LRU cache of linked BKBs.
+
+        Entries are evicted in least recently used order once the summed size of all entries
+        is over max_bytes (or the number of entries is over max_entries if set).
+
+        :param max_bytes: The byte budget of the cache.
+        :type max_bytes: int
+        :param max_entries: Optional upper bound on the number of cached linked BKBs.
+        :type max_entries: int
+    """
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, value, num_bytes):
+        with self._lock:
+            if num_bytes > self.max_bytes:
+                logger.info('Linked bkb of {} bytes is over the cache budget so it was not cached.'.format(num_bytes))
+                return
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, num_bytes)
+            self.num_bytes += num_bytes
+            while self.num_bytes > self.max_bytes or (self.max_entries is not None and len(self._entries) > self.max_entries):
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted_bytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counts along with the current memory usage.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class ResultCache:
+    """ Two tier cache of reasoning results. Results are kept in an in-memory LRU tier and, if a path
+        is passed, in an SQLite file that survives restarts.
+
+        Every entry is stored with the scope of the artifacts it was computed against, see get_artifact_scope,
+        and their version. Keys should include that version so that stale entries are never hit, and prune
+        removes the stale entries of a scope. Entries of other scopes, e.g. of other reasoners sharing the
+        file, are left alone.
+
+        :param path: Optional path of the SQLite file of the on-disk tier.
+        :type path: str
+        :param max_entries: Number of results kept in memory.
+        :type max_entries: int
+    """
+    def __init__(self, path=None, max_entries=1024):
+        self.path = path
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn = None
+        if path is not None:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, scope TEXT, version TEXT, value BLOB)')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(results)')]
+            if 'scope' not in columns:
+                # Entries written without a scope can not be attributed to any artifacts so they are dropped
+                self._conn.execute('DROP TABLE results')
+                self._conn.execute('CREATE TABLE results (key TEXT PRIMARY KEY, scope TEXT, version TEXT, value BLOB)')
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+    def _put_memory(self, key, value, scope, version):
+        self._entries[key] = (value, scope, version)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key, loads=pickle.loads):
+        """ Returns the cached value or None. Values found on disk are deserialized with loads and
+            promoted to the memory tier.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            row = None
+            if self._conn is not None:
+                row = self._conn.execute('SELECT value, scope, version FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+        # Deserialize outside of the lock so other lookups are not held up
+        value = loads(row[0])
+        with self._lock:
+            self._put_memory(key, value, row[1], row[2])
+            self.disk_hits += 1
+        return value
+
+    def put(self, key, value, version, scope=None, dumps=pickle.dumps):
+        """ Caches a value computed against the given version of the artifacts of a scope. Values are
+            serialized with dumps for the on-disk tier.
+        """
+        blob = None
+        if self._conn is not None:
+            # Serialize outside of the lock so other lookups are not held up
+            try:
+                blob = dumps(value)
+            except Exception as ex:
+                logger.warning('Could not serialize result for the on-disk cache: {}'.format(ex))
+        with self._lock:
+            self._put_memory(key, value, scope, version)
+            if blob is not None:
+                self._conn.execute('INSERT OR REPLACE INTO results (key, scope, version, value) VALUES (?, ?, ?, ?)', (key, scope, version, blob))
+                self._conn.commit()
+
+    def prune(self, scope, valid_versions):
+        """ Deletes every entry of the scope that was not computed against one of the valid versions.
+        """
+        valid_versions = [version for version in valid_versions if version is not None]
+        with self._lock:
+            for key, (_, entry_scope, version) in list(self._entries.items()):
+                if entry_scope == scope and version not in valid_versions:
+                    del self._entries[key]
+            if self._conn is not None:
+                placeholders = ','.join(['?' for _ in valid_versions])
+                deleted = self._conn.execute(
+                    'DELETE FROM results WHERE scope IS ? AND version NOT IN ({})'.format(placeholders),
+                    [scope] + valid_versions,
+                ).rowcount
+                self._conn.commit()
+                if deleted > 0:
+                    logger.info('Pruned {} stale results from the result cache.'.format(deleted))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM results')
+                self._conn.commit()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
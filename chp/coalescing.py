@@ -0,0 +1,136 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import logging
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# Query attributes a coalesced query takes from the query that was actually run
+_SHARED_QUERY_ATTRIBUTES = [
+    'evidence',
+    'result',
+    'contributions',
+    'compute_time',
+    'from_joint_reasoner',
+    'from_result_cache',
+    'partial',
+    'approximation_error',
+]
+
+# Helper functions
+
+def share_query_result(query, leader_query):
+    """ Copies the result of the query that was run onto an identical query that waited for it.
+    """
+    if leader_query is query:
+        return query
+    for attribute in _SHARED_QUERY_ATTRIBUTES:
+        if hasattr(leader_query, attribute):
+            setattr(query, attribute, getattr(leader_query, attribute))
+    query.coalesced = True
+    return query
+
+
+class FlightAbandoned(Exception):
+    """ Set on a flight whose leader gave up on the computation before it ran, e.g. because its latency
+        budget ran out first. Waiters should run the computation themselves.
+    """
+    pass
+
+
+class _Flight:
+    def __init__(self):
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.waiters = 0
+
+
+class SingleFlight:
+    """ Coalesces concurrent computations with the same key.
+
+        The first caller of a key becomes its leader and runs the computation, every caller that joins
+        while it is in flight waits on the leader's future and shares its result or error. Keys are
+        forgotten as soon as the leader finishes, so unlike a cache nothing is kept between bursts. A
+        leader that gives up on the computation fails the flight with FlightAbandoned.
+    """
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.num_leaders = 0
+        self.num_coalesced = 0
+
+    def join(self, key):
+        """ Joins the computation of the key.
+
+            :return: The future of the computation and whether the caller is its leader. The leader must
+                finish the computation with resolve or fail.
+            :rtype: tuple
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.num_leaders += 1
+                return flight.future, True
+            flight.waiters += 1
+            self.num_coalesced += 1
+            return flight.future, False
+
+    def resolve(self, key, result):
+        with self._lock:
+            flight = self._flights.pop(key)
+        flight.future.set_result(result)
+        if flight.waiters > 0:
+            logger.info('Shared one computation with {} coalesced callers.'.format(flight.waiters))
+
+    def fail(self, key, error):
+        with self._lock:
+            flight = self._flights.pop(key, None)
+        if flight is not None:
+            flight.future.set_exception(error)
+
+    def do(self, key, fn):
+        """ Runs fn unless a computation of the key is already in flight, in which case its result is shared.
+
+            :return: The result and whether it was shared from another caller's computation.
+            :rtype: tuple
+        """
+        future, leader = self.join(key)
+        while not leader:
+            try:
+                return future.result(), True
+            except FlightAbandoned:
+                # Try again, most likely as the leader of a new flight
+                future, leader = self.join(key)
+        try:
+            result = fn()
+        except BaseException as ex:
+            self.fail(key, ex)
+            raise
+        self.resolve(key, result)
+        return result, False
+
+    def waiter_counts(self):
+        """ Number of callers waiting on every key that is in flight.
+        """
+        with self._lock:
+            return {key: flight.waiters for key, flight in self._flights.items()}
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._flights),
+                "waiters": sum([flight.waiters for flight in self._flights.values()]),
+                "num_leaders": self.num_leaders,
+                "num_coalesced": self.num_coalesced,
+            }
@@ -0,0 +1,376 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import os
+import mmap
+import json
+import struct
+import hashlib
+import logging
+import argparse
+import threading
+from collections import defaultdict
+
+import numpy as np
+import compress_pickle
+
+from pybkb.common.bayesianKnowledgeBase import BKB_S_node
+from pybkb.common.bayesianKnowledgeBase import bayesianKnowledgeBase as BKB
+
+logger = logging.getLogger(__name__)
+
+COMPACT_BKB_MAGIC = b'CHPBKB01'
+COMPACT_BKB_EXTENSION = '.cbkb'
+# Every array starts on a multiple of this so it can be viewed in place from the mmap.
+_ALIGNMENT = 8
+
+# Helper functions
+
+def _encode_strings(strings):
+    """ Encodes a list of strings into a utf-8 blob and an offsets array.
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded], dtype=np.int64)
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+def get_compact_bkb_path(bkb_path):
+    """ Returns the path where the compact version of a pickled bkb is expected.
+    """
+    return os.path.splitext(bkb_path)[0] + COMPACT_BKB_EXTENSION
+
+def is_compact_bkb(path):
+    with open(path, 'rb') as f_:
+        return f_.read(len(COMPACT_BKB_MAGIC)) == COMPACT_BKB_MAGIC
+
+def get_file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f_:
+        for chunk in iter(lambda: f_.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def _parse_header(data):
+    """ Parses the header of a compact bkb. Returns the header and the offset of the data section, or None if
+        the data is not a complete compact bkb, e.g. a file that is still being written.
+    """
+    header_start = len(COMPACT_BKB_MAGIC) + 8
+    if len(data) < header_start or data[:len(COMPACT_BKB_MAGIC)] != COMPACT_BKB_MAGIC:
+        return None
+    header_len = struct.unpack('<Q', data[len(COMPACT_BKB_MAGIC):header_start])[0]
+    if len(data) < header_start + header_len:
+        return None
+    try:
+        header = json.loads(bytes(data[header_start:header_start + header_len]).decode('utf-8'))
+    except ValueError:
+        return None
+    data_start = header_start + header_len
+    for info in header["arrays"].values():
+        if data_start + info["offset"] + info["length"] * np.dtype(info["dtype"]).itemsize > len(data):
+            return None
+    return header, data_start
+
+def read_compact_bkb_header(path):
+    """ The header of a compact bkb file, None if it is not a complete compact bkb.
+    """
+    if os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as f_:
+        with mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            parsed = _parse_header(data)
+    if parsed is None:
+        return None
+    return parsed[0]
+
+def is_compact_bkb_of(compact_path, bkb_path):
+    """ Whether the compact bkb file is complete and was converted from the current contents of the bkb pickle.
+    """
+    header = read_compact_bkb_header(compact_path)
+    return header is not None and header.get("source_sha256") == get_file_sha256(bkb_path)
+
+def save_compact_bkb(bkb, path, source_path=None):
+    """ Writes a BKB into the compact, array backed format.
+
+        Layout: magic, little endian uint64 header length, JSON header with the dtype, offset and
+        length of every array, then the arrays themselves.
+
+        :param bkb: The bkb to save.
+        :type bkb: pybkb.common.bayesianKnowledgeBase.bayesianKnowledgeBase
+        :param path: Path of the compact file.
+        :type path: str
+        :param source_path: Optional path of the file the bkb was loaded from. Its hash is recorded in the
+            header so the compact file is only used in its place while it is unchanged, see is_compact_bkb_of.
+        :type source_path: str
+    """
+    comp_indices = bkb.getAllComponentIndices()
+    comp_names = [bkb.getComponentName(comp_idx) for comp_idx in comp_indices]
+    inode_offsets = np.zeros(len(comp_indices) + 1, dtype=np.int64)
+    inode_names = []
+    for comp_idx in comp_indices:
+        for state_idx in bkb.getAllComponentINodeIndices(comp_idx):
+            inode_names.append(bkb.getComponentINodeName(comp_idx, state_idx))
+        inode_offsets[comp_idx + 1] = len(inode_names)
+    snodes = list(bkb.getAllSNodes())
+    snode_head_comp = np.zeros(len(snodes), dtype=np.int32)
+    snode_head_state = np.zeros(len(snodes), dtype=np.int32)
+    snode_prob = np.zeros(len(snodes), dtype=np.float64)
+    snode_tail_offsets = np.zeros(len(snodes) + 1, dtype=np.int64)
+    tail_comp = []
+    tail_state = []
+    for i, snode in enumerate(snodes):
+        snode_head_comp[i], snode_head_state[i] = snode.getHead()
+        snode_prob[i] = snode.probability
+        for tail_idx in range(snode.getNumberTail()):
+            _tail_comp, _tail_state = snode.getTail(tail_idx)
+            tail_comp.append(_tail_comp)
+            tail_state.append(_tail_state)
+        snode_tail_offsets[i + 1] = len(tail_comp)
+    comp_name_offsets, comp_name_blob = _encode_strings(comp_names)
+    inode_name_offsets, inode_name_blob = _encode_strings(inode_names)
+    arrays = {
+        "comp_name_offsets": comp_name_offsets,
+        "comp_name_blob": comp_name_blob,
+        "comp_sorted": np.array(sorted(comp_indices, key=lambda comp_idx: comp_names[comp_idx]), dtype=np.int32),
+        "inode_offsets": inode_offsets,
+        "inode_name_offsets": inode_name_offsets,
+        "inode_name_blob": inode_name_blob,
+        "snode_head_comp": snode_head_comp,
+        "snode_head_state": snode_head_state,
+        "snode_prob": snode_prob,
+        "snode_tail_offsets": snode_tail_offsets,
+        "snode_tail_comp": np.array(tail_comp, dtype=np.int32),
+        "snode_tail_state": np.array(tail_state, dtype=np.int32),
+        "src_components": np.array(bkb.getSrcComponents(), dtype=np.int32),
+    }
+    # Lay out arrays relative to the start of the data section
+    header = {"name": bkb.name, "arrays": {}}
+    if source_path is not None:
+        header["source_sha256"] = get_file_sha256(source_path)
+    offset = 0
+    for array_name, array in arrays.items():
+        header["arrays"][array_name] = {
+            "dtype": array.dtype.str,
+            "offset": offset,
+            "length": len(array),
+        }
+        offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix_len = len(COMPACT_BKB_MAGIC) + 8 + len(header_bytes)
+    padding = -prefix_len % _ALIGNMENT
+    # Written next to the final path and moved in place so readers never see a partial file
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f_:
+        f_.write(COMPACT_BKB_MAGIC)
+        f_.write(struct.pack('<Q', len(header_bytes) + padding))
+        f_.write(header_bytes + b' ' * padding)
+        for array_name, array in arrays.items():
+            data = array.tobytes()
+            f_.write(data)
+            f_.write(b'\0' * (-len(data) % _ALIGNMENT))
+    os.replace(tmp_path, path)
+    logger.info('Saved compact bkb with {} components and {} S-nodes to: {}'.format(len(comp_names), len(snodes), path))
+
+def convert_bkb_pickle(bkb_pickle_path, compact_path=None):
+    """ Converts one of the lz4 compressed bkb pickles into the compact format.
+    """
+    if compact_path is None:
+        compact_path = get_compact_bkb_path(bkb_pickle_path)
+    with open(bkb_pickle_path, 'rb') as f_:
+        bkb = compress_pickle.load(f_, compression='lz4')
+    save_compact_bkb(bkb, compact_path, source_path=bkb_pickle_path)
+    return compact_path
+
+
+class _CompactSNodes:
+    """ Lazy sequence of the S-nodes in a compact bkb. S-nodes are built on first access and then kept.
+    """
+    def __init__(self, compact_bkb):
+        self._bkb = compact_bkb
+
+    def __len__(self):
+        return len(self._bkb._snode_prob)
+
+    def __getitem__(self, snode_idx):
+        return self._bkb._get_snode(snode_idx)
+
+    def __iter__(self):
+        for snode_idx in range(len(self)):
+            yield self._bkb._get_snode(snode_idx)
+
+    def __contains__(self, snode):
+        return self._bkb.getSNodeIndex(snode) is not None
+
+
+class CompactBkb:
+    """ Read only BKB backed by a memory mapped compact bkb file.
+
+        Opening the file only parses the header, every array is a view into the mapping so the
+        operating system shares the pages between all processes that load the same file. The object
+        answers the same component, I-node and S-node lookups as a pybkb BKB and can be used as the
+        base of a chp.bkb_overlay.BkbOverlay. S-nodes are built on first access and kept, so like in
+        a pybkb BKB every access returns the same object.
+
+        :param path: Path to a file written by save_compact_bkb.
+        :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+        parsed = None
+        if os.path.getsize(path) > 0:
+            with open(path, 'rb') as f_:
+                self._mmap = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ)
+            parsed = _parse_header(self._mmap)
+        if parsed is None:
+            raise ValueError('{} is not a complete compact bkb file.'.format(path))
+        header, data_start = parsed
+        self.name = header["name"]
+        for array_name, info in header["arrays"].items():
+            array = np.frombuffer(
+                self._mmap,
+                dtype=np.dtype(info["dtype"]),
+                count=info["length"],
+                offset=data_start + info["offset"],
+            )
+            setattr(self, '_{}'.format(array_name), array)
+        self._snodes = [None] * len(self._snode_prob)
+        # Index of every built S-node by object id, built S-nodes are never released so ids stay unique
+        self._snode_indices = {}
+        self._snode_lock = threading.Lock()
+        # State name to state index of every component that was looked up
+        self._state_indices = {}
+
+    def __getstate__(self):
+        # Only the path is pickled, the unpickled bkb maps the same file again.
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _decode(self, blob, offsets, idx):
+        return blob[offsets[idx]:offsets[idx + 1]].tobytes().decode('utf-8')
+
+    # Components
+
+    def getAllComponentIndices(self):
+        return list(range(len(self._comp_name_offsets) - 1))
+
+    def getAllComponentNames(self):
+        return [self.getComponentName(comp_idx) for comp_idx in self.getAllComponentIndices()]
+
+    def getComponentName(self, comp_idx):
+        return self._decode(self._comp_name_blob, self._comp_name_offsets, comp_idx)
+
+    def getComponentIndex(self, comp_name):
+        # Binary search over the components sorted by name
+        low = 0
+        high = len(self._comp_sorted)
+        while low < high:
+            mid = (low + high) // 2
+            comp_idx = int(self._comp_sorted[mid])
+            mid_name = self.getComponentName(comp_idx)
+            if mid_name == comp_name:
+                return comp_idx
+            elif mid_name < comp_name:
+                low = mid + 1
+            else:
+                high = mid
+        return -1
+
+    def getSrcComponents(self):
+        return self._src_components.tolist()
+
+    # I-nodes
+
+    def getNumberComponentINodes(self, comp_idx):
+        return int(self._inode_offsets[comp_idx + 1] - self._inode_offsets[comp_idx])
+
+    def getAllComponentINodeIndices(self, comp_idx):
+        return list(range(self.getNumberComponentINodes(comp_idx)))
+
+    def getComponentINodeName(self, comp_idx, state_idx):
+        return self._decode(self._inode_name_blob, self._inode_name_offsets, self._inode_offsets[comp_idx] + state_idx)
+
+    def getComponentINodeIndex(self, comp_idx, state_name):
+        state_indices = self._state_indices.get(comp_idx)
+        if state_indices is None:
+            # Reversed so the first of any duplicate state names wins
+            state_indices = {
+                self.getComponentINodeName(comp_idx, state_idx): state_idx
+                for state_idx in reversed(self.getAllComponentINodeIndices(comp_idx))
+            }
+            self._state_indices[comp_idx] = state_indices
+        return state_indices.get(state_name, -1)
+
+    def findINode(self, comp_idx, state_name, contains=False):
+        if not contains:
+            return self.getComponentINodeIndex(comp_idx, state_name)
+        for state_idx in self.getAllComponentINodeIndices(comp_idx):
+            if state_name in self.getComponentINodeName(comp_idx, state_idx):
+                return state_idx
+        return -1
+
+    # S-nodes
+
+    def _make_snode(self, snode_idx):
+        start = self._snode_tail_offsets[snode_idx]
+        end = self._snode_tail_offsets[snode_idx + 1]
+        tail = list(zip(self._snode_tail_comp[start:end].tolist(), self._snode_tail_state[start:end].tolist()))
+        return BKB_S_node(init_component_index=int(self._snode_head_comp[snode_idx]),
+                          init_state_index=int(self._snode_head_state[snode_idx]),
+                          init_probability=float(self._snode_prob[snode_idx]),
+                          init_tail=tail)
+
+    def _get_snode(self, snode_idx):
+        snode = self._snodes[snode_idx]
+        if snode is None:
+            with self._snode_lock:
+                snode = self._snodes[snode_idx]
+                if snode is None:
+                    snode = self._make_snode(snode_idx)
+                    self._snode_indices[id(snode)] = snode_idx
+                    self._snodes[snode_idx] = snode
+        return snode
+
+    def getAllSNodes(self):
+        return _CompactSNodes(self)
+
+    def getSNodeIndex(self, snode):
+        """ Index of an S-node of this bkb, None if the object is not one of its S-nodes.
+        """
+        return self._snode_indices.get(id(snode))
+
+    def constructSNodesByHead(self):
+        S_nodes_by_head = defaultdict(list)
+        for snode in self.getAllSNodes():
+            S_nodes_by_head[snode.getHead()].append(snode)
+        return S_nodes_by_head
+
+    def to_bkb(self):
+        """ Materializes a standard pybkb BKB with the same components, I-nodes and S-nodes.
+        """
+        bkb = BKB(name=self.name)
+        for comp_idx in self.getAllComponentIndices():
+            new_comp_idx = bkb.addComponent(self.getComponentName(comp_idx))
+            for state_idx in self.getAllComponentINodeIndices(comp_idx):
+                bkb.addComponentState(new_comp_idx, self.getComponentINodeName(comp_idx, state_idx))
+        for snode in self.getAllSNodes():
+            bkb.addSNode(snode)
+        return bkb
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert lz4 pickled bkbs into the compact memory mappable format.')
+    parser.add_argument('bkb_paths', nargs='+', help='Paths to lz4 compressed bkb pickles.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for bkb_path in args.bkb_paths:
+        logger.info('Wrote compact bkb: {}'.format(convert_bkb_pickle(bkb_path)))
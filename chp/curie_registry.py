@@ -0,0 +1,151 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import sys
+import copy
+import json
+import bisect
+import logging
+import threading
+from collections.abc import Mapping
+
+from chp.cache import get_artifact_version
+
+logger = logging.getLogger(__name__)
+
+# Registries shared by every handler in the process, keyed by path
+_CURIE_REGISTRIES = {}
+_PREDICATES = {}
+_LOCK = threading.Lock()
+
+# Helper functions
+
+def _intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return tuple([_intern(item) for item in value])
+    return value
+
+def _to_json(value):
+    # Reverses _intern, JSON only has lists
+    if isinstance(value, tuple):
+        return [_to_json(item) for item in value]
+    return value
+
+def _load_versioned(cache, path, load):
+    """ Returns load(path) from the cache, loading it again whenever the file at path changed.
+    """
+    version = get_artifact_version(path)
+    cached = cache.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with _LOCK:
+        cached = cache.get(path)
+        if cached is None or cached[0] != version:
+            cache[path] = (version, load(path))
+            if cached is not None:
+                logger.info('Reloaded changed file: {}'.format(path))
+        return cache[path][1]
+
+def get_curie_registry(curies_path):
+    """ The process wide curie registry of a curies JSON, see CurieRegistry.
+
+        :param curies_path: Path to the curies JSON of a bkb handler.
+        :type curies_path: str
+    """
+    return _load_versioned(_CURIE_REGISTRIES, curies_path, CurieRegistry.load)
+
+def load_predicates(predicates_path):
+    """ The predicates JSON of a bkb handler. The file is read again only if it changed, every caller
+        gets its own copy.
+    """
+    def _load_predicates(path):
+        with open(path, 'r') as f_:
+            return json.load(f_)
+    return copy.deepcopy(_load_versioned(_PREDICATES, predicates_path, _load_predicates))
+
+
+class CurieTable(Mapping):
+    """ Names of the curies of one category. Curies are interned and kept in a sorted tuple searched
+        by bisection, with their names in a parallel tuple, which is far smaller than a dict.
+    """
+    def __init__(self, names_by_curie):
+        curies = sorted(names_by_curie)
+        self._curies = tuple([sys.intern(curie) for curie in curies])
+        self._names = tuple([_intern(names_by_curie[curie]) for curie in curies])
+
+    def _find(self, curie):
+        idx = bisect.bisect_left(self._curies, curie)
+        if idx < len(self._curies) and self._curies[idx] == curie:
+            return idx
+        return None
+
+    def __getitem__(self, curie):
+        idx = self._find(curie)
+        if idx is None:
+            raise KeyError(curie)
+        return self._names[idx]
+
+    def __contains__(self, curie):
+        return isinstance(curie, str) and self._find(curie) is not None
+
+    def __iter__(self):
+        return iter(self._curies)
+
+    def __len__(self):
+        return len(self._curies)
+
+    def as_dict(self):
+        return {curie: _to_json(names) for curie, names in zip(self._curies, self._names)}
+
+
+class CurieRegistry(Mapping):
+    """ Read only view of a curies JSON, i.e. {category: {curie: [name, ...]}}, that handlers index like
+        the JSON itself. Use get_curie_registry to share one registry per file across the process.
+    """
+    def __init__(self, curies):
+        self._tables = {}
+        for category, names_by_curie in curies.items():
+            if isinstance(names_by_curie, dict):
+                self._tables[sys.intern(category)] = CurieTable(names_by_curie)
+            else:
+                self._tables[sys.intern(category)] = _intern(names_by_curie)
+
+    @classmethod
+    def load(cls, curies_path):
+        with open(curies_path, 'r') as f_:
+            return cls(json.load(f_))
+
+    def __getitem__(self, category):
+        return self._tables[category]
+
+    def __iter__(self):
+        return iter(self._tables)
+
+    def __len__(self):
+        return len(self._tables)
+
+    def get_name(self, category, curie):
+        """ The first name of a curie, None if it is unknown.
+        """
+        table = self._tables.get(category)
+        if table is None or curie not in table:
+            return None
+        return table[curie][0]
+
+    def as_dict(self):
+        """ The curies as plain JSON serializable dicts, as in the curies JSON. Every call builds new dicts
+            so callers can change them without affecting the shared registry.
+        """
+        return {
+            category: table.as_dict() if isinstance(table, CurieTable) else _to_json(table)
+            for category, table in self._tables.items()
+        }
@@ -0,0 +1,139 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import time
+import bisect
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Metrics sinks
+
+class MetricsSink:
+    """ Receives one record for every timed phase of a query. Subclasses should override record.
+    """
+    def record(self, phase, duration, query=None):
+        pass
+
+
+class LoggingMetricsSink(MetricsSink):
+    """ Writes every phase timing as a log line.
+    """
+    def __init__(self, level=logging.INFO):
+        self.level = level
+
+    def record(self, phase, duration, query=None):
+        query_id = getattr(query, 'query_id', None) if query is not None else None
+        logger.log(self.level, 'phase={} duration={:.6f} query_id={}'.format(phase, duration, query_id))
+
+
+class CallbackMetricsSink(MetricsSink):
+    """ Calls a function with (phase, duration, query) for every phase timing.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+
+    def record(self, phase, duration, query=None):
+        self.callback(phase, duration, query)
+
+
+class RecordingMetricsSink(MetricsSink):
+    """ Keeps every (phase, duration, query) record in a list, e.g. to send the phases timed in a worker
+        process back to the sink of the parent.
+    """
+    def __init__(self):
+        self.records = []
+
+    def record(self, phase, duration, query=None):
+        self.records.append((phase, duration, query))
+
+
+class HistogramMetricsSink(MetricsSink):
+    """ In-process histogram of phase timings.
+
+        :param bucket_bounds: Upper bounds of the histogram buckets in seconds. A final bucket
+            catches everything above the last bound.
+        :type bucket_bounds: list
+    """
+    def __init__(self, bucket_bounds=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)):
+        self.bucket_bounds = list(bucket_bounds)
+        self._lock = threading.Lock()
+        self.counts = defaultdict(lambda: [0 for _ in range(len(self.bucket_bounds) + 1)])
+        self.totals = defaultdict(float)
+
+    def record(self, phase, duration, query=None):
+        with self._lock:
+            self.counts[phase][bisect.bisect_left(self.bucket_bounds, duration)] += 1
+            self.totals[phase] += duration
+
+    def summary(self):
+        """ Returns the count, total and mean time and bucket counts of every phase.
+        """
+        with self._lock:
+            summary = {}
+            for phase, counts in self.counts.items():
+                num = sum(counts)
+                summary[phase] = {
+                    "count": num,
+                    "total": self.totals[phase],
+                    "mean": self.totals[phase] / num if num > 0 else 0,
+                    "buckets": dict(zip(self.bucket_bounds + [float('inf')], counts)),
+                }
+            return summary
+
+# Spans
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('sink', 'phase', 'query', 'start_time')
+
+    def __init__(self, sink, phase, query):
+        self.sink = sink
+        self.phase = phase
+        self.query = query
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start_time
+        if self.query is not None:
+            self.query.phase_times[self.phase] = self.query.phase_times.get(self.phase, 0) + duration
+        self.sink.record(self.phase, duration, self.query)
+        return False
+
+
+def span(sink, phase, query=None):
+    """ Times the enclosed block as a phase. The duration is added to query.phase_times and sent
+        to the sink. If the sink is None a shared no-op context manager is returned so disabled
+        metrics cost a single function call.
+
+        :param sink: The metrics sink or None if metrics are disabled.
+        :type sink: chp.metrics.MetricsSink
+        :param phase: Name of the phase.
+        :type phase: str
+        :param query: Optional query the phase belongs to.
+        :type query: chp.query.Query
+    """
+    if sink is None:
+        return _NULL_SPAN
+    return _Span(sink, phase, query)
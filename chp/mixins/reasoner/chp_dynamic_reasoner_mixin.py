@@ -1,36 +1,373 @@
+import io
+import os
+import pickle
 import compress_pickle
 import logging
 import copy
 import time
+import math
+import threading
+import multiprocessing
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from pybkb.python_base.reasoning.reasoning import updating
 from pybkb.python_base.learning.bkb_builder import LinkerBuilder
 
+from chp.bkb_overlay import BkbOverlay
+from chp.compact_bkb import CompactBkb, get_compact_bkb_path, is_compact_bkb, is_compact_bkb_of
+from chp.cache import canonicalize_feature_properties, canonicalize_query, get_artifact_version, get_artifact_scope
+from chp.metrics import span, RecordingMetricsSink
+from chp.approximation import estimate_updates
+from chp.coalescing import SingleFlight, FlightAbandoned, share_query_result
+
 logger = logging.getLogger(__name__)
 
+# Threads of the pool every budgeted call of a reasoner runs its reasoning on. Jobs that have not started
+# when the budget runs out are dropped, so at most this many abandoned jobs keep running at a time.
+_MAX_BACKGROUND_WORKERS = 2
+
+# Reasoners that started an executor. Worker processes are forked after this is set so they
+# inherit the loaded reasoner, and its prelinked bkbs, without any pickling.
+_EXECUTOR_REASONERS = {}
+
+def _worker_ping(reasoner_key):
+    return reasoner_key in _EXECUTOR_REASONERS
+
+def _worker_run(reasoner_key, method, *args):
+    """ Runs a method of the reasoner in a worker. The result is pickled with references to the prelinked
+        bkbs, which the parent already holds, so only the linked delta of a result is sent back. The sink
+        of the parent never sees the phases timed in the worker, so they are recorded and sent back along
+        with the result, see ChpDynamicReasonerMixin._load_worker_result.
+    """
+    reasoner = _EXECUTOR_REASONERS[reasoner_key]
+    metrics_sink = reasoner.metrics_sink
+    if metrics_sink is not None:
+        # Workers run one task at a time so the sink can be swapped for the task
+        reasoner.metrics_sink = RecordingMetricsSink()
+    try:
+        result = getattr(reasoner, method)(*args)
+        records = None if metrics_sink is None else reasoner.metrics_sink.records
+    finally:
+        reasoner.metrics_sink = metrics_sink
+    return reasoner._dumps_result((result, records), relink=False)
+
+def _worker_run_query(reasoner_key, query, bkb_type):
+    return _worker_run(reasoner_key, '_run_query_local', query, bkb_type)
+
+def _worker_run_group(reasoner_key, feature_properties, group, bkb_type):
+    return _worker_run(reasoner_key, '_run_group', feature_properties, group, bkb_type)
+
+class _ResultPickler(pickle.Pickler):
+    """ Pickles reasoning results with references to linked and prelinked bkbs instead of the bkbs themselves.
+
+        :param relink: If False linked bkbs are pickled with their delta instead of being linked again on load.
+        :type relink: bool
+    """
+    def __init__(self, file, reasoner, relink=True):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.reasoner = reasoner
+        self.relink = relink
+
+    def persistent_id(self, obj):
+        if self.relink and isinstance(obj, BkbOverlay) and getattr(obj, 'link_key', None) is not None:
+            return ('linked_bkb',) + obj.link_key
+        for bkb_type, bkb in self.reasoner._prelinked_bkbs.items():
+            if obj is bkb:
+                return ('prelinked_bkb', bkb_type)
+        for bkb_type, feature_index in self.reasoner._feature_indices.items():
+            if obj is feature_index:
+                return ('feature_index', bkb_type)
+        return None
+
+class _ResultUnpickler(pickle.Unpickler):
+    """ Unpickles results pickled by _ResultPickler by relinking the referenced bkbs.
+    """
+    def __init__(self, file, reasoner):
+        super().__init__(file)
+        self.reasoner = reasoner
+
+    def persistent_load(self, pid):
+        if pid[0] == 'linked_bkb':
+            return self.reasoner._link_bkb(pid[2], pid[1])
+        elif pid[0] == 'prelinked_bkb':
+            return self.reasoner._get_prelinked_bkb(pid[1])
+        elif pid[0] == 'feature_index':
+            return self.reasoner.get_feature_index(pid[1])
+        raise pickle.UnpicklingError('Unknown persistent id: {}'.format(pid))
+
 class ChpDynamicReasonerMixin:
+    # Derived state saved in snapshots, see chp.snapshot
+    _reasoner_snapshot_attributes = ['linker_builder', '_prelinked_bkbs', '_feature_indices']
+
     def _setup_reasoner(self):
         # Construct linker
-        self.linker_builder = LinkerBuilder(self.patient_data)
+        with self.startup_timeline.track("linker_builder"):
+            self.linker_builder = LinkerBuilder(self.patient_data)
         logger.info('Constructed Linker Builder from processed patient data.')
-        # Load in gene prelinked bkb for bkb_data_handler or appropriate override
-        if self.gene_prelinked_bkb_override is None:
-            with open(self.bkb_handler.collapsed_gene_bkb_path, 'rb') as f_:
-                self.gene_prelinked_bkb = compress_pickle.load(f_, compression='lz4')
-            logger.info('Loaded in gene prelinked bkb from: {}'.format(self.bkb_handler.collapsed_gene_bkb_path))
-        else:
-            self.gene_prelinked_bkb = self.gene_prelinked_bkb_override
-            logger.info('Loaded override gene prelinked bkb.')
-        # Load in drug prelinked bkb for bkb_data_handler or appropriate override
-        if self.drug_prelinked_bkb_override is None:
-            with open(self.bkb_handler.collapsed_drug_bkb_path, 'rb') as f_:
-                self.drug_prelinked_bkb = compress_pickle.load(f_, compression='lz4')
-            logger.info('Loaded in drug prelinked bkb from: {}'.format(self.bkb_handler.collapsed_drug_bkb_path))
-        else:
-            self.drug_prelinked_bkb = self.drug_prelinked_bkb_override
-            logger.info('Loaded override drug prelinked bkb.')
+        # Prelinked bkbs are only loaded once a query needs them, see _get_prelinked_bkb
+        self._prelinked_bkbs = {}
+        self._feature_indices = {}
+
+    def _setup_runtime(self):
+        self._prelinked_bkb_locks = {
+            "gene": threading.Lock(),
+            "drug": threading.Lock(),
+        }
+        # Timings of the last run_queries call of each thread, see run_queries_timings
+        self._run_queries_local = threading.local()
+        self.background_executor = ThreadPoolExecutor(max_workers=_MAX_BACKGROUND_WORKERS, thread_name_prefix='chp-background')
+        # Identical queries that run at the same time share one computation
+        self.single_flight = SingleFlight()
+        # Artifact versions key the result cache so results are invalidated when the bkb files change
+        self.artifact_versions = {
+            "gene": self._get_artifact_version('gene'),
+            "drug": self._get_artifact_version('drug'),
+        }
+        if self.result_cache is not None:
+            for bkb_type, version in self.artifact_versions.items():
+                if version is not None:
+                    self.result_cache.prune(self._get_result_cache_scope(bkb_type), [version])
+        # Wait for the prelinked bkbs that were loaded concurrently during startup
+        for bkb_type in ['gene', 'drug']:
+            if '{}_prelinked_bkb'.format(bkb_type) in self._startup_futures:
+                self._get_prelinked_bkb(bkb_type)
+        self.executor = None
+
+    def _start_runtime(self):
+        if self.executor_processes:
+            self.start_executor(self.executor_processes)
+
+    @property
+    def run_queries_timings(self):
+        """ Timings of every group run by the last run_queries call of the calling thread, so concurrent
+            calls from other threads do not mix in.
+        """
+        return getattr(self._run_queries_local, 'timings', [])
+
+    @property
+    def gene_prelinked_bkb(self):
+        return self._get_prelinked_bkb('gene')
+
+    @gene_prelinked_bkb.setter
+    def gene_prelinked_bkb(self, bkb):
+        self._prelinked_bkbs['gene'] = bkb
+        self._feature_indices['gene'] = frozenset(bkb.getAllComponentNames())
+
+    @property
+    def drug_prelinked_bkb(self):
+        return self._get_prelinked_bkb('drug')
+
+    @drug_prelinked_bkb.setter
+    def drug_prelinked_bkb(self, bkb):
+        self._prelinked_bkbs['drug'] = bkb
+        self._feature_indices['drug'] = frozenset(bkb.getAllComponentNames())
+
+    def _get_prelinked_bkb(self, bkb_type):
+        """ Returns the prelinked bkb of the given type, loading it on first use. Loading is guarded by
+            a lock per bkb type so concurrent first queries only load it once.
+        """
+        bkb = self._prelinked_bkbs.get(bkb_type)
+        if bkb is not None:
+            return bkb
+        if bkb_type not in self._prelinked_bkb_locks:
+            raise ValueError('Unrecognized bkb type: {}'.format(bkb_type))
+        with self._prelinked_bkb_locks[bkb_type]:
+            if bkb_type not in self._prelinked_bkbs:
+                future = self._startup_futures.pop('{}_prelinked_bkb'.format(bkb_type), None)
+                if future is not None:
+                    # Loaded concurrently during startup
+                    self._prelinked_bkbs[bkb_type] = future.result()
+                else:
+                    with self.startup_timeline.track("{}_prelinked_bkb".format(bkb_type)):
+                        override = self._get_prelinked_bkb_override(bkb_type)
+                        # Load in prelinked bkb for bkb_data_handler or appropriate override
+                        if override is None:
+                            bkb_path = self._get_prelinked_bkb_path(bkb_type)
+                            self._prelinked_bkbs[bkb_type] = self._load_prelinked_bkb(bkb_path)
+                            logger.info('Loaded in {} prelinked bkb from: {}'.format(bkb_type, bkb_path))
+                        else:
+                            self._prelinked_bkbs[bkb_type] = override
+                            logger.info('Loaded override {} prelinked bkb.'.format(bkb_type))
+                # Index the component names once so evidence checks are constant time
+                with self.startup_timeline.track("{}_feature_index".format(bkb_type)):
+                    self._feature_indices[bkb_type] = frozenset(self._prelinked_bkbs[bkb_type].getAllComponentNames())
+        return self._prelinked_bkbs[bkb_type]
+
+    def _get_prelinked_bkb_override(self, bkb_type):
+        if bkb_type == 'gene':
+            return self.gene_prelinked_bkb_override
+        return self.drug_prelinked_bkb_override
+
+    def _get_prelinked_bkb_path(self, bkb_type):
+        if bkb_type == 'gene':
+            return self.bkb_handler.collapsed_gene_bkb_path
+        return self.bkb_handler.collapsed_drug_bkb_path
+
+    def _get_reasoner_snapshot_sources(self):
+        sources = []
+        for bkb_type in ['gene', 'drug']:
+            bkb_path = self._get_prelinked_bkb_path(bkb_type)
+            sources.append(bkb_path)
+            if os.path.exists(get_compact_bkb_path(bkb_path)):
+                sources.append(get_compact_bkb_path(bkb_path))
+        return sources
+
+    def _get_startup_tasks(self):
+        """ The prelinked bkbs that are not overridden only depend on their files, so they can be loaded
+            while the patient data is processed.
+        """
+        tasks = {}
+        for bkb_type in ['gene', 'drug']:
+            if self._get_prelinked_bkb_override(bkb_type) is None:
+                tasks['{}_prelinked_bkb'.format(bkb_type)] = partial(self._load_startup_bkb, bkb_type)
+        return tasks
+
+    def _load_startup_bkb(self, bkb_type):
+        bkb_path = self._get_prelinked_bkb_path(bkb_type)
+        with self.startup_timeline.track("{}_prelinked_bkb".format(bkb_type)):
+            bkb = self._load_prelinked_bkb(bkb_path)
+        logger.info('Loaded in {} prelinked bkb from: {}'.format(bkb_type, bkb_path))
+        return bkb
+
+    def get_feature_index(self, bkb_type):
+        """ Returns the set of component names in the prelinked bkb of the given type.
+        """
+        feature_index = self._feature_indices.get(bkb_type)
+        if feature_index is None:
+            self._get_prelinked_bkb(bkb_type)
+            feature_index = self._feature_indices[bkb_type]
+        return feature_index
+
+    def preload(self, bkb_types=('gene', 'drug')):
+        """ Eagerly loads the prelinked bkbs for deployments that want to warm up before serving. The bkb
+            types are loaded concurrently.
+
+            :param bkb_types: The bkb types to load.
+            :type bkb_types: tuple
+
+            :return: Load time in seconds of every artifact loaded so far.
+            :rtype: dict
+        """
+        with ThreadPoolExecutor(max_workers=max(len(bkb_types), 1), thread_name_prefix='chp-preload') as pool:
+            list(pool.map(self._get_prelinked_bkb, bkb_types))
+        return self.artifact_load_times
+
+    def _get_artifact_version(self, bkb_type):
+        """ Versions the artifacts a bkb type depends on. Overridden bkbs can not be versioned so None is returned.
+        """
+        if self._get_prelinked_bkb_override(bkb_type) is not None:
+            return None
+        bkb_path = self._get_prelinked_bkb_path(bkb_type)
+        paths = [self.bkb_handler.patient_data_pk_path, bkb_path]
+        compact_path = get_compact_bkb_path(bkb_path)
+        if os.path.exists(compact_path):
+            paths.append(compact_path)
+        return get_artifact_version(*paths)
+
+    def _get_result_cache_scope(self, bkb_type):
+        """ Scopes the cached results of a bkb type to its artifact paths so pruning leaves the results
+            of reasoners over other artifacts alone.
+        """
+        return get_artifact_scope(self.bkb_handler.patient_data_pk_path, self._get_prelinked_bkb_path(bkb_type))
+
+    def _get_result_cache_key(self, query, bkb_type):
+        if self.result_cache is None or self.artifact_versions.get(bkb_type) is None:
+            return None
+        return self.result_cache.make_key(bkb_type, self.artifact_versions[bkb_type], canonicalize_query(query))
+
+    def _dumps_result(self, cached_result, relink=True):
+        f_ = io.BytesIO()
+        _ResultPickler(f_, self, relink=relink).dump(cached_result)
+        return f_.getvalue()
+
+    def _loads_result(self, data):
+        return _ResultUnpickler(io.BytesIO(data), self).load()
+
+    def _load_worker_result(self, data):
+        """ Unpickles the result of a worker, see _worker_run, and replays the phases it timed into the sink.
+        """
+        result, records = self._loads_result(data)
+        if records is not None and self.metrics_sink is not None:
+            for phase, duration, query in records:
+                self.metrics_sink.record(phase, duration, query)
+        return result
+
+    def _get_cached_result(self, query, cache_key):
+        if cache_key is None:
+            return None
+        cached_result = self.result_cache.get(cache_key, loads=self._loads_result)
+        if cached_result is None:
+            return None
+        query.result, query.compute_time = cached_result
+        query.from_result_cache = True
+        return query
+
+    def _put_cached_result(self, query, cache_key, bkb_type):
+        if cache_key is not None:
+            self.result_cache.put(
+                cache_key,
+                (query.result, query.compute_time),
+                self.artifact_versions[bkb_type],
+                scope=self._get_result_cache_scope(bkb_type),
+                dumps=self._dumps_result,
+            )
 
-    def _pool_properties(self, query, bkb):
+    def _load_prelinked_bkb(self, bkb_path):
+        """ Loads a prelinked bkb. A compact bkb file next to the lz4 pickle (see chp.compact_bkb) is memory
+            mapped instead of unpickling, as long as it is complete and was converted from the pickle as it is now.
+        """
+        compact_path = get_compact_bkb_path(bkb_path)
+        if os.path.exists(compact_path):
+            if not os.path.exists(bkb_path) or is_compact_bkb_of(compact_path, bkb_path):
+                logger.info('Memory mapping compact bkb: {}'.format(compact_path))
+                return CompactBkb(compact_path)
+            logger.warning('Ignoring compact bkb {} since it is incomplete or was not converted from {}.'.format(compact_path, bkb_path))
+        if is_compact_bkb(bkb_path):
+            return CompactBkb(bkb_path)
+        with open(bkb_path, 'rb') as f_:
+            return compress_pickle.load(f_, compression='lz4')
+
+    def start_executor(self, num_processes, bkb_types=('gene', 'drug')):
+        """ Forks a pool of worker processes that run queries against this reasoner. The prelinked bkbs of
+            the passed types are loaded first as the workers share them copy-on-write via fork.
+
+            A lock held by another thread at the time of the fork, e.g. of logging or a cache, stays locked
+            in the workers. The threads of the reasoner are stopped before forking and a warning is logged
+            for any other thread that is still alive, so start the executor before starting other threads.
+
+            :param num_processes: Number of worker processes.
+            :type num_processes: int
+            :param bkb_types: The bkb types the workers will reason over.
+            :type bkb_types: tuple
+        """
+        if self.executor is not None:
+            self.shutdown_executor()
+        self.preload(bkb_types)
+        _EXECUTOR_REASONERS[id(self)] = self
+        self.executor_processes = num_processes
+        # Budgeted jobs still running keep their threads, the new executor only starts threads on use
+        self.background_executor.shutdown(wait=True)
+        self.background_executor = ThreadPoolExecutor(max_workers=_MAX_BACKGROUND_WORKERS, thread_name_prefix='chp-background')
+        other_threads = [thread.name for thread in threading.enumerate() if thread is not threading.current_thread()]
+        if len(other_threads) > 0:
+            logger.warning('Forking worker processes while other threads are alive, a lock they hold can deadlock the workers: {}'.format(', '.join(other_threads)))
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_processes,
+            mp_context=multiprocessing.get_context('fork'),
+        )
+        # Fork all the workers now instead of on the first query
+        list(self.executor.map(_worker_ping, [id(self) for _ in range(num_processes)]))
+        logger.info('Started executor with {} worker processes.'.format(num_processes))
+
+    def shutdown_executor(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            _EXECUTOR_REASONERS.pop(id(self), None)
+
+    def _pool_properties(self, query, bkb_type):
         features_not_to_format = []
         if query.dynamic_evidence is None:
             feature_properties = {}
@@ -39,7 +376,7 @@ class ChpDynamicReasonerMixin:
         if query.dynamic_targets is not None:
             feature_properties.update(query.dynamic_targets)
         for feature, state in query.evidence.items():
-            if not self.linker_builder.is_feature_in_bkb(feature, bkb):
+            if feature not in self.get_feature_index(bkb_type):
                 if feature[0] == '_':
                     logger.info('Could not find interpolate feature {} in bkb.'.format(feature))
                     features_not_to_format.append(feature)
@@ -71,10 +408,10 @@ class ChpDynamicReasonerMixin:
                 standard[feature] = '{} {}'.format(prop["op"], prop["value"])
         return standard
 
-    def _check_evidence(self, query, bkb):
+    def _check_evidence(self, query, bkb_type):
         evidence = {}
         for feature, state in query.evidence.items():
-            if not self.linker_builder.is_feature_in_bkb(feature, bkb):
+            if feature not in self.get_feature_index(bkb_type):
                 if feature[0] == '_':
                     logger.info('Could not find interpolated feature: {} in bkb so we are removing it from evidence.'.format(feature))
                 else:
@@ -84,40 +421,310 @@ class ChpDynamicReasonerMixin:
         query.evidence = evidence
         return query
 
-    def run_query(self, query, bkb_type='gene'):
-        # Need to make a copy of prelinked bkb
-        if bkb_type == 'gene':
-            bkb = copy.deepcopy(self.gene_prelinked_bkb)
-        elif bkb_type == 'drug':
-            bkb = copy.deepcopy(self.drug_prelinked_bkb)
-        else:
-            raise ValueError('Unrecognized bkb type: {}'.format(bkb_type))
-        query = self._check_evidence(query, bkb)
+    def _link_bkb(self, feature_properties, bkb_type):
+        """ Links the prelinked bkb of the given type with the passed feature properties or returns
+            an already linked bkb from the linked bkb cache.
+        """
+        if self.linked_bkb_cache is not None:
+            cache_key = (bkb_type, canonicalize_feature_properties(feature_properties))
+            bkb = self.linked_bkb_cache.get(cache_key)
+            if bkb is not None:
+                logger.info('Using cached linked {} bkb.'.format(bkb_type))
+                return bkb
+        # Link into a copy-on-write overlay so the shared prelinked bkb is never copied or mutated.
+        # The overlay only holds the linked delta and is released together with the result.
+        bkb = BkbOverlay(self._get_prelinked_bkb(bkb_type), feature_index=self.get_feature_index(bkb_type))
+        self.linker_builder.link(feature_properties, bkb)
+        # Lets results that reference this bkb be pickled by relinking instead of copying it
+        bkb.link_key = (bkb_type, feature_properties)
+        if self.linked_bkb_cache is not None:
+            self.linked_bkb_cache.put(cache_key, bkb, bkb.delta_nbytes())
+        return bkb
+
+    def _prepare_query(self, query, bkb_type):
+        """ Checks the evidence of the query and pools its dynamic properties for linking.
+        """
+        with span(self.metrics_sink, 'check_evidence', query):
+            query = self._check_evidence(query, bkb_type)
         # Pool any dynamic evidence and/or targets for linking
-        feature_properties, features_not_to_format = self._pool_properties(query, bkb)
-        # Link BKB based on dynamic evidence in query
-        linked_bkb = self.linker_builder.link(feature_properties, bkb)
-        # Update reasoning evidence with the dynamic evidence
-        evidence = self._format_evidence(query, features_not_to_format)
-        # Update reasoning targets with the dynamic targets
-        if query.targets is None:
-            targets = []
-        else:
-            targets = copy.copy(query.targets)
-        if query.dynamic_targets is not None:
-            targets += [target_feature for target_feature in query.dynamic_targets]
+        with span(self.metrics_sink, 'pool_properties', query):
+            feature_properties, features_not_to_format = self._pool_properties(query, bkb_type)
+        return query, feature_properties, features_not_to_format
+
+    def _update(self, query, bkb, features_not_to_format):
+        """ Runs updating for the query on an already linked bkb.
+        """
+        with span(self.metrics_sink, 'format_evidence', query):
+            # Update reasoning evidence with the dynamic evidence
+            evidence = self._format_evidence(query, features_not_to_format)
+            # Update reasoning targets with the dynamic targets
+            if query.targets is None:
+                targets = []
+            else:
+                targets = copy.copy(query.targets)
+            if query.dynamic_targets is not None:
+                targets += [target_feature for target_feature in query.dynamic_targets]
+        # Distributed updating saves the bkb for its hosts, which must include the linked delta of an overlay
+        if self.hosts_filename is not None and isinstance(bkb, BkbOverlay):
+            bkb = bkb.to_bkb()
         # Run update
         start_time = time.time()
-        res = updating(bkb,
-                       evidence,
-                       targets,
-                       hosts_filename=self.hosts_filename,
-                       num_processes_per_host=self.num_processes_per_host,
-                       venv=self.venv,
-                      )
+        with span(self.metrics_sink, 'updating', query):
+            res = updating(bkb,
+                           evidence,
+                           targets,
+                           hosts_filename=self.hosts_filename,
+                           num_processes_per_host=self.num_processes_per_host,
+                           venv=self.venv,
+                          )
         compute_time = time.time() - start_time
         logger.info('Ran update in {} seconds.'.format(compute_time))
         # Update query with results
         query.result = res
         query.compute_time = compute_time
         return query
+
+    def _run_query_local(self, query, bkb_type):
+        query, feature_properties, features_not_to_format = self._prepare_query(query, bkb_type)
+        # Link BKB based on dynamic evidence in query
+        with span(self.metrics_sink, 'link', query):
+            bkb = self._link_bkb(feature_properties, bkb_type)
+        return self._update(query, bkb, features_not_to_format)
+
+    def run_query(self, query, bkb_type='gene', budget=None):
+        """ Runs a single query. If an identical query is already running, its result is shared instead.
+
+            :param query: The CHP query to run.
+            :type query: chp.query.Query
+            :param bkb_type: Either 'gene' or 'drug'.
+            :type bkb_type: str
+            :param budget: Optional latency budget in seconds, see run_queries.
+            :type budget: float
+        """
+        if budget is not None:
+            return self.run_queries([query], bkb_type=bkb_type, budget=budget)[0]
+        leader_query, coalesced = self.single_flight.do(
+            self._get_flight_key(query, bkb_type),
+            lambda: self._run_single_query(query, bkb_type),
+        )
+        if coalesced:
+            return share_query_result(query, leader_query)
+        return leader_query
+
+    def _get_flight_key(self, query, bkb_type):
+        return (bkb_type, canonicalize_query(query))
+
+    def _run_single_query(self, query, bkb_type):
+        with span(self.metrics_sink, 'result_cache', query):
+            cache_key = self._get_result_cache_key(query, bkb_type)
+            cached_query = self._get_cached_result(query, cache_key)
+        if cached_query is not None:
+            return cached_query
+        if self.executor is not None:
+            query = self._load_worker_result(self.executor.submit(_worker_run_query, id(self), query, bkb_type).result())
+        else:
+            query = self._run_query_local(query, bkb_type)
+        self._put_cached_result(query, cache_key, bkb_type)
+        return query
+
+    def _group_queries(self, queries, bkb_type):
+        groups = OrderedDict()
+        for idx, query in enumerate(queries):
+            query, feature_properties, features_not_to_format = self._prepare_query(query, bkb_type)
+            group_key = canonicalize_feature_properties(feature_properties)
+            if group_key not in groups:
+                groups[group_key] = (feature_properties, [])
+            groups[group_key][1].append((idx, query, features_not_to_format))
+        logger.info('Grouped {} queries into {} linking groups.'.format(len(queries), len(groups)))
+        return groups
+
+    def _run_group(self, feature_properties, group, bkb_type):
+        """ Links the bkb once for the group and runs every query of the group against it.
+        """
+        start_time = time.time()
+        # The link is shared by the group so it is not attributed to a single query
+        with span(self.metrics_sink, 'link'):
+            bkb = self._link_bkb(feature_properties, bkb_type)
+        link_time = time.time() - start_time
+        start_time = time.time()
+        ran_group = []
+        for idx, query, features_not_to_format in group:
+            ran_group.append((idx, self._update(query, bkb, features_not_to_format)))
+        update_time = time.time() - start_time
+        timing = {
+            "feature_properties": canonicalize_feature_properties(feature_properties),
+            "num_queries": len(group),
+            "link_time": link_time,
+            "update_time": update_time,
+        }
+        logger.info('Linked group of {} queries in {} seconds and ran updates in {} seconds.'.format(len(group), link_time, update_time))
+        return ran_group, timing
+
+    def _detach_query(self, query):
+        """ Shallow copy of a query that is updated in the background, so a late result never
+            overwrites an approximate answer that was already returned.
+        """
+        detached = copy.copy(query)
+        detached.phase_times = dict(query.phase_times)
+        return detached
+
+    def _run_groups_in_background(self, jobs, bkb_type):
+        """ Submits the (feature_properties, group) jobs to the background executor of the reasoner and
+            returns a future per job. The queries of each job are detached first so a late result never
+            overwrites the approximate answer of a query whose budget ran out.
+        """
+        futures = []
+        for feature_properties, group in jobs:
+            detached_group = [(idx, self._detach_query(query), features_not_to_format) for idx, query, features_not_to_format in group]
+            futures.append(self.background_executor.submit(self._run_group, feature_properties, detached_group, bkb_type))
+        return futures
+
+    def _can_approximate(self):
+        return getattr(self, 'raw_patient_data', None) is not None
+
+    def _approximate_query(self, query):
+        """ Answers the query from the raw patient data when reasoning does not finish within the budget.
+        """
+        start_time = time.time()
+        with span(self.metrics_sink, 'approximate', query):
+            query.result, query.approximation_error = estimate_updates(
+                self.raw_patient_data,
+                query.evidence,
+                query.dynamic_evidence,
+                query.dynamic_targets,
+            )
+        query.compute_time = time.time() - start_time
+        query.partial = True
+        return query
+
+    def run_queries(self, queries, bkb_type='gene', budget=None):
+        """ Runs a batch of queries against the same type of bkb. Queries that pool to identical
+            dynamic properties are grouped so the bkb is only linked once per group. If the executor
+            is running, groups are split into chunks that are run by the worker processes.
+
+            :param queries: The CHP queries to run.
+            :type queries: list
+            :param bkb_type: Either 'gene' or 'drug'.
+            :type bkb_type: str
+            :param budget: Optional latency budget in seconds for the whole batch. Queries whose reasoning
+                does not finish in time are answered from the raw patient data instead, with partial set to
+                True and the standard error of the estimate in approximation_error. Reasoning that already
+                started still finishes in the background. Its exact results are put in the result cache and
+                shared with the identical queries waiting on them.
+            :type budget: float
+
+            :return: The ran queries in the same order as they were passed. Timings for each finished
+                group are saved in the run_queries_timings attribute of the calling thread.
+            :rtype: list
+        """
+        deadline = None if budget is None else time.time() + budget
+        ran_queries = [None for _ in queries]
+        # Only run the queries that are not in the result cache and not already running
+        cache_keys = [self._get_result_cache_key(query, bkb_type) for query in queries]
+        flight_keys = [self._get_flight_key(query, bkb_type) for query in queries]
+        uncached = []
+        coalesced = []
+        for idx, (query, cache_key) in enumerate(zip(queries, cache_keys)):
+            with span(self.metrics_sink, 'result_cache', query):
+                ran_queries[idx] = self._get_cached_result(query, cache_key)
+            if ran_queries[idx] is not None:
+                continue
+            future, leader = self.single_flight.join(flight_keys[idx])
+            if leader:
+                uncached.append(idx)
+            else:
+                coalesced.append((idx, future))
+        resolved = set()
+        try:
+            self._run_uncached_queries(queries, ran_queries, uncached, cache_keys, flight_keys, resolved, bkb_type, deadline)
+        except BaseException as ex:
+            for idx in uncached:
+                if idx not in resolved:
+                    self.single_flight.fail(flight_keys[idx], ex)
+            raise
+        # Wait for the identical queries that other calls were running
+        for idx, future in coalesced:
+            try:
+                if deadline is None or not self._can_approximate():
+                    leader_query = future.result()
+                else:
+                    leader_query = future.result(timeout=max(0, deadline - time.time()))
+            except FutureTimeoutError:
+                ran_queries[idx] = self._approximate_query(queries[idx])
+                continue
+            except FlightAbandoned:
+                # The leader dropped the reasoning so the query is run here
+                budget = None if deadline is None else max(0, deadline - time.time())
+                ran_queries[idx] = self.run_queries([queries[idx]], bkb_type=bkb_type, budget=budget)[0]
+                continue
+            ran_queries[idx] = share_query_result(queries[idx], leader_query)
+        return ran_queries
+
+    def _run_uncached_queries(self, queries, ran_queries, uncached, cache_keys, flight_keys, resolved, bkb_type, deadline):
+        """ Runs the queries this call leads, see run_queries, and resolves their flights as they finish.
+        """
+        groups = self._group_queries([queries[idx] for idx in uncached], bkb_type)
+        timings = []
+        self._run_queries_local.timings = timings
+        if self.executor is None:
+            jobs = list(groups.values())
+        else:
+            jobs = []
+            for feature_properties, group in groups.values():
+                chunk_size = math.ceil(len(group) / self.executor_processes)
+                for i in range(0, len(group), chunk_size):
+                    jobs.append((feature_properties, group[i:i+chunk_size]))
+        # Results of the executor come back pickled, see _worker_run
+        loads = None
+        if self.executor is not None:
+            futures = [self.executor.submit(_worker_run_group, id(self), feature_properties, group, bkb_type) for feature_properties, group in jobs]
+            loads = self._load_worker_result
+        elif deadline is not None and self._can_approximate():
+            futures = self._run_groups_in_background(jobs, bkb_type)
+        else:
+            if deadline is not None:
+                logger.warning('No raw patient data to approximate with so the budget is ignored.')
+            futures = None
+
+        def _finish_late_group(group, future):
+            # Flights of approximated queries are only resolved with exact results
+            try:
+                if future.cancelled():
+                    raise FlightAbandoned()
+                ran_group = future.result() if loads is None else loads(future.result())
+            except BaseException as ex:
+                for uncached_idx, _, _ in group:
+                    self.single_flight.fail(flight_keys[uncached[uncached_idx]], ex)
+                return
+            for uncached_idx, query in ran_group[0]:
+                idx = uncached[uncached_idx]
+                self._put_cached_result(query, cache_keys[idx], bkb_type)
+                self.single_flight.resolve(flight_keys[idx], query)
+
+        for job_idx, (feature_properties, group) in enumerate(jobs):
+            if futures is None:
+                ran_group, timing = self._run_group(feature_properties, group, bkb_type)
+            else:
+                future = futures[job_idx]
+                try:
+                    if deadline is None or not self._can_approximate():
+                        result = future.result()
+                    else:
+                        result = future.result(timeout=max(0, deadline - time.time()))
+                    ran_group, timing = result if loads is None else loads(result)
+                except FutureTimeoutError:
+                    logger.info('Budget ran out before a group of {} queries finished, approximating them.'.format(len(group)))
+                    for uncached_idx, query, _ in group:
+                        ran_queries[uncached[uncached_idx]] = self._approximate_query(query)
+                        resolved.add(uncached[uncached_idx])
+                    # Jobs that have not started are dropped, running ones still finish the flights and fill the result cache
+                    future.cancel()
+                    future.add_done_callback(partial(_finish_late_group, group))
+                    continue
+            for uncached_idx, query in ran_group:
+                idx = uncached[uncached_idx]
+                ran_queries[idx] = query
+                self._put_cached_result(query, cache_keys[idx], bkb_type)
+                self.single_flight.resolve(flight_keys[idx], query)
+                resolved.add(idx)
+            timings.append(timing)
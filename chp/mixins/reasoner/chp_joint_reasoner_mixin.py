@@ -1,15 +1,62 @@
 import logging
+from collections import OrderedDict
+from collections.abc import Mapping
 
 from pybkb.python_base.reasoning.reasoning import updating
 from pybkb.python_base.reasoning.joint_reasoner import JointReasoner
 
+from chp.patient_matrix import PatientMatrix
+from chp.cache import canonicalize_feature_properties
+from chp.survival_cubes import load_or_build_survival_cubes
+
 logger = logging.getLogger(__name__)
 #logger.setLevel(logging.INFO)
 
+class _LazyContributions(Mapping):
+    """ Contributions of a query answered from the survival cubes. The cubes only hold counts so
+        the patient contributions are computed from the patient matrix when they are first read.
+    """
+    def __init__(self, patient_matrix, evidence, continuous_targets):
+        self._args = (patient_matrix, evidence, continuous_targets)
+        self._contributions = None
+
+    def _get(self):
+        if self._contributions is None:
+            patient_matrix, evidence, continuous_targets = self._args
+            self._contributions = patient_matrix.compute_joint(evidence, continuous_targets=continuous_targets)[1]
+        return self._contributions
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
 class ChpJointReasonerMixin:
+    # Derived state saved in snapshots, see chp.snapshot
+    _reasoner_snapshot_attributes = ['joint_reasoner', 'patient_matrix', 'survival_cubes']
+
     def _setup_reasoner(self):
         self.joint_reasoner = JointReasoner(self.patient_data)
         logger.info('Setup Joint Reasoner.')
+        # Build the columnar patient matrix that answers most joint queries without pybkb
+        self.patient_matrix = None
+        if getattr(self, 'raw_patient_data', None) is not None:
+            with self.startup_timeline.track("patient_matrix"):
+                self.patient_matrix = PatientMatrix(self.raw_patient_data, posting_index=self.posting_index)
+            logger.info('Built patient matrix of {} patients.'.format(len(self.patient_matrix)))
+        # Precomputed survival counts for the configured thresholds
+        self.survival_cubes = None
+        if self.patient_matrix is not None and (self.survival_thresholds is not None or self.survival_cubes_path is not None):
+            with self.startup_timeline.track("survival_cubes"):
+                self.survival_cubes = load_or_build_survival_cubes(
+                    self.patient_matrix,
+                    thresholds=self.survival_thresholds,
+                    path=self.survival_cubes_path,
+                )
 
     def _process_evidence(self, evidence):
         """ Since no interpolation is going on remove the '_' from the gene evidence if
@@ -23,16 +70,95 @@ class ChpJointReasonerMixin:
                 new_format[feature] = state
         return new_format
 
-    def run_query(self, query):
-        # Compute joint probability
-        res, contrib = self.joint_reasoner.compute_joint(
-            self._process_evidence(query.evidence),
+    def _lookup_survival_cubes(self, query, evidence):
+        """ Answers the query from the survival cubes. Returns None if the cubes do not cover it.
+        """
+        if self.survival_cubes is None:
+            return None
+        res = self.survival_cubes.lookup(
+            evidence,
             query.targets,
             continuous_evidence=query.dynamic_evidence,
             continuous_targets=query.dynamic_targets,
         )
+        if res is None:
+            return None
+        query.result = res
+        query.contributions = _LazyContributions(self.patient_matrix, evidence, query.dynamic_targets)
+        query.from_joint_reasoner = True
+        return query
+
+    def run_query(self, query):
+        evidence = self._process_evidence(query.evidence)
+        if self._lookup_survival_cubes(query, evidence) is not None:
+            return query
+        # Compute joint probability
+        if self.patient_matrix is not None and self.patient_matrix.supports(
+                evidence,
+                query.targets,
+                continuous_evidence=query.dynamic_evidence,
+                continuous_targets=query.dynamic_targets,
+                ):
+            res, contrib = self.patient_matrix.compute_joint(
+                evidence,
+                continuous_evidence=query.dynamic_evidence,
+                continuous_targets=query.dynamic_targets,
+            )
+        else:
+            res, contrib = self.joint_reasoner.compute_joint(
+                evidence,
+                query.targets,
+                continuous_evidence=query.dynamic_evidence,
+                continuous_targets=query.dynamic_targets,
+            )
         # Set query parameters
         query.result = res
         query.contributions = contrib
         query.from_joint_reasoner = True
         return query
+
+    def run_queries(self, queries):
+        """ Runs a batch of joint queries. Queries covered by the survival cubes are looked up, queries
+            that share their dynamic evidence and targets are computed together in one vectorized pass over
+            the patient matrix and the rest are run one by one.
+
+            :param queries: The CHP queries to run.
+            :type queries: list
+
+            :return: The ran queries in the same order as they were passed.
+            :rtype: list
+        """
+        if self.patient_matrix is None:
+            return [self.run_query(query) for query in queries]
+        groups = OrderedDict()
+        for query in queries:
+            evidence = self._process_evidence(query.evidence)
+            if self._lookup_survival_cubes(query, evidence) is not None:
+                continue
+            if not self.patient_matrix.supports(
+                    evidence,
+                    query.targets,
+                    continuous_evidence=query.dynamic_evidence,
+                    continuous_targets=query.dynamic_targets,
+                    ):
+                self.run_query(query)
+                continue
+            group_key = (
+                canonicalize_feature_properties(query.dynamic_evidence),
+                canonicalize_feature_properties(query.dynamic_targets),
+            )
+            if group_key not in groups:
+                groups[group_key] = []
+            groups[group_key].append((query, evidence))
+        for group in groups.values():
+            batch = self.patient_matrix.compute_joint_batch(
+                [evidence for _, evidence in group],
+                continuous_evidence=group[0][0].dynamic_evidence,
+                continuous_targets=group[0][0].dynamic_targets,
+            )
+            for (query, _), (res, contrib) in zip(group, batch):
+                query.result = res
+                query.contributions = contrib
+                query.from_joint_reasoner = True
+        logger.info('Ran {} joint queries in {} vectorized groups.'.format(len(queries), len(groups)))
+        return queries
@@ -10,7 +10,6 @@
 
 import copy
 import csv
-import sys
 import uuid
 import json
 from collections import defaultdict
@@ -19,7 +18,9 @@ from chp_data.bkb_handler import BkbDataHandler
 from chp_data.trapi_constants import *
 
 from chp.query import Query
+from chp.query_validation import query_error
 from chp.reasoner import ChpDynamicReasoner, ChpJointReasoner
+from chp.reasoner_registry import get_reasoner
 
 
 class DefaultHandlerMixin:
@@ -32,14 +33,16 @@ class DefaultHandlerMixin:
             # Instiatate Reasoners
             if 'default' in self.query_dict:
                 if self.dynamic_reasoner is None:
-                    self.dynamic_reasoner = ChpDynamicReasoner(
-                        bkb_handler=self.bkb_data_handler,
+                    self.dynamic_reasoner = get_reasoner(
+                        ChpDynamicReasoner,
+                        self.bkb_data_handler,
                         hosts_filename=self.hosts_filename,
                         num_processes_per_host=self.num_processes_per_host)
             if 'simple' in self.query_dict:
                 if self.joint_reasoner is None:
-                    self.joint_reasoner = ChpJointReasoner(
-                        bkb_handler=self.bkb_data_handler,
+                    self.joint_reasoner = get_reasoner(
+                        ChpJointReasoner,
+                        self.bkb_data_handler,
                         hosts_filename=self.hosts_filename,
                         num_processes_per_host=self.num_processes_per_host)
 
@@ -110,9 +113,9 @@ class DefaultHandlerMixin:
                 total_nodes += 1
         if total_nodes == 0:
             acceptable_target_curies_print = ','.join(acceptable_target_curies)
-            sys.exit('Survival Node not found. Node category must be \'biolink:PhenotypicFeature\' and id must be in: ' + acceptable_target_curies_print)
+            raise query_error('Survival Node not found. Node category must be \'biolink:PhenotypicFeature\' and id must be in: ' + acceptable_target_curies_print)
         elif total_nodes > 1:
-            sys.exit('Too many target nodes')
+            raise query_error('Too many target nodes')
 
         # get disease node info and ensure only 1 disease:
         acceptable_disease_curies = ['MONDO:0007254']
@@ -131,15 +134,15 @@ class DefaultHandlerMixin:
                             qualifier = '>='
                         total_edges += 1
                 if total_edges == 0:
-                    sys.exit('Disease and target edge not found. Edge type must be \'biolink:DiseaseToPhenotypicFeatureAssociation\'')
+                    raise query_error('Disease and target edge not found. Edge type must be \'biolink:DiseaseToPhenotypicFeatureAssociation\'')
                 elif total_edges > 1:
-                    sys.exit('Disease has too many outgoing edges')
+                    raise query_error('Disease has too many outgoing edges')
                 total_nodes += 1
         if total_nodes  == 1:
             acceptable_disease_curies_print = ','.join(acceptable_disease_curies)
-            sys.exit('Disease node not found. Node type must be \'biolink:Disease\' and curie must be in: ' + acceptable_disease_curies_print)
+            raise query_error('Disease node not found. Node type must be \'biolink:Disease\' and curie must be in: ' + acceptable_disease_curies_print)
         elif total_nodes > 2:
-            sys.exit('Too many disease nodes')
+            raise query_error('Too many disease nodes')
         # set BKB target
         dynamic_targets[node["id"]] = {
             "op": qualifier,
@@ -159,15 +162,15 @@ class DefaultHandlerMixin:
                     if edge['predicate'] == BIOLINK_GENE_TO_DISEASE_PREDICATE and edge['subject'] == gene_id and edge['object'] == disease_id:
                         total_edges += 1
                 if total_edges == total_nodes - 1:
-                    sys.exit("Gene and disease edge not found. Edge type must be '{}'".format(BIOLINK_GENE_TO_DISEASE_PREDICATE))
+                    raise query_error("Gene and disease edge not found. Edge type must be '{}'".format(BIOLINK_GENE_TO_DISEASE_PREDICATE))
                 elif total_edges > total_nodes:
-                    sys.exit('Gene has too many outgoing edges')
+                    raise query_error('Gene has too many outgoing edges')
                 # check for appropriate gene node curie
                 gene_curie = node['id']
                 if gene_curie in self.curies[BIOLINK_GENE]:
                     gene = gene_curie
                 else:
-                    sys.exit('Invalid ENSEMBL Identifier. Must be in form ENSEMBL:<ID>.')
+                    raise query_error('Invalid ENSEMBL Identifier. Must be in form ENSEMBL:<ID>.')
                 evidence["_" + gene] = 'True'
                 total_nodes += 1
             # drugs
@@ -179,20 +182,20 @@ class DefaultHandlerMixin:
                     if edge['predicate'] == BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE and edge['subject'] == drug_id and edge['object'] == disease_id:
                         total_edges += 1
                 if total_edges == total_nodes - 1:
-                    sys.exit("Drug and disease edge not found. Edge type must be '{}'".format(BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE))
+                    raise query_error("Drug and disease edge not found. Edge type must be '{}'".format(BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE))
                 elif total_edges > total_nodes:
-                    sys.exit('Drug has too many outgoing edges')
+                    raise query_error('Drug has too many outgoing edges')
                 # check for appropriate drug node curie
                 drug_curie = node['id']
                 if drug_curie in self.curies[BIOLINK_DRUG]:
                     drug = drug_curie
                 else:
-                    sys.exit('Invalid CHEMBL Identifier: {}. Must be in form CHEMBL:<ID>'.format(drug_curie))
+                    raise query_error('Invalid CHEMBL Identifier: {}. Must be in form CHEMBL:<ID>'.format(drug_curie))
                 evidence[node["id"]] = 'True'
                 total_nodes += 1
 
         if total_nodes != len(query["query_graph"]['nodes']) or total_edges != len(query["query_graph"]['edges']):
-            sys.exit('There are extra components in the provided QG structure')
+            raise query_error('There are extra components in the provided QG structure')
 
         # produce BKB query
         chp_query = Query(
@@ -209,27 +212,48 @@ class DefaultHandlerMixin:
     def _run_query(self, chp_query, query_type):
         if query_type == 'simple':
             chp_query = self.joint_reasoner.run_query(chp_query)
-            # If a probability was found for the target
-            if len(chp_query.result) > 0:
-                # If a probability was found for the truth target
-                if chp_query.truth_target in chp_query.result:
-                    total_unnormalized_prob = 0
-                    for target, contrib in chp_query.result.items():
-                        prob = max(0, contrib)
-                        total_unnormalized_prob += prob
-                    chp_query.truth_prob = max([0, chp_query.result[(chp_query.truth_target)]])/total_unnormalized_prob
-                else:
-                    chp_query.truth_prob = 0
+            chp_query = self._process_joint_query(chp_query)
+        else:
+            chp_query = self.dynamic_reasoner.run_query(chp_query, budget=self.budget)
+            chp_query = self._process_dynamic_query(chp_query)
+        return chp_query
+
+    def _process_joint_query(self, chp_query):
+        # If a probability was found for the target, no matching patients means no probability either
+        if len(chp_query.result) > 0 and sum([max(0, prob) for prob in chp_query.result.values()]) > 0:
+            # If a probability was found for the truth target
+            if chp_query.truth_target in chp_query.result:
+                total_unnormalized_prob = 0
+                for target, contrib in chp_query.result.items():
+                    prob = max(0, contrib)
+                    total_unnormalized_prob += prob
+                chp_query.truth_prob = max([0, chp_query.result[(chp_query.truth_target)]])/total_unnormalized_prob
             else:
-                chp_query.truth_prob = -1
-            chp_query.report = None
+                chp_query.truth_prob = 0
         else:
-            chp_query = self.dynamic_reasoner.run_query(chp_query)
-            chp_res_dict = chp_query.result.process_updates(normalize=True)
-            chp_query.truth_prob = max([0, chp_res_dict[chp_query.truth_target[0]][chp_query.truth_target[1]]])
-            chp_query.report = None
+            chp_query.truth_prob = -1
+        chp_query.report = None
         return chp_query
 
+    def _process_dynamic_query(self, chp_query):
+        chp_res_dict = chp_query.result.process_updates(normalize=True)
+        chp_query.truth_prob = max([0, chp_res_dict[chp_query.truth_target[0]][chp_query.truth_target[1]]])
+        chp_query.report = None
+        return chp_query
+
+    def _get_run_tasks(self, chp_queries, query_type, chunk_size=None):
+        # Both query types are batched by their reasoner
+        return self._get_batch_run_tasks(chp_queries, query_type, chunk_size=chunk_size)
+
+    def _run_queries(self, chp_queries, query_type):
+        if query_type == 'simple':
+            # Simple queries that share a survival target are computed in one vectorized pass
+            chp_queries = self.joint_reasoner.run_queries(chp_queries)
+            return [self._process_joint_query(chp_query) for chp_query in chp_queries]
+        # Batch default queries so queries with the same survival target share a linked bkb
+        chp_queries = self.dynamic_reasoner.run_queries(chp_queries, budget=self.budget)
+        return [self._process_dynamic_query(chp_query) for chp_query in chp_queries]
+
     def _construct_trapi_response(self, chp_query, query_type=None):
         # Get orginal query
         if len(self.init_query) == 1:
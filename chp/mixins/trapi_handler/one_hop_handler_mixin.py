@@ -10,14 +10,15 @@
 
 import copy
 import csv
-import sys
 import pickle
 from collections import defaultdict
 
 from chp_data.trapi_constants import *
 
 from chp.query import Query
+from chp.query_validation import query_error
 from chp.reasoner import ChpDynamicReasoner
+from chp.reasoner_registry import get_reasoner
 from chp_data.bkb_handler import BkbDataHandler
 
 class OneHopHandlerMixin:
@@ -50,8 +51,9 @@ class OneHopHandlerMixin:
 
             # Instiatate Reasoners
             if self.dynamic_reasoner is None:
-                self.dynamic_reasoner = ChpDynamicReasoner(
-                    bkb_handler=self.bkb_data_handler,
+                self.dynamic_reasoner = get_reasoner(
+                    ChpDynamicReasoner,
+                    self.bkb_data_handler,
                     hosts_filename=self.hosts_filename,
                     num_processes_per_host=self.num_processes_per_host)
 
@@ -72,7 +74,7 @@ class OneHopHandlerMixin:
                 if wildcard_type is None:
                     wildcard_type = node['category']
                 else:
-                    sys.exit('You can only have one contribution target. Make sure to leave only one node with a black curie.')
+                    raise query_error('You can only have one contribution target. Make sure to leave only one node with a black curie.')
         if wildcard_type == BIOLINK_DRUG:
             return 'drug'
         elif wildcard_type == BIOLINK_GENE:
@@ -90,30 +92,30 @@ class OneHopHandlerMixin:
         dynamic_targets = {}
 
         if len(query["query_graph"]['nodes']) > 2 or len(query["query_graph"]['edges']) > 1:
-            sys.exit('1 hop quries can only have 2 nodes and 1 edge')
+            raise query_error('1 hop quries can only have 2 nodes and 1 edge')
 
         # check edge for source and target
         edge_key = list(query["query_graph"]["edges"].keys())[0]
         edge = query["query_graph"]['edges'][edge_key]
         if 'subject' not in edge.keys() or 'object' not in edge.keys():
-            sys.exit('Edge must have both a \'subject\' and and \'object\' key')
+            raise query_error('Edge must have both a \'subject\' and and \'object\' key')
         subject = edge['subject']
         obj = edge['object']
 
         # Get non-wildcard node
         if query_type == 'gene':
             if query["query_graph"]['nodes'][subject]['category'] != BIOLINK_GENE:
-                sys.exit('Subject node must be \'category\' {}'.format(BIOLINK_GENE))
+                raise query_error('Subject node must be \'category\' {}'.format(BIOLINK_GENE))
             drug_curie = query["query_graph"]['nodes'][obj]['id']
             if drug_curie not in self.curies[BIOLINK_DRUG]:
-                sys.exit('Invalid CHEMBL Identifier. Must be CHEMBL:<ID>')
+                raise query_error('Invalid CHEMBL Identifier. Must be CHEMBL:<ID>')
             evidence['_{}'.format(drug_curie)] = 'True'
         elif query_type == 'drug':
             if query["query_graph"]['nodes'][subject]['category'] != BIOLINK_DRUG:
-                sys.exit('Subject node must be \'category\' {}'.format(BIOLINK_DRUG))
+                raise query_error('Subject node must be \'category\' {}'.format(BIOLINK_DRUG))
             gene_curie = query["query_graph"]['nodes'][obj]['id']
             if gene_curie not in self.curies[BIOLINK_GENE]:
-                sys.exit('Invalid ENSEMBL Identifier. Must be ENSEMBL:<ID>')
+                raise query_error('Invalid ENSEMBL Identifier. Must be ENSEMBL:<ID>')
             evidence['_{}'.format(gene_curie)] = 'True'
 
         # default survival time
@@ -137,10 +139,27 @@ class OneHopHandlerMixin:
             Contributions for each gene are calculuated and classified under
             their true/false target assignments.
         """
+        chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type=self._get_bkb_type(query_type), budget=self.budget)
+        return self._process_dynamic_query(chp_query, query_type)
+
+    def _get_bkb_type(self, query_type):
+        # Wildcard genes are found by reasoning over the drug bkb and vice versa
         if query_type == 'gene':
-            chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type='drug')
+            return 'drug'
         elif query_type == 'drug':
-            chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type='gene')
+            return 'gene'
+
+    def _get_run_tasks(self, chp_queries, query_type, chunk_size=None):
+        # Queries are batched by the dynamic reasoner
+        return self._get_batch_run_tasks(chp_queries, query_type, chunk_size=chunk_size)
+
+    def _run_queries(self, chp_queries, query_type):
+        chp_queries = self.dynamic_reasoner.run_queries(chp_queries, bkb_type=self._get_bkb_type(query_type), budget=self.budget)
+        return [self._process_dynamic_query(chp_query, query_type) for chp_query in chp_queries]
+
+    def _process_dynamic_query(self, chp_query, query_type):
+        """ Translates the patient contributions of a ran query into gene or drug contributions.
+        """
         chp_res_dict = chp_query.result.process_updates()
         chp_res_norm_dict = chp_query.result.process_updates(normalize=True)
         #chp_query.result.summary()
@@ -165,16 +184,11 @@ class OneHopHandlerMixin:
                         # Normalize to get relative contribution
                         patient_contributions[target][_hash] += contrib/hash_len #/ chp_res_dict[target_comp_name][target_state_name]
 
-        # Now iterate through the patient data to translate patient contributions to drug/gene contributions
+        # Now use the posting index to translate patient contributions to drug/gene contributions
         wildcard_contributions = defaultdict(lambda: defaultdict(int))
         for target, patient_contrib_dict in patient_contributions.items():
-            for patient, contrib in patient_contrib_dict.items():
-                if query_type == 'gene':
-                    for gene_curie in self.dynamic_reasoner.raw_patient_data[patient]["gene_curies"]:
-                        wildcard_contributions[gene_curie][target] += contrib
-                elif query_type == 'drug':
-                    for drug_curie in self.dynamic_reasoner.raw_patient_data[patient]["drug_curies"]:
-                        wildcard_contributions[drug_curie][target] += contrib
+            for curie, contrib in self.dynamic_reasoner.posting_index.aggregate(patient_contrib_dict, query_type).items():
+                wildcard_contributions[curie][target] += contrib
 
         # normalize gene contributions by the target and take relative difference
         for curie in wildcard_contributions.keys():
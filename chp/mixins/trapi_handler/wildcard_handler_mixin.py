@@ -10,16 +10,19 @@
 
 import copy
 import csv
-import sys
 import pickle
 from collections import defaultdict
 import json
 
+import numpy as np
+
 from chp_data.bkb_handler import BkbDataHandler
 from chp_data.trapi_constants import *
 
 from chp.query import Query
+from chp.query_validation import query_error
 from chp.reasoner import ChpDynamicReasoner
+from chp.reasoner_registry import get_reasoner
 from pybkb.python_base.utils import get_operator, get_opposite_operator
 
 
@@ -32,8 +35,9 @@ class WildCardHandlerMixin:
 
             # Instiatate Reasoners
             if self.dynamic_reasoner is None:
-                self.dynamic_reasoner = ChpDynamicReasoner(
-                    bkb_handler=self.bkb_data_handler,
+                self.dynamic_reasoner = get_reasoner(
+                    ChpDynamicReasoner,
+                    self.bkb_data_handler,
                     hosts_filename=self.hosts_filename,
                     num_processes_per_host=self.num_processes_per_host)
 
@@ -54,7 +58,7 @@ class WildCardHandlerMixin:
                 if wildcard_type is None:
                     wildcard_type = node['category']
                 else:
-                    sys.exit('You can only have one contribution target. Make sure to leave only one node with a black curie.')
+                    raise query_error('You can only have one contribution target. Make sure to leave only one node with a black curie.')
         if wildcard_type == BIOLINK_DRUG:
             return 'drug'
         elif wildcard_type == BIOLINK_GENE:
@@ -74,7 +78,7 @@ class WildCardHandlerMixin:
         # get phenotype node
         targets = list()
         acceptable_target_curies = ['EFO:0000714']
-        self.implicit_survival_node = False
+        implicit_survival_node = False
         for node_key in query["query_graph"]['nodes'].keys():
             node = query["query_graph"]['nodes'][node_key]
             if node['category'] == BIOLINK_PHENOTYPIC_FEATURE and node['id'] in acceptable_target_curies:
@@ -82,13 +86,13 @@ class WildCardHandlerMixin:
                 total_nodes += 1
         if total_nodes == 0:
             # Use Default Survival
-            self.implicit_survival_node = True
+            implicit_survival_node = True
             total_nodes += 1
             #acceptable_target_curies_print = ','.join(acceptable_target_curies)
             #sys.exit("Survival Node not found. Node category must be '{}' and id must be in: {}".format(BIOLINK_PHENOTYPIC_FEATURE,
             #                                                                                            acceptable_target_curies_print))
         elif total_nodes > 1:
-            sys.exit('Too many target nodes')
+            raise query_error('Too many target nodes')
 
         # get disease node info and ensure only 1 disease:
         acceptable_disease_curies = ['MONDO:0007254']
@@ -107,20 +111,20 @@ class WildCardHandlerMixin:
                             qualifier = '>='
                         total_edges += 1
                 if total_edges > 1:
-                    sys.exit('Disease has too many outgoing edges')
+                    raise query_error('Disease has too many outgoing edges')
                 total_nodes += 1
 
-        if self.implicit_survival_node:
+        if implicit_survival_node:
             days=970
             qualifier = '>='
             total_edges += 1
 
         if total_nodes  == 1:
             acceptable_disease_curies_print = ','.join(acceptable_disease_curies)
-            sys.exit("Disease node not found. Node type must be '{}' and curie must be in: {}".format(BIOLINK_DISEASE,
+            raise query_error("Disease node not found. Node type must be '{}' and curie must be in: {}".format(BIOLINK_DISEASE,
                                                                                                       acceptable_disease_curies_print))
         elif total_nodes > 2:
-            sys.exit('Too many disease nodes')
+            raise query_error('Too many disease nodes')
         # set BKB target
         dynamic_targets['EFO:0000714'] = {
             "op": qualifier,
@@ -140,16 +144,16 @@ class WildCardHandlerMixin:
                     if edge['predicate'] == BIOLINK_GENE_TO_DISEASE_PREDICATE and edge['subject'] == gene_id and edge['object'] == disease_id:
                         total_edges += 1
                 if total_edges == total_nodes - 1:
-                    sys.exit("Gene and disease edge not found. Edge type must be '{}'".format(BIOLINK_GENE_TO_DISEASE_PREDICATE))
+                    raise query_error("Gene and disease edge not found. Edge type must be '{}'".format(BIOLINK_GENE_TO_DISEASE_PREDICATE))
                 elif total_edges > total_nodes:
-                    sys.exit('Gene has too many outgoing edges')
+                    raise query_error('Gene has too many outgoing edges')
                 # check for appropriate gene node curie
                 if query_type != 'gene':
                     gene_curie = node['id']
                     if gene_curie in self.curies[BIOLINK_GENE]:
                         gene = gene_curie
                     else:
-                        sys.exit('Invalid ENSEMBL Identifier. Must be in form ENSEMBL:<ID>.')
+                        raise query_error('Invalid ENSEMBL Identifier. Must be in form ENSEMBL:<ID>.')
                     evidence["_" + gene] = 'True'
                 total_nodes += 1
             # drugs
@@ -161,24 +165,21 @@ class WildCardHandlerMixin:
                     if edge['predicate'] == BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE and edge['subject'] == drug_id and edge['object'] == disease_id:
                         total_edges += 1
                 if total_edges == total_nodes - 1:
-                    sys.exit("Drug and disease edge not found. Edge type must be '{}'".format(BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE))
+                    raise query_error("Drug and disease edge not found. Edge type must be '{}'".format(BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE))
                 elif total_edges > total_nodes:
-                    sys.exit('Drug has too many outgoing edges')
+                    raise query_error('Drug has too many outgoing edges')
                 # check for appropriate drug node curie
                 if query_type != 'drug':
                     drug_curie = node['id']
                     if drug_curie in self.curies[BIOLINK_DRUG]:
                         drug = drug_curie
                     else:
-                        sys.exit('Invalid CHEMBL Identifier: {}. Must be in form CHEMBL:<ID>'.format(drug_curie))
+                        raise query_error('Invalid CHEMBL Identifier: {}. Must be in form CHEMBL:<ID>'.format(drug_curie))
                     evidence['_' + drug] = 'True'
                 total_nodes += 1
 
         # Temporary solution to no evidence linking
-        if len(evidence.keys()) == 0 and len(dynamic_evidence.keys()) == 0:
-            self.no_evidence_probability_check = True
-        else:
-            self.no_evidence_probability_check = False
+        no_evidence_probability_check = len(evidence.keys()) == 0 and len(dynamic_evidence.keys()) == 0
 
         # produce BKB query
         chp_query = Query(
@@ -189,6 +190,9 @@ class WildCardHandlerMixin:
             type='updating')
         # Set some other helpful attributes
         chp_query.truth_target = truth_target
+        # Kept on the query rather than the handler since queries of a batch can run concurrently
+        chp_query.implicit_survival_node = implicit_survival_node
+        chp_query.no_evidence_probability_check = no_evidence_probability_check
         chp_query.query_id = query["query_id"] if 'query_id' in query else None
         return chp_query
 
@@ -200,11 +204,11 @@ class WildCardHandlerMixin:
         """
 
         # temporary solution to no evidence linking
-        if not self.no_evidence_probability_check:
+        if not chp_query.no_evidence_probability_check:
             if query_type == 'gene':
-                chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type='drug')
+                chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type='drug', budget=self.budget)
             elif query_type == 'drug':
-                chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type='gene')
+                chp_query = self.dynamic_reasoner.run_query(chp_query, bkb_type='gene', budget=self.budget)
             chp_res_dict = chp_query.result.process_updates()
             chp_res_norm_dict = chp_query.result.process_updates(normalize=True)
             #chp_query.result.summary()
@@ -229,21 +233,21 @@ class WildCardHandlerMixin:
 
         else:
             # probability of survival
-            num_survived = 0
-            num_all = len(self.dynamic_reasoner.raw_patient_data.keys())
+            patient_store = self.dynamic_reasoner.raw_patient_data
+            num_all = len(patient_store)
             str_op = chp_query.dynamic_targets['EFO:0000714']['op']
             opp_op = get_opposite_operator(str_op)
             op = get_operator(str_op)
             days = chp_query.dynamic_targets['EFO:0000714']['value']
-            for patient, pat_dict in self.dynamic_reasoner.raw_patient_data.items():
-                if op(pat_dict['survival_time'], days):
-                    num_survived += 1
+            with np.errstate(invalid='ignore'):
+                survived = op(patient_store.numeric_column('survival_time'), days)
+            num_survived = int(np.count_nonzero(survived))
             chp_query.truth_prob = num_survived/num_all
 
             # patient_contributions
             patient_contributions = defaultdict(lambda: defaultdict(int))
-            for patient, pat_dict in self.dynamic_reasoner.raw_patient_data.items():
-                if op(pat_dict['survival_time'], days):
+            for patient, patient_survived in zip(patient_store.patient_hashes.tolist(), survived.tolist()):
+                if patient_survived:
                     if num_survived == 0:
                         patient_contributions[('EFO:0000714', '{} {}'.format(str_op, days))][patient] = 0
                     else:
@@ -254,16 +258,11 @@ class WildCardHandlerMixin:
                     else:
                         patient_contributions[('EFO:0000714', '{} {}'.format(opp_op, days))][patient] = (1-chp_query.truth_prob)/(num_all-num_survived)
 
-        # Now iterate through the patient data to translate patient contributions to drug/gene contributions
+        # Now use the posting index to translate patient contributions to drug/gene contributions
         wildcard_contributions = defaultdict(lambda: defaultdict(int))
         for target, patient_contrib_dict in patient_contributions.items():
-            for patient, contrib in patient_contrib_dict.items():
-                if query_type == 'gene':
-                    for gene_curie in self.dynamic_reasoner.raw_patient_data[patient]["gene_curies"]:
-                        wildcard_contributions[gene_curie][target] += contrib
-                elif query_type == 'drug':
-                    for drug_curie in self.dynamic_reasoner.raw_patient_data[patient]["drug_curies"]:
-                        wildcard_contributions[drug_curie][target] += contrib
+            for curie, contrib in self.dynamic_reasoner.posting_index.aggregate(patient_contrib_dict, query_type).items():
+                wildcard_contributions[curie][target] += contrib
 
         # normalize gene contributions by the target and take relative difference
         for curie in wildcard_contributions.keys():
@@ -310,7 +309,7 @@ class WildCardHandlerMixin:
             else:
                 kg["nodes"].pop(node_key)
 
-        if not self.implicit_survival_node:
+        if not chp_query.implicit_survival_node:
             # Process Edges
             edge_pairs = dict()
             knowledge_edges = 0
@@ -0,0 +1,253 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import numbers
+import hashlib
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+from pybkb.python_base.utils import get_operator, get_opposite_operator
+
+from chp.patient_store import PatientStore
+from chp.posting_index import PatientPostingIndex
+
+logger = logging.getLogger(__name__)
+
+# Patient data column that holds the value of each continuous target curie
+CONTINUOUS_TARGET_FEATURES = {
+    'EFO:0000714': 'survival_time',
+}
+
+# Number of set bits in every byte value, used if numpy has no bitwise_count
+_POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+# Helper functions
+
+def popcount(bitset, axis=None):
+    """ Number of set bits in a packed bitset, or along an axis of a stack of bitsets.
+    """
+    if hasattr(np, 'bitwise_count'):
+        counts = np.bitwise_count(bitset).sum(axis=axis, dtype=np.int64)
+    else:
+        counts = _POPCOUNT_TABLE[bitset].sum(axis=axis, dtype=np.int64)
+    if axis is None:
+        return int(counts)
+    return counts
+
+
+class PatientMatrix:
+    """ Columnar view of the raw patient data for fast joint probability queries.
+
+        Every gene and drug curie is stored as a bitset over the patients packed eight patients to
+        a byte, and every numeric patient feature, e.g. survival_time, as a dense float array with
+        NaN for missing values. Evidence is then matched with bitwise ANDs of the curie bitsets and
+        vectorized comparisons on the feature arrays, and probabilities are bit counts.
+
+        :param raw_patient_data: Patient data keyed by patient hash, either a patient store or the dict
+            pickled at the bkb handler's patient_data_pk_path.
+        :type raw_patient_data: chp.patient_store.PatientStore
+        :param posting_index: Optional posting index of the same patient data to build the curie bitsets from.
+        :type posting_index: chp.posting_index.PatientPostingIndex
+    """
+    def __init__(self, raw_patient_data, posting_index=None):
+        if isinstance(raw_patient_data, PatientStore):
+            self._init_from_store(raw_patient_data, posting_index)
+            return
+        self.patient_hashes = np.array(list(raw_patient_data.keys()))
+        self.num_patients = len(self.patient_hashes)
+        curie_rows = defaultdict(list)
+        feature_values = defaultdict(lambda: np.full(self.num_patients, np.nan))
+        for row, pat_dict in enumerate(raw_patient_data.values()):
+            if posting_index is None:
+                for curie in pat_dict["gene_curies"]:
+                    curie_rows[curie].append(row)
+                for curie in pat_dict["drug_curies"]:
+                    curie_rows[curie].append(row)
+            for feature, value in pat_dict.items():
+                if isinstance(value, numbers.Number) and not isinstance(value, bool):
+                    feature_values[feature][row] = value
+        if posting_index is None:
+            self.gene_curies = sorted(set([curie for pat_dict in raw_patient_data.values() for curie in pat_dict["gene_curies"]]))
+            self.drug_curies = sorted(set([curie for pat_dict in raw_patient_data.values() for curie in pat_dict["drug_curies"]]))
+        else:
+            self.gene_curies = list(posting_index.gene_curies)
+            self.drug_curies = list(posting_index.drug_curies)
+            for curie in self.gene_curies + self.drug_curies:
+                curie_rows[curie] = posting_index.patients(curie)
+        self._set_bitsets(curie_rows)
+        self.features = dict(feature_values)
+
+    def _init_from_store(self, patient_store, posting_index):
+        # Curie rows come from the posting index and features are the store's number columns as they are
+        if posting_index is None:
+            posting_index = PatientPostingIndex(patient_store)
+        self.patient_hashes = np.asarray(patient_store.patient_hashes)
+        self.num_patients = len(self.patient_hashes)
+        self.gene_curies = list(posting_index.gene_curies)
+        self.drug_curies = list(posting_index.drug_curies)
+        self._set_bitsets({curie: posting_index.patients(curie) for curie in self.gene_curies + self.drug_curies})
+        self.features = {name: patient_store.numeric_column(name) for name in patient_store.numeric_columns()}
+
+    def _set_bitsets(self, curie_rows):
+        self.bitsets = {}
+        for curie, rows in curie_rows.items():
+            mask = np.zeros(self.num_patients, dtype=bool)
+            mask[rows] = True
+            self.bitsets[curie] = np.packbits(mask)
+        self._all = np.packbits(np.ones(self.num_patients, dtype=bool))
+        self._none = np.zeros_like(self._all)
+
+    def __len__(self):
+        return self.num_patients
+
+    def nbytes(self):
+        return sum([bitset.nbytes for bitset in self.bitsets.values()]) + sum([values.nbytes for values in self.features.values()])
+
+    def fingerprint(self):
+        """ Hash of the patients in the matrix, used to check that derived tables match the patient data.
+        """
+        return hashlib.sha256(repr(self.patient_hashes.tolist()).encode('utf-8')).hexdigest()
+
+    def _get_feature(self, feature):
+        return self.features.get(CONTINUOUS_TARGET_FEATURES.get(feature, feature))
+
+    def supports(self, evidence, targets, continuous_evidence=None, continuous_targets=None):
+        """ Whether the query can be answered from the matrix. Discrete targets and continuous
+            features that are not patient data columns are left to pybkb's JointReasoner.
+        """
+        if self.num_patients == 0 or (targets is not None and len(targets) > 0):
+            return False
+        for state in evidence.values():
+            if str(state) not in ['True', 'False']:
+                return False
+        for feature_properties in [continuous_evidence, continuous_targets]:
+            if feature_properties is None:
+                continue
+            for feature in feature_properties:
+                if self._get_feature(feature) is None:
+                    return False
+        return True
+
+    def curie_bitset(self, curie):
+        """ Bitset of the patients with the curie, empty if no patient has it.
+        """
+        return self.bitsets.get(curie, self._none)
+
+    def feature_bitset(self, feature, op, value):
+        """ Bitset of the patients whose feature satisfies the operator. Missing values never match.
+        """
+        values = self._get_feature(feature)
+        with np.errstate(invalid='ignore'):
+            mask = get_operator(op)(values, value)
+        return np.packbits(mask & ~np.isnan(values))
+
+    def evidence_bitset(self, evidence, continuous_evidence=None):
+        """ Bitset of the patients that match all the evidence.
+        """
+        bitset = self._all
+        for curie, state in evidence.items():
+            if str(state) == 'True':
+                bitset = bitset & self.curie_bitset(curie)
+            else:
+                bitset = bitset & ~self.curie_bitset(curie)
+        if continuous_evidence is not None:
+            for feature, prop in continuous_evidence.items():
+                bitset = bitset & self.feature_bitset(feature, prop["op"], prop["value"])
+        # Clear the padding bits that negated curies set
+        return bitset & self._all
+
+    def patients(self, bitset):
+        """ Hashes of the patients in a bitset.
+        """
+        rows = np.flatnonzero(np.unpackbits(bitset, count=self.num_patients))
+        return self.patient_hashes[rows]
+
+    def _target_bitsets(self, continuous_targets):
+        """ Bitset of the patients in each state of the continuous targets.
+        """
+        target_bitsets = []
+        if continuous_targets is None:
+            return target_bitsets
+        for target, prop in continuous_targets.items():
+            for state_op in [prop["op"], get_opposite_operator(prop["op"])]:
+                target_state = (target, '{} {}'.format(state_op, prop["value"]))
+                target_bitsets.append((target_state, self.feature_bitset(target, state_op, prop["value"])))
+        return target_bitsets
+
+    def compute_joint(self, evidence, continuous_evidence=None, continuous_targets=None):
+        """ Joint probability of the evidence with each state of the continuous targets.
+
+            :return: The joint probability of every (target, state) over the cohort and the contribution
+                of each matching patient to it.
+            :rtype: tuple
+        """
+        evidence_bitset = self.evidence_bitset(evidence, continuous_evidence)
+        result = {}
+        contributions = {}
+        for target_state, target_bitset in self._target_bitsets(continuous_targets):
+            bitset = evidence_bitset & target_bitset
+            result[target_state] = popcount(bitset) / self.num_patients
+            contributions[target_state] = dict.fromkeys(self.patients(bitset).tolist(), 1 / self.num_patients)
+        return result, contributions
+
+    def compute_joint_batch(self, evidences, continuous_evidence=None, continuous_targets=None, block_size=1024):
+        """ Same as compute_joint for many evidence dicts that share their continuous evidence and targets.
+
+            The bitsets of all curies in the batch, and their complements, are stacked into one table. Every
+            query becomes a row of indices into that table, so a block of queries is matched with a single
+            gather and bitwise AND reduction, and the joint counts of all queries are row bit counts.
+
+            :param evidences: The evidence dict of every query.
+            :type evidences: list
+            :param block_size: Number of queries matched at a time.
+            :type block_size: int
+
+            :return: A (result, contributions) tuple for every evidence dict.
+            :rtype: list
+        """
+        base_bitset = self.evidence_bitset({}, continuous_evidence)
+        target_bitsets = self._target_bitsets(continuous_targets)
+        curies = sorted(set([curie for evidence in evidences for curie in evidence]))
+        curie_rows = {curie: row for row, curie in enumerate(curies)}
+        # Rows are the curie bitsets, then their complements, then the continuous evidence bitset
+        table = np.empty((2 * len(curies) + 1, len(base_bitset)), dtype=np.uint8)
+        for curie, row in curie_rows.items():
+            table[row] = self.curie_bitset(curie)
+            table[len(curies) + row] = ~self.curie_bitset(curie) & self._all
+        base_row = 2 * len(curies)
+        table[base_row] = base_bitset
+        width = max([len(evidence) for evidence in evidences] + [0]) + 1
+        batch = []
+        for start in range(0, len(evidences), block_size):
+            block = evidences[start:start + block_size]
+            # Queries with fewer curies are padded with the base row, which does not change the AND
+            indices = np.full((len(block), width), base_row, dtype=np.int64)
+            for query_idx, evidence in enumerate(block):
+                for col, (curie, state) in enumerate(evidence.items()):
+                    if str(state) == 'True':
+                        indices[query_idx, col] = curie_rows[curie]
+                    else:
+                        indices[query_idx, col] = len(curies) + curie_rows[curie]
+            matches = np.bitwise_and.reduce(table[indices], axis=1)
+            block_results = [({}, {}) for _ in block]
+            for target_state, target_bitset in target_bitsets:
+                target_matches = matches & target_bitset
+                counts = popcount(target_matches, axis=1)
+                target_patients = np.unpackbits(target_matches, axis=1, count=self.num_patients).astype(bool)
+                for query_idx, (result, contributions) in enumerate(block_results):
+                    result[target_state] = int(counts[query_idx]) / self.num_patients
+                    contributions[target_state] = dict.fromkeys(
+                        self.patient_hashes[target_patients[query_idx]].tolist(),
+                        1 / self.num_patients,
+                    )
+            batch.extend(block_results)
+        return batch
@@ -0,0 +1,360 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import os
+import json
+import time
+import pickle
+import numbers
+import logging
+import argparse
+from collections.abc import Mapping
+
+import numpy as np
+
+from chp.cache import get_artifact_version
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the on disk layout changes so older stores are rebuilt
+PATIENT_STORE_FORMAT_VERSION = 2
+_META_FILENAME = 'meta.json'
+_OBJECTS_FILENAME = 'objects.pk'
+
+# Column kinds
+RAGGED = 'ragged'
+CATEGORICAL = 'categorical'
+NUMERIC = 'numeric'
+OBJECT = 'object'
+
+# Container types of ragged columns by name
+_CONTAINERS = {
+    "list": list,
+    "tuple": tuple,
+    "set": set,
+    "frozenset": frozenset,
+}
+
+# Helper functions
+
+def _get_column_kind(values):
+    """ Picks the column kind that can hold every present value of a column.
+    """
+    # Ragged values are rebuilt with the container type of the column
+    if all([type(value) in _CONTAINERS.values() and all([isinstance(item, str) for item in value]) for value in values]) \
+            and len(set([type(value) for value in values])) == 1:
+        return RAGGED
+    if all([isinstance(value, str) for value in values]):
+        return CATEGORICAL
+    if all([isinstance(value, numbers.Number) and not isinstance(value, bool) for value in values]):
+        return NUMERIC
+    return OBJECT
+
+def _encode(values):
+    """ Dictionary encodes a list of strings into a sorted dictionary and int32 codes.
+    """
+    if len(values) == 0:
+        return np.empty(0, dtype=str), np.empty(0, dtype=np.int32)
+    dictionary, codes = np.unique(np.array(values, dtype=str), return_inverse=True)
+    return dictionary, codes.astype(np.int32).reshape(-1)
+
+
+class PatientStore(Mapping):
+    """ Columnar store of the raw patient data.
+
+        Every patient data column is stored as numpy arrays by kind. Lists of strings, e.g. the gene and
+        drug curies, are ragged columns: a sorted dictionary of the distinct strings, int32 codes of every
+        patient's strings back to back and offsets so that the codes of patient i are codes[offsets[i]:offsets[i+1]].
+        String columns are dictionary encoded categoricals, number columns are float64 arrays with NaN for
+        missing values and every column has a mask of the patients that have it. Values of any other type
+        are kept as python objects.
+
+        The store is saved as a directory of .npy files that are memory mapped on load. It is also a mapping
+        from patient hash to a patient dict so callers of the old pickled patient data keep working. Each dict is
+        built on first access, with the value types of the pickled data, and the same dict is returned from then
+        on. A store built from the pickled data hands out the pickled dicts themselves. Changes to the dicts are
+        not written back to the columns.
+
+        :param patient_hashes: Hash of every patient.
+        :type patient_hashes: numpy.ndarray
+        :param columns: Arrays of every column keyed by column name.
+        :type columns: dict
+        :param source_version: Artifact version of the pickled patient data the store was built from.
+        :type source_version: str
+    """
+    def __init__(self, patient_hashes, columns, source_version=None):
+        self.patient_hashes = patient_hashes
+        self.num_patients = len(patient_hashes)
+        self.columns = columns
+        self.source_version = source_version
+        self._rows = None
+        self._records = None
+
+    def __getstate__(self):
+        # The lookup caches are rebuilt on access
+        state = self.__dict__.copy()
+        state["_rows"] = None
+        state["_records"] = None
+        return state
+
+    @classmethod
+    def from_records(cls, raw_patient_data, source_version=None):
+        """ Builds the store from patient dicts keyed by patient hash, as pickled at the bkb handler's
+            patient_data_pk_path.
+        """
+        patient_hashes = np.array(list(raw_patient_data.keys()))
+        if len(patient_hashes) > 0 and patient_hashes.dtype.kind not in 'iuU':
+            raise ValueError('Patient hashes must be integers or strings, got {}.'.format(patient_hashes.dtype))
+        num_patients = len(patient_hashes)
+        column_values = {}
+        for row, pat_dict in enumerate(raw_patient_data.values()):
+            for name, value in pat_dict.items():
+                column_values.setdefault(name, []).append((row, value))
+        columns = {}
+        for name, row_values in column_values.items():
+            rows = np.array([row for row, _ in row_values], dtype=np.int64)
+            values = [value for _, value in row_values]
+            present = np.zeros(num_patients, dtype=bool)
+            present[rows] = True
+            kind = _get_column_kind(values)
+            if kind == RAGGED:
+                lengths = np.zeros(num_patients, dtype=np.int64)
+                lengths[rows] = [len(value) for value in values]
+                offsets = np.zeros(num_patients + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum(lengths)
+                dictionary, codes = _encode([item for value in values for item in value])
+                columns[name] = {"kind": kind, "present": present, "dictionary": dictionary, "offsets": offsets, "codes": codes, "container": type(values[0]).__name__}
+            elif kind == CATEGORICAL:
+                dictionary, value_codes = _encode(values)
+                codes = np.full(num_patients, -1, dtype=np.int32)
+                codes[rows] = value_codes
+                columns[name] = {"kind": kind, "present": present, "dictionary": dictionary, "codes": codes}
+            elif kind == NUMERIC:
+                column = np.full(num_patients, np.nan)
+                column[rows] = values
+                int_mask = np.zeros(num_patients, dtype=bool)
+                int_mask[rows] = [isinstance(value, numbers.Integral) for value in values]
+                columns[name] = {"kind": kind, "present": present, "values": column, "int_mask": int_mask}
+            else:
+                column = [None] * num_patients
+                for row, value in row_values:
+                    column[row] = value
+                columns[name] = {"kind": kind, "present": present, "values": column}
+        store = cls(patient_hashes, columns, source_version=source_version)
+        store._records = list(raw_patient_data.values())
+        return store
+
+    def save(self, path):
+        """ Saves the store to a directory of .npy files and a JSON description of the columns.
+        """
+        os.makedirs(path, exist_ok=True)
+        # A store being overwritten is incomplete until the new description is written
+        if os.path.exists(os.path.join(path, _META_FILENAME)):
+            os.remove(os.path.join(path, _META_FILENAME))
+        meta = {
+            "format_version": PATIENT_STORE_FORMAT_VERSION,
+            "num_patients": self.num_patients,
+            "source_version": self.source_version,
+            "columns": [],
+        }
+        np.save(os.path.join(path, 'patient_hashes.npy'), self.patient_hashes)
+        objects = {}
+        # Files are named by column position since column names need not be valid filenames
+        for idx, (name, column) in enumerate(self.columns.items()):
+            column_meta = {"name": name, "kind": column["kind"], "fields": []}
+            if column["kind"] == RAGGED:
+                column_meta["container"] = column["container"]
+            if column["kind"] == OBJECT:
+                objects[name] = column["values"]
+            for field, array in column.items():
+                if isinstance(array, np.ndarray):
+                    np.save(os.path.join(path, 'column_{}.{}.npy'.format(idx, field)), array)
+                    column_meta["fields"].append(field)
+            meta["columns"].append(column_meta)
+        if len(objects) > 0:
+            with open(os.path.join(path, _OBJECTS_FILENAME), 'wb') as f_:
+                pickle.dump(objects, f_)
+        # Written last so an interrupted save is never loaded
+        with open(os.path.join(path, _META_FILENAME), 'w') as f_:
+            json.dump(meta, f_)
+        logger.info('Saved patient store of {} patients to: {}'.format(self.num_patients, path))
+
+    @staticmethod
+    def read_meta(path):
+        """ Description of a saved store, None if there is no complete store at path.
+        """
+        meta_path = os.path.join(path, _META_FILENAME)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f_:
+            return json.load(f_)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Loads a saved store. The arrays are memory mapped unless mmap is False.
+        """
+        meta = cls.read_meta(path)
+        if meta is None:
+            raise FileNotFoundError('No patient store at: {}'.format(path))
+        mmap_mode = 'r' if mmap else None
+        objects = {}
+        if os.path.exists(os.path.join(path, _OBJECTS_FILENAME)):
+            with open(os.path.join(path, _OBJECTS_FILENAME), 'rb') as f_:
+                objects = pickle.load(f_)
+        columns = {}
+        for idx, column_meta in enumerate(meta["columns"]):
+            column = {"kind": column_meta["kind"]}
+            for field in column_meta["fields"]:
+                column[field] = np.load(os.path.join(path, 'column_{}.{}.npy'.format(idx, field)), mmap_mode=mmap_mode)
+            if column_meta["kind"] == RAGGED:
+                column["container"] = column_meta["container"]
+            if column_meta["kind"] == OBJECT:
+                column["values"] = objects[column_meta["name"]]
+            columns[column_meta["name"]] = column
+        patient_hashes = np.load(os.path.join(path, 'patient_hashes.npy'), mmap_mode=mmap_mode)
+        return cls(patient_hashes, columns, source_version=meta["source_version"])
+
+    def nbytes(self):
+        return self.patient_hashes.nbytes + sum([
+            array.nbytes for column in self.columns.values() for array in column.values() if isinstance(array, np.ndarray)
+        ])
+
+    # Columnar access
+
+    def column_kind(self, name):
+        column = self.columns.get(name)
+        return None if column is None else column["kind"]
+
+    def numeric_columns(self):
+        return [name for name, column in self.columns.items() if column["kind"] == NUMERIC]
+
+    def numeric_column(self, name):
+        """ Values of a number column as float64 with NaN for patients that do not have it.
+        """
+        return self.columns[name]["values"]
+
+    def ragged_column(self, name):
+        """ The (dictionary, offsets, codes) arrays of a ragged column.
+        """
+        column = self.columns[name]
+        return column["dictionary"], column["offsets"], column["codes"]
+
+    def ragged_rows(self, name):
+        """ The patient row of every code of a ragged column.
+        """
+        offsets = self.columns[name]["offsets"]
+        return np.repeat(np.arange(self.num_patients, dtype=np.int32), np.diff(offsets))
+
+    def has_value(self, name, value):
+        """ Mask of the patients whose ragged column holds the value.
+        """
+        dictionary, _, codes = self.ragged_column(name)
+        mask = np.zeros(self.num_patients, dtype=bool)
+        code = np.searchsorted(dictionary, value)
+        if code == len(dictionary) or dictionary[code] != value:
+            return mask
+        mask[self.ragged_rows(name)[codes == code]] = True
+        return mask
+
+    # Mapping view
+
+    def _get_rows(self):
+        if self._rows is None:
+            self._rows = {patient: row for row, patient in enumerate(self.patient_hashes.tolist())}
+        return self._rows
+
+    def _build_record(self, row):
+        record = {}
+        for name, column in self.columns.items():
+            if not column["present"][row]:
+                continue
+            if column["kind"] == RAGGED:
+                codes = column["codes"][column["offsets"][row]:column["offsets"][row + 1]]
+                record[name] = _CONTAINERS[column["container"]](column["dictionary"][codes].tolist())
+            elif column["kind"] == CATEGORICAL:
+                record[name] = str(column["dictionary"][column["codes"][row]])
+            elif column["kind"] == NUMERIC:
+                value = column["values"][row]
+                record[name] = int(value) if column["int_mask"][row] else float(value)
+            else:
+                record[name] = column["values"][row]
+        return record
+
+    def record(self, row):
+        """ The patient dict of a row, as in the pickled patient data. Built once and cached.
+        """
+        if self._records is None:
+            self._records = [None] * self.num_patients
+        record = self._records[row]
+        if record is None:
+            record = self._build_record(row)
+            self._records[row] = record
+        return record
+
+    def __getitem__(self, patient):
+        return self.record(self._get_rows()[patient])
+
+    def __contains__(self, patient):
+        return patient in self._get_rows()
+
+    def __iter__(self):
+        return iter(self.patient_hashes.tolist())
+
+    def __len__(self):
+        return self.num_patients
+
+    def items(self):
+        for row, patient in enumerate(self.patient_hashes.tolist()):
+            yield patient, self.record(row)
+
+    def values(self):
+        for row in range(self.num_patients):
+            yield self.record(row)
+
+
+def load_patient_store(patient_data_pk_path, store_path=None):
+    """ Loads the patient store saved at store_path if it was built from the current pickled patient data,
+        otherwise builds it from the pickle and saves it to store_path. Without a store_path the store is
+        built in memory.
+
+        :param patient_data_pk_path: Path to the pickled raw patient data.
+        :type patient_data_pk_path: str
+        :param store_path: Optional directory of the saved store.
+        :type store_path: str
+    """
+    source_version = get_artifact_version(patient_data_pk_path)
+    if store_path is not None:
+        meta = PatientStore.read_meta(store_path)
+        if meta is None:
+            logger.info('No patient store at {}, building it.'.format(store_path))
+        elif meta["format_version"] != PATIENT_STORE_FORMAT_VERSION:
+            logger.info('Patient store at {} has an old format, rebuilding.'.format(store_path))
+        elif source_version is not None and meta["source_version"] != source_version:
+            logger.info('Patient store at {} was built from other patient data, rebuilding.'.format(store_path))
+        else:
+            return PatientStore.load(store_path)
+    start_time = time.time()
+    with open(patient_data_pk_path, 'rb') as patient_file:
+        raw_patient_data = pickle.load(patient_file)
+    store = PatientStore.from_records(raw_patient_data, source_version=source_version)
+    logger.info('Built patient store of {} patients in {} seconds.'.format(len(store), time.time() - start_time))
+    if store_path is not None:
+        store.save(store_path)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the pickled raw patient data to a columnar patient store.')
+    parser.add_argument('patient_data_path', help='Path to the pickled raw patient data.')
+    parser.add_argument('output_path', help='Directory of the patient store.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_patient_store(args.patient_data_path, store_path=args.output_path)
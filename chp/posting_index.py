@@ -0,0 +1,237 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import logging
+import threading
+from functools import reduce
+
+import numpy as np
+
+from chp.patient_store import PatientStore
+
+logger = logging.getLogger(__name__)
+
+# Posting indices shared by every reasoner and handler in the process, keyed by patient data version.
+# Only the latest version of each scope is kept, see get_shared_posting_index.
+_SHARED_INDICES = {}
+_SHARED_INDEX_SCOPES = {}
+_SHARED_INDEX_LOCKS = {}
+_SHARED_INDICES_LOCK = threading.Lock()
+
+# Helper functions
+
+def get_shared_posting_index(raw_patient_data, key=None, scope=None):
+    """ Returns the posting index of the patient data, building it the first time the key is seen.
+        Without a key a new, unshared index is built. Indices of different keys are built in parallel.
+
+        :param raw_patient_data: Patient data keyed by patient hash.
+        :type raw_patient_data: dict
+        :param key: Identifies the patient data, e.g. its artifact version.
+        :type key: str
+        :param scope: Identifies where the patient data comes from, e.g. its artifact scope. Building
+            the index of a new key drops the index of the older key with the same scope.
+        :type scope: str
+    """
+    if key is None:
+        return PatientPostingIndex(raw_patient_data)
+    with _SHARED_INDICES_LOCK:
+        if key in _SHARED_INDICES:
+            return _SHARED_INDICES[key]
+        build_lock = _SHARED_INDEX_LOCKS.setdefault(key, threading.Lock())
+    with build_lock:
+        with _SHARED_INDICES_LOCK:
+            if key in _SHARED_INDICES:
+                return _SHARED_INDICES[key]
+        posting_index = PatientPostingIndex(raw_patient_data)
+        with _SHARED_INDICES_LOCK:
+            _SHARED_INDICES[key] = posting_index
+            if scope is not None:
+                old_key = _SHARED_INDEX_SCOPES.get(scope)
+                if old_key is not None and old_key != key:
+                    logger.info('Dropping posting index of outdated patient data {}.'.format(old_key))
+                    _SHARED_INDICES.pop(old_key, None)
+                    _SHARED_INDEX_LOCKS.pop(old_key, None)
+                _SHARED_INDEX_SCOPES[scope] = key
+        return posting_index
+
+
+class _PostingLists:
+    """ Posting lists of one curie type stored back to back, with the postings of the i-th curie at
+        postings[offsets[i]:offsets[i+1]].
+    """
+    def __init__(self, curies, offsets, postings):
+        self.curies = curies
+        self.curie_index = {curie: idx for idx, curie in enumerate(self.curies)}
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def from_curie_rows(cls, curie_rows):
+        curies = sorted(curie_rows)
+        offsets = np.zeros(len(curies) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(curie_rows[curie]) for curie in curies])
+        postings = np.empty(offsets[-1], dtype=np.int32)
+        for idx, curie in enumerate(curies):
+            postings[offsets[idx]:offsets[idx + 1]] = np.unique(curie_rows[curie])
+        return cls(curies, offsets, postings)
+
+    @classmethod
+    def from_ragged_column(cls, patient_store, name):
+        """ Builds the posting lists of a ragged patient store column by sorting its codes.
+        """
+        if patient_store.column_kind(name) is None:
+            return cls([], np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32))
+        dictionary, _, codes = patient_store.ragged_column(name)
+        rows = patient_store.ragged_rows(name)
+        # Sort by curie then patient and drop repeated curies of a patient
+        order = np.lexsort((rows, codes))
+        codes = codes[order]
+        rows = rows[order]
+        keep = np.ones(len(codes), dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])
+        codes = codes[keep]
+        counts = np.bincount(codes, minlength=len(dictionary))
+        used = counts > 0
+        offsets = np.zeros(np.count_nonzero(used) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts[used])
+        # The dictionary is sorted so the curies are too
+        return cls(dictionary[used].tolist(), offsets, rows[keep].astype(np.int32))
+
+    def get(self, curie):
+        idx = self.curie_index.get(curie)
+        if idx is None:
+            return None
+        return self.postings[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def nbytes(self):
+        return self.offsets.nbytes + self.postings.nbytes
+
+
+class PatientPostingIndex:
+    """ Inverted index from every gene and drug curie to the patients that carry it.
+
+        Patients get dense ids in the order of the patient data and every curie maps to a sorted int32
+        array of patient ids. The arrays of each curie type are stored back to back so that summing
+        patient weights per curie is a single numpy reduction.
+
+        :param raw_patient_data: Patient data keyed by patient hash, either a patient store or a dict.
+        :type raw_patient_data: chp.patient_store.PatientStore
+    """
+    def __init__(self, raw_patient_data):
+        if isinstance(raw_patient_data, PatientStore):
+            self.patient_hashes = np.asarray(raw_patient_data.patient_hashes)
+            self.posting_lists = {
+                "gene": _PostingLists.from_ragged_column(raw_patient_data, "gene_curies"),
+                "drug": _PostingLists.from_ragged_column(raw_patient_data, "drug_curies"),
+            }
+        else:
+            self.patient_hashes = np.array(list(raw_patient_data.keys()))
+            gene_rows = {}
+            drug_rows = {}
+            for patient_id, pat_dict in enumerate(raw_patient_data.values()):
+                for curie in pat_dict["gene_curies"]:
+                    gene_rows.setdefault(curie, []).append(patient_id)
+                for curie in pat_dict["drug_curies"]:
+                    drug_rows.setdefault(curie, []).append(patient_id)
+            self.posting_lists = {
+                "gene": _PostingLists.from_curie_rows(gene_rows),
+                "drug": _PostingLists.from_curie_rows(drug_rows),
+            }
+        self.num_patients = len(self.patient_hashes)
+        self.patient_ids = {patient: patient_id for patient_id, patient in enumerate(self.patient_hashes.tolist())}
+        self._empty = np.empty(0, dtype=np.int32)
+        logger.info('Built posting index of {} genes and {} drugs over {} patients.'.format(len(self.gene_curies), len(self.drug_curies), self.num_patients))
+
+    @property
+    def gene_curies(self):
+        return self.posting_lists["gene"].curies
+
+    @property
+    def drug_curies(self):
+        return self.posting_lists["drug"].curies
+
+    def __contains__(self, curie):
+        return any([curie in posting_lists.curie_index for posting_lists in self.posting_lists.values()])
+
+    def patients(self, curie):
+        """ Sorted dense ids of the patients with the curie.
+        """
+        for posting_lists in self.posting_lists.values():
+            postings = posting_lists.get(curie)
+            if postings is not None:
+                return postings
+        return self._empty
+
+    def patient_hashes_of(self, patient_ids):
+        return self.patient_hashes[patient_ids]
+
+    def intersect(self, *curies):
+        """ Patients that carry all of the curies.
+        """
+        if len(curies) == 0:
+            return np.arange(self.num_patients, dtype=np.int32)
+        # Intersect the shortest lists first
+        postings = sorted([self.patients(curie) for curie in curies], key=len)
+        return reduce(lambda a, b: np.intersect1d(a, b, assume_unique=True), postings)
+
+    def union(self, *curies):
+        """ Patients that carry any of the curies.
+        """
+        if len(curies) == 0:
+            return self._empty
+        return np.unique(np.concatenate([self.patients(curie) for curie in curies]))
+
+    def cardinality(self, curie):
+        return len(self.patients(curie))
+
+    def aggregate(self, patient_weights, curie_type):
+        """ Sums the weights of the patients that carry each curie of a type.
+
+            :param patient_weights: Weight of each patient keyed by patient hash.
+            :type patient_weights: dict
+            :param curie_type: Either 'gene' or 'drug'.
+            :type curie_type: str
+
+            :return: Summed weight of every curie carried by at least one of the weighted patients.
+            :rtype: dict
+        """
+        posting_lists = self.posting_lists[curie_type]
+        weights = np.zeros(self.num_patients, dtype=np.float64)
+        weighted = np.zeros(self.num_patients, dtype=bool)
+        for patient, weight in patient_weights.items():
+            patient_id = self.patient_ids[patient]
+            weights[patient_id] += weight
+            weighted[patient_id] = True
+        if len(posting_lists.curies) == 0:
+            return {}
+        # Sum over every posting list at once. A trailing zero keeps the starts of empty lists at the
+        # end in bounds, the sums of empty lists are masked out below.
+        starts = posting_lists.offsets[:-1]
+        sums = np.add.reduceat(np.append(weights[posting_lists.postings], 0), starts)
+        counts = np.add.reduceat(np.append(weighted[posting_lists.postings], False).astype(np.int64), starts)
+        lengths = np.diff(posting_lists.offsets)
+        aggregated = {}
+        for idx in np.flatnonzero((lengths > 0) & (counts > 0)):
+            aggregated[posting_lists.curies[idx]] = float(sums[idx])
+        return aggregated
+
+    def memory_stats(self):
+        """ Memory used by the index compared to one bitset per curie.
+        """
+        num_curies = sum([len(posting_lists.curies) for posting_lists in self.posting_lists.values()])
+        num_postings = sum([len(posting_lists.postings) for posting_lists in self.posting_lists.values()])
+        return {
+            "num_patients": self.num_patients,
+            "num_curies": num_curies,
+            "num_postings": num_postings,
+            "mean_posting_length": num_postings / num_curies if num_curies > 0 else 0,
+            "posting_bytes": sum([posting_lists.nbytes() for posting_lists in self.posting_lists.values()]),
+            "bitset_bytes": num_curies * ((self.num_patients + 7) // 8),
+        }
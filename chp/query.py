@@ -45,6 +45,11 @@ class Query:
         self.gene_var_direct = None
         self.max_new_ev = None
         self.from_joint_reasoner = False
+        self.from_result_cache = False
+        self.phase_times = {}
+        self.partial = False
+        self.approximation_error = None
+        self.coalesced = False
 
     def make_bogus_updates(self):
         bogus_updates = {}
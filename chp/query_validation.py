@@ -0,0 +1,161 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import re
+import logging
+from numbers import Number
+
+from chp_data.trapi_constants import *
+
+logger = logging.getLogger(__name__)
+
+# Rules the handlers apply while extracting CHP queries, compiled once so queries can be checked
+# before any handler or reasoner is set up
+_CURIE_PATTERNS = {
+    BIOLINK_GENE: re.compile(r'ENSEMBL:\S+'),
+    BIOLINK_DRUG: re.compile(r'CHEMBL:\S+'),
+    BIOLINK_DISEASE: re.compile(re.escape('MONDO:0007254')),
+    BIOLINK_PHENOTYPIC_FEATURE: re.compile(re.escape('EFO:0000714')),
+}
+_CURIE_FORMATS = {
+    BIOLINK_GENE: 'ENSEMBL:<ID>',
+    BIOLINK_DRUG: 'CHEMBL:<ID>',
+    BIOLINK_DISEASE: 'MONDO:0007254',
+    BIOLINK_PHENOTYPIC_FEATURE: 'EFO:0000714',
+}
+# Subject and object category of every predicate with a fixed meaning
+_EDGE_CATEGORIES = {
+    BIOLINK_GENE_TO_DISEASE_PREDICATE: (BIOLINK_GENE, BIOLINK_DISEASE),
+    BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE: (BIOLINK_DRUG, BIOLINK_DISEASE),
+    BIOLINK_DISEASE_TO_PHENOTYPIC_FEATURE_PREDICATE: (BIOLINK_DISEASE, BIOLINK_PHENOTYPIC_FEATURE),
+}
+# Predicate of the edge every gene and drug node needs to the disease node
+_EVIDENCE_PREDICATES = {
+    BIOLINK_GENE: BIOLINK_GENE_TO_DISEASE_PREDICATE,
+    BIOLINK_DRUG: BIOLINK_CHEMICAL_TO_DISEASE_OR_PHENOTYPIC_FEATURE_PREDICATE,
+}
+_SURVIVAL_QUALIFIERS = frozenset(['==', '!=', '<', '<=', '>', '>='])
+
+
+class QueryValidationError(ValueError):
+    """ Raised for queries that can not be answered, before any reasoner is touched.
+
+        :param errors: One dict per problem with the position of the query in the batch (None for a single
+            query), the location of the problem in the query graph and a message.
+        :type errors: list
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__('; '.join(['{} at {}: {}'.format(
+            'Query' if error["query"] is None else 'Query {}'.format(error["query"]),
+            error["location"],
+            error["message"],
+        ) for error in errors]))
+
+# Helper functions
+
+def _error(position, location, message):
+    return {"query": position, "location": location, "message": message}
+
+def query_error(message, location='query_graph', position=None):
+    """ A QueryValidationError for a single problem, e.g. one a handler finds while extracting a query.
+    """
+    return QueryValidationError([_error(position, location, message)])
+
+def validate_query_structure(query, position=None):
+    """ Checks the parts of a query graph every handler relies on, i.e. categorized nodes and edges between
+        them, so the query can be classified.
+
+        :return: The structured errors, see QueryValidationError.
+        :rtype: list
+    """
+    if not isinstance(query, dict) or not isinstance(query.get("query_graph"), dict):
+        return [_error(position, 'query_graph', 'Query must have a query_graph.')]
+    qg = query["query_graph"]
+    if not isinstance(qg.get("nodes"), dict) or len(qg["nodes"]) == 0:
+        return [_error(position, 'query_graph/nodes', 'Query graph must have nodes.')]
+    if not isinstance(qg.get("edges"), dict):
+        return [_error(position, 'query_graph/edges', 'Query graph must have edges.')]
+    errors = []
+    for node_key, node in qg["nodes"].items():
+        location = 'query_graph/nodes/{}'.format(node_key)
+        if not isinstance(node, dict) or node.get("category") not in _CURIE_PATTERNS:
+            errors.append(_error(position, location, 'Node category must be one of: {}'.format(', '.join(_CURIE_PATTERNS))))
+        elif 'id' in node and not isinstance(node["id"], str):
+            errors.append(_error(position, location, 'Node id must be a single curie.'))
+    for edge_key, edge in qg["edges"].items():
+        location = 'query_graph/edges/{}'.format(edge_key)
+        if not isinstance(edge, dict) or edge.get("subject") not in qg["nodes"] or edge.get("object") not in qg["nodes"]:
+            errors.append(_error(position, location, 'Edge subject and object must be nodes of the query graph.'))
+    return errors
+
+def validate_query(query, query_type, position=None, curies=None):
+    """ Checks a structurally valid query graph against what the handler of its type can answer.
+
+        :param query_type: The type of the query, i.e. default, wildcard or onehop.
+        :type query_type: str
+        :param curies: Optional curie registry, see chp.curie_registry, to also check that curies are known.
+        :type curies: chp.curie_registry.CurieRegistry
+        :return: The structured errors, see QueryValidationError.
+        :rtype: list
+    """
+    qg = query["query_graph"]
+    errors = []
+    nodes_by_category = {category: [] for category in _CURIE_PATTERNS}
+    for node_key, node in qg["nodes"].items():
+        nodes_by_category[node["category"]].append(node_key)
+        if 'id' not in node:
+            continue
+        location = 'query_graph/nodes/{}'.format(node_key)
+        if not _CURIE_PATTERNS[node["category"]].fullmatch(node["id"]):
+            errors.append(_error(position, location, 'Invalid curie {}. Must be {}.'.format(node["id"], _CURIE_FORMATS[node["category"]])))
+        elif curies is not None and node["category"] in _EVIDENCE_PREDICATES and node["id"] not in curies[node["category"]]:
+            errors.append(_error(position, location, 'Unknown curie {}.'.format(node["id"])))
+    for edge_key, edge in qg["edges"].items():
+        location = 'query_graph/edges/{}'.format(edge_key)
+        categories = _EDGE_CATEGORIES.get(edge.get("predicate"))
+        if categories is None:
+            continue
+        if (qg["nodes"][edge["subject"]]["category"], qg["nodes"][edge["object"]]["category"]) != categories:
+            errors.append(_error(position, location, 'Predicate {} must go from a {} node to a {} node.'.format(edge["predicate"], *categories)))
+        if edge["predicate"] == BIOLINK_DISEASE_TO_PHENOTYPIC_FEATURE_PREDICATE and 'properties' in edge:
+            properties = edge["properties"]
+            if not isinstance(properties, dict) or properties.get("qualifier") not in _SURVIVAL_QUALIFIERS:
+                errors.append(_error(position, location, 'Survival qualifier must be one of: {}'.format(', '.join(sorted(_SURVIVAL_QUALIFIERS)))))
+            elif not isinstance(properties.get("days"), Number) or isinstance(properties["days"], bool):
+                errors.append(_error(position, location, 'Survival days must be a number.'))
+    if query_type == 'onehop':
+        if len(qg["nodes"]) != 2 or len(qg["edges"]) != 1:
+            errors.append(_error(position, 'query_graph', 'One hop queries can only have 2 nodes and 1 edge.'))
+        else:
+            edge = list(qg["edges"].values())[0]
+            if 'id' in qg["nodes"][edge["subject"]] or 'id' not in qg["nodes"][edge["object"]]:
+                errors.append(_error(position, 'query_graph', 'The subject of a one hop edge must be the node without a curie.'))
+        return errors
+    # Default and wildcard queries relate genes and drugs to survival through a single disease node
+    if len(nodes_by_category[BIOLINK_DISEASE]) != 1:
+        errors.append(_error(position, 'query_graph', 'Query graph must have exactly one {} node.'.format(BIOLINK_DISEASE)))
+        return errors
+    disease_key = nodes_by_category[BIOLINK_DISEASE][0]
+    for node_key, node in qg["nodes"].items():
+        if 'id' not in node and (query_type == 'default' or node["category"] not in _EVIDENCE_PREDICATES):
+            errors.append(_error(position, 'query_graph/nodes/{}'.format(node_key), 'Node must have a curie.'))
+    num_phenotypes = len(nodes_by_category[BIOLINK_PHENOTYPIC_FEATURE])
+    if num_phenotypes > 1 or (num_phenotypes == 0 and query_type == 'default'):
+        errors.append(_error(position, 'query_graph', 'Query graph must have one {} survival node.'.format(BIOLINK_PHENOTYPIC_FEATURE)))
+    required_edges = [(node_key, disease_key, _EVIDENCE_PREDICATES[category]) for category in _EVIDENCE_PREDICATES for node_key in nodes_by_category[category]]
+    required_edges += [(disease_key, node_key, BIOLINK_DISEASE_TO_PHENOTYPIC_FEATURE_PREDICATE) for node_key in nodes_by_category[BIOLINK_PHENOTYPIC_FEATURE]]
+    edges = [(edge["subject"], edge["object"], edge.get("predicate")) for edge in qg["edges"].values()]
+    for subject, obj, predicate in required_edges:
+        if edges.count((subject, obj, predicate)) != 1:
+            errors.append(_error(position, 'query_graph/nodes/{}'.format(subject), 'Node needs exactly one {} edge to {}.'.format(predicate, obj)))
+    if len(edges) != len(required_edges):
+        errors.append(_error(position, 'query_graph/edges', 'There are extra components in the provided query graph.'))
+    return errors
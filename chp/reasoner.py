@@ -1,5 +1,5 @@
-import pickle
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 from pybkb.python_base.reasoning.reasoning import updating
 from pybkb.python_base.reasoning.joint_reasoner import JointReasoner
@@ -7,6 +7,11 @@ from pybkb.python_base.learning.bkb_builder import LinkerBuilder
 
 from chp_data.patient_bkb_builder import PatientBkbBuilder
 
+from chp.patient_store import load_patient_store
+from chp.cache import get_artifact_scope
+from chp.posting_index import get_shared_posting_index
+from chp.startup import StartupTimeline
+from chp.snapshot import save_snapshot, read_snapshot_header, get_stale_reason, load_snapshot_state
 from chp.mixins.reasoner.chp_joint_reasoner_mixin import ChpJointReasonerMixin
 from chp.mixins.reasoner.chp_dynamic_reasoner_mixin import ChpDynamicReasonerMixin
 
@@ -16,6 +21,10 @@ logger = logging.getLogger(__name__)
 # Base Reasoner Class
 
 class BaseReasoner:
+    # Derived state saved in snapshots, extended by each reasoner mixin, see chp.snapshot
+    _snapshot_attributes = ['raw_patient_data', 'posting_index', 'patient_bkb_builder', 'patient_data']
+    _reasoner_snapshot_attributes = []
+
     def __init__(self,
                  bkb_handler,
                  hosts_filename=None,
@@ -24,6 +33,15 @@ class BaseReasoner:
                  patient_bkb_builder=None,
                  gene_prelinked_bkb_override=None,
                  drug_prelinked_bkb_override=None,
+                 linked_bkb_cache=None,
+                 executor_processes=None,
+                 result_cache=None,
+                 metrics_sink=None,
+                 survival_thresholds=None,
+                 survival_cubes_path=None,
+                 patient_store_path=None,
+                 startup_workers=None,
+                 snapshot_path=None,
                 ):
         """ The base reasoner class for CHP.
 
@@ -45,34 +63,178 @@ class BaseReasoner:
             :param drug_prelinked_bkb_override: A drug bkb that is used to override the bkb loaded from the
             bkb handler. Used primarily in obtaining reasoning results for internal analysis.
             :type drug_prelinked_bkb_override: pybkb.bayesianKnowledgeBase
+            :param linked_bkb_cache: Cache of BKBs that have already been linked for a set of dynamic
+            feature properties. If None, every dynamic query is linked from scratch.
+            :type linked_bkb_cache: chp.cache.LinkedBkbCache
+            :param executor_processes: If set, the dynamic reasoner forks this many worker processes once
+            everything is loaded and dispatches queries to them. The workers share the loaded bkbs and
+            patient data copy-on-write, so this is only supported on platforms that can fork.
+            :type executor_processes: int
+            :param result_cache: Optional cache of dynamic reasoning results. Entries are keyed by the
+            version of the bkb artifacts so they are invalidated when the bkb handler files change.
+            :type result_cache: chp.cache.ResultCache
+            :param metrics_sink: Optional sink that receives the timing of every dynamic reasoning phase.
+            Phase timings are also kept in the phase_times of each query. If None, phases are not timed.
+            :type metrics_sink: chp.metrics.MetricsSink
+            :param survival_thresholds: List of (op, days) survival thresholds the joint reasoner precomputes
+            survival counts for, see chp.survival_cubes. Queries on other thresholds are computed live.
+            :type survival_thresholds: list
+            :param survival_cubes_path: Optional path the joint reasoner loads precomputed survival counts from.
+            They are built, for the default 970 day threshold if no thresholds are passed, and saved there if
+            the file is missing or was built from other patient data.
+            :type survival_cubes_path: str
+            :param patient_store_path: Optional directory of the columnar patient store, see chp.patient_store.
+            The raw patient data is memory mapped from there, after converting the pickled patient data if the
+            store is missing or was built from other patient data. If None, the store is built in memory.
+            :type patient_store_path: str
+            :param startup_workers: If set, artifacts that do not depend on the patient data, i.e. the prelinked bkbs
+            of the dynamic reasoner, are loaded on this many threads while the patient data is loaded and processed.
+            Setup waits for them before returning. If None, the prelinked bkbs are loaded on first use.
+            :type startup_workers: int
+            :param snapshot_path: Optional path of a snapshot of the reasoner's derived state, see chp.snapshot. The
+            state is restored from it if it was taken with the same settings from unchanged source artifacts,
+            otherwise the reasoner is set up from the artifacts and a new snapshot is written there. Not supported
+            with a patient_bkb_builder or prelinked bkb overrides.
+            :type snapshot_path: str
         """
         self.bkb_handler = bkb_handler
         self.hosts_filename = hosts_filename
         self.num_processes_per_host = num_processes_per_host
         self.venv = venv
         self.patient_bkb_builder = patient_bkb_builder
+        # Snapshots only cover patient bkb builders built from the bkb handler
+        self._patient_bkb_builder_passed = patient_bkb_builder is not None
         self.gene_prelinked_bkb_override = gene_prelinked_bkb_override
         self.drug_prelinked_bkb_override = drug_prelinked_bkb_override
+        self.linked_bkb_cache = linked_bkb_cache
+        self.executor_processes = executor_processes
+        self.result_cache = result_cache
+        self.metrics_sink = metrics_sink
+        self.survival_thresholds = survival_thresholds
+        self.survival_cubes_path = survival_cubes_path
+        self.patient_store_path = patient_store_path
+        self.startup_workers = startup_workers
+        self.snapshot_path = snapshot_path
 
         # Run base reasoner setup
         self._setup_base_reasoner()
 
     def _setup_base_reasoner(self):
-        # Read in raw patient data
-        if self.patient_bkb_builder is None:
-            with open(self.bkb_handler.patient_data_pk_path, 'rb') as patient_file:
-                self.raw_patient_data = pickle.load(patient_file)
-            # Load in the CHP Data Patient data builder
-            self.patient_bkb_builder = PatientBkbBuilder(
-                                self.raw_patient_data,
-                                self.bkb_handler,
-                               )
-            logger.info('Constructed Patient Bkb Builder.')
-        # For readability
-        self.patient_data = self.patient_bkb_builder.patient_data
-
-        # Setup reasoner mixin
-        self._setup_reasoner()
+        # Start, end and duration of each startup artifact
+        self.startup_timeline = StartupTimeline()
+        self._startup_futures = {}
+        if self._restore_snapshot():
+            self._setup_runtime()
+            self._start_runtime()
+            logger.info(self.startup_timeline.report())
+            return
+        # Start the artifacts that do not need the patient data first so they load while it is processed
+        startup_pool = None
+        if self.startup_workers:
+            startup_pool = ThreadPoolExecutor(max_workers=self.startup_workers, thread_name_prefix='chp-startup')
+            for artifact, load in self._get_startup_tasks().items():
+                self._startup_futures[artifact] = startup_pool.submit(load)
+        try:
+            # Read in raw patient data as a columnar patient store
+            if self.patient_bkb_builder is None:
+                with self.startup_timeline.track("patient_data"):
+                    self.raw_patient_data = load_patient_store(
+                        self.bkb_handler.patient_data_pk_path,
+                        store_path=self.patient_store_path,
+                    )
+                # Index the patients of every curie, shared with all reasoners that load the same patient data
+                with self.startup_timeline.track("posting_index"):
+                    self.posting_index = get_shared_posting_index(
+                        self.raw_patient_data,
+                        key=self.raw_patient_data.source_version,
+                        scope=get_artifact_scope(self.bkb_handler.patient_data_pk_path),
+                    )
+                # Load in the CHP Data Patient data builder
+                with self.startup_timeline.track("patient_bkb_builder"):
+                    self.patient_bkb_builder = PatientBkbBuilder(
+                                        self.raw_patient_data,
+                                        self.bkb_handler,
+                                       )
+                logger.info('Constructed Patient Bkb Builder.')
+            else:
+                self.posting_index = None
+            # For readability
+            self.patient_data = self.patient_bkb_builder.patient_data
+
+            # Setup reasoner mixin
+            self._setup_reasoner()
+            self._setup_runtime()
+        finally:
+            if startup_pool is not None:
+                startup_pool.shutdown(wait=True)
+        if self.snapshot_path is not None and self._can_snapshot():
+            with self.startup_timeline.track("snapshot_save"):
+                save_snapshot(self, self.snapshot_path)
+        # Only once the startup threads are gone, see _start_runtime
+        self._start_runtime()
+        logger.info(self.startup_timeline.report())
+
+    def _can_snapshot(self):
+        # Objects passed in by the caller can not be versioned against source artifacts
+        return self.gene_prelinked_bkb_override is None and self.drug_prelinked_bkb_override is None and not self._patient_bkb_builder_passed
+
+    def _get_snapshot_attributes(self):
+        return self._snapshot_attributes + self._reasoner_snapshot_attributes
+
+    def _get_snapshot_sources(self):
+        """ Artifacts the derived state is built from. Snapshots are rebuilt when any of them changes.
+        """
+        return [self.bkb_handler.patient_data_pk_path] + self._get_reasoner_snapshot_sources()
+
+    def _get_reasoner_snapshot_sources(self):
+        return []
+
+    def _restore_snapshot(self):
+        """ Restores the derived state from the snapshot at snapshot_path. Returns False if there is no
+            snapshot or it is stale, in which case the reasoner is set up from the source artifacts.
+        """
+        if self.snapshot_path is None:
+            return False
+        if not self._can_snapshot():
+            logger.warning('Snapshots are not supported with a passed patient bkb builder or prelinked bkb overrides.')
+            return False
+        header = read_snapshot_header(self.snapshot_path)
+        if header is None:
+            logger.info('No snapshot at {}, setting up from source artifacts.'.format(self.snapshot_path))
+            return False
+        stale_reason = get_stale_reason(header, self)
+        if stale_reason is not None:
+            logger.info('Snapshot at {} is stale since {}, rebuilding.'.format(self.snapshot_path, stale_reason))
+            return False
+        with self.startup_timeline.track("snapshot_restore"):
+            for name, value in load_snapshot_state(self.snapshot_path, header).items():
+                setattr(self, name, value)
+        logger.info('Restored {} from snapshot: {}'.format(type(self).__name__, self.snapshot_path))
+        return True
+
+    @property
+    def artifact_load_times(self):
+        """ Load time in seconds of each startup artifact.
+        """
+        return self.startup_timeline.durations()
+
+    def _setup_runtime(self):
+        """ Sets up the state that is not snapshotted, e.g. locks and executors, once the derived state
+            is built or restored.
+        """
+        pass
+
+    def _start_runtime(self):
+        """ Starts what has to wait for setup to finish, e.g. worker processes that are forked and so must
+            not inherit locks held by the startup threads.
+        """
+        pass
+
+    def _get_startup_tasks(self):
+        """ Loaders of the artifacts the reasoner mixin can load concurrently with the patient data, keyed
+            by artifact name. The mixin collects their results from self._startup_futures.
+        """
+        return {}
 
     def _setup_reasoner(self):
         pass
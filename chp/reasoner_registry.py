@@ -0,0 +1,157 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chp.cache import get_artifact_version
+from chp.startup import StartupTimeline
+from chp.curie_registry import get_curie_registry
+from chp.reasoner import ChpDynamicReasoner, ChpJointReasoner
+
+logger = logging.getLogger(__name__)
+
+# Bkb handler attributes that identify the data a reasoner is built from
+_BKB_HANDLER_VERSION_ATTRIBUTES = [
+    'bkb_major_version',
+    'bkb_minor_version',
+]
+_BKB_HANDLER_PATH_ATTRIBUTES = [
+    'patient_data_pk_path',
+    'collapsed_gene_bkb_path',
+    'collapsed_drug_bkb_path',
+]
+
+# Threads each reasoner built during warmup loads its artifacts on
+_WARMUP_STARTUP_WORKERS = 2
+
+# Helper functions
+
+def get_bkb_handler_identity(bkb_handler):
+    """ Identifies the data behind a bkb handler by its version attributes and paths.
+    """
+    return tuple([getattr(bkb_handler, attr, None) for attr in _BKB_HANDLER_VERSION_ATTRIBUTES + _BKB_HANDLER_PATH_ATTRIBUTES])
+
+def get_bkb_handler_version(bkb_handler):
+    """ Fingerprint of the files behind a bkb handler, so reasoners are rebuilt when the files change.
+    """
+    paths = [getattr(bkb_handler, attr, None) for attr in _BKB_HANDLER_PATH_ATTRIBUTES]
+    return get_artifact_version(*[path for path in paths if path is not None])
+
+
+class ReasonerRegistry:
+    """ Thread safe registry of shared reasoners.
+
+        Reasoners are keyed by their bkb handler, their class and their distributed reasoning settings.
+        Each one is built the first time it is requested and the same instance is handed out afterwards,
+        until the files behind the bkb handler change and it is replaced. Reasoners with different keys
+        are built concurrently, requests for a reasoner that is being built wait for it.
+    """
+    def __init__(self):
+        self._reasoners = {}
+        self._build_locks = {}
+        self._lock = threading.Lock()
+        self.build_times = {}
+        self.startup_timeline = None
+
+    def __len__(self):
+        return len(self._reasoners)
+
+    def _get_key(self, reasoner_class, bkb_handler, hosts_filename, num_processes_per_host, venv):
+        return (get_bkb_handler_identity(bkb_handler), reasoner_class, hosts_filename, num_processes_per_host, venv)
+
+    def get(self, reasoner_class, bkb_handler, hosts_filename=None, num_processes_per_host=0, venv=None, startup_workers=None):
+        """ Returns the shared reasoner for the key, building it if needed.
+
+            :param reasoner_class: Either chp.reasoner.ChpDynamicReasoner or chp.reasoner.ChpJointReasoner.
+            :type reasoner_class: type
+            :param bkb_handler: The CHP Data handler that holds the paths to all important BKB files.
+            :type bkb_handler: chp_data.bkb_handler.BkbHandler
+            :param hosts_filename: Hosts file for distributed reasoning.
+            :type hosts_filename: str
+            :param num_processes_per_host: The number of processes that can be run on each host.
+            :type num_processes_per_host: int
+            :param venv: Virtual env path where to run distrubted reasoning.
+            :type venv: str
+            :param startup_workers: Threads that load the reasoner's artifacts concurrently if it is built,
+                see chp.reasoner.BaseReasoner. Not part of the key.
+            :type startup_workers: int
+        """
+        key = self._get_key(reasoner_class, bkb_handler, hosts_filename, num_processes_per_host, venv)
+        version = get_bkb_handler_version(bkb_handler)
+        entry = self._reasoners.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        with self._lock:
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            entry = self._reasoners.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    logger.info('Files of the bkb handler changed, rebuilding {}.'.format(reasoner_class.__name__))
+                start_time = time.time()
+                reasoner = reasoner_class(
+                    bkb_handler,
+                    hosts_filename=hosts_filename,
+                    num_processes_per_host=num_processes_per_host,
+                    venv=venv,
+                    startup_workers=startup_workers,
+                )
+                self.build_times[key] = time.time() - start_time
+                self._reasoners[key] = (version, reasoner)
+                logger.info('Built shared {} in {} seconds.'.format(reasoner_class.__name__, self.build_times[key]))
+        return self._reasoners[key][1]
+
+    def warmup(self, bkb_handler, reasoner_classes=(ChpJointReasoner, ChpDynamicReasoner), **settings):
+        """ Builds the reasoners and loads the curies JSON ahead of the first request, all concurrently.
+            Dynamic reasoners also load their prelinked bkbs, while their patient data is processed. Returns once everything is loaded and logs
+            the startup timeline, which is kept in self.startup_timeline.
+
+            :return: The warmed up reasoners.
+            :rtype: list
+        """
+        self.startup_timeline = StartupTimeline()
+
+        def _warmup_reasoner(reasoner_class):
+            with self.startup_timeline.track(reasoner_class.__name__):
+                reasoner = self.get(reasoner_class, bkb_handler, startup_workers=_WARMUP_STARTUP_WORKERS, **settings)
+            if hasattr(reasoner, 'preload'):
+                with self.startup_timeline.track('{}.preload'.format(reasoner_class.__name__)):
+                    reasoner.preload()
+            return reasoner
+
+        def _warmup_curies():
+            with self.startup_timeline.track('curies'):
+                get_curie_registry(bkb_handler.curies_path)
+
+        with ThreadPoolExecutor(max_workers=len(reasoner_classes) + 1, thread_name_prefix='chp-warmup') as pool:
+            curies_future = pool.submit(_warmup_curies)
+            reasoners = list(pool.map(_warmup_reasoner, reasoner_classes))
+            curies_future.result()
+        logger.info(self.startup_timeline.report())
+        return reasoners
+
+    def clear(self):
+        with self._lock:
+            self._reasoners.clear()
+            self._build_locks.clear()
+            self.build_times.clear()
+
+
+# The registry used by the TRAPI handlers
+REASONER_REGISTRY = ReasonerRegistry()
+
+def get_reasoner(reasoner_class, bkb_handler, **settings):
+    return REASONER_REGISTRY.get(reasoner_class, bkb_handler, **settings)
+
+def warmup(bkb_handler, **kwargs):
+    return REASONER_REGISTRY.warmup(bkb_handler, **kwargs)
@@ -0,0 +1,161 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import os
+import mmap
+import json
+import time
+import struct
+import pickle
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'CHPSNP01'
+# Bumped whenever the layout or the snapshotted attributes change so older snapshots are rebuilt
+SNAPSHOT_FORMAT_VERSION = 1
+# Out of band buffers start on a multiple of this so numpy arrays can be viewed in place from the mmap
+_ALIGNMENT = 64
+_CHECKSUM_CHUNK_SIZE = 1 << 24
+
+# Helper functions
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f_:
+        for chunk in iter(lambda: f_.read(_CHECKSUM_CHUNK_SIZE), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def describe_source(path):
+    """ Size, modification time and checksum of a source artifact.
+    """
+    stat = os.stat(path)
+    return {
+        "path": os.path.abspath(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": file_checksum(path),
+    }
+
+def source_matches(source):
+    """ Whether a source artifact is unchanged since it was described. The checksum is only recomputed
+        if the file was touched, e.g. copied by a deploy, without changing size.
+    """
+    if not os.path.exists(source["path"]):
+        return False
+    stat = os.stat(source["path"])
+    if stat.st_size != source["size"]:
+        return False
+    if stat.st_mtime_ns == source["mtime_ns"]:
+        return True
+    return file_checksum(source["path"]) == source["sha256"]
+
+def _get_abspath(path):
+    return None if path is None else os.path.abspath(path)
+
+def _get_settings(reasoner):
+    # Round trip through JSON so settings compare equal to the ones read back from a header
+    return json.loads(json.dumps({
+        "reasoner_class": type(reasoner).__name__,
+        "survival_thresholds": reasoner.survival_thresholds,
+        "survival_cubes_path": _get_abspath(reasoner.survival_cubes_path),
+        "patient_store_path": _get_abspath(reasoner.patient_store_path),
+    }))
+
+def save_snapshot(reasoner, path):
+    """ Writes the derived state of a fully set up reasoner to a single file. Lazily loaded artifacts,
+        e.g. the prelinked bkbs, are loaded first so they are part of the snapshot.
+
+        Layout: magic, little endian uint64 header length, JSON header with the format version, the
+        reasoner settings, the source artifacts and the offset and length of every section, then the
+        pickled state and the out of band buffers of its numpy arrays.
+
+        :param reasoner: The reasoner to snapshot.
+        :type reasoner: chp.reasoner.BaseReasoner
+        :param path: Path of the snapshot file.
+        :type path: str
+    """
+    if hasattr(reasoner, 'preload'):
+        reasoner.preload()
+    state = {name: getattr(reasoner, name) for name in reasoner._get_snapshot_attributes()}
+    buffers = []
+    state_bytes = pickle.dumps(state, protocol=5, buffer_callback=buffers.append)
+    sections = [state_bytes] + [buffer.raw() for buffer in buffers]
+    # Lay out sections relative to the start of the data section
+    header = {
+        "format_version": SNAPSHOT_FORMAT_VERSION,
+        "created": time.time(),
+        "settings": _get_settings(reasoner),
+        "sources": [describe_source(source_path) for source_path in reasoner._get_snapshot_sources()],
+        "sections": [],
+    }
+    offset = 0
+    for section in sections:
+        header["sections"].append({"offset": offset, "length": section.nbytes if isinstance(section, memoryview) else len(section)})
+        offset += -(-header["sections"][-1]["length"] // _ALIGNMENT) * _ALIGNMENT
+    header_bytes = json.dumps(header).encode('utf-8')
+    prefix_len = len(SNAPSHOT_MAGIC) + 8 + len(header_bytes)
+    padding = -prefix_len % _ALIGNMENT
+    # Written next to the snapshot and moved over it so readers never see a partial file
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as f_:
+        f_.write(SNAPSHOT_MAGIC)
+        f_.write(struct.pack('<Q', len(header_bytes) + padding))
+        f_.write(header_bytes + b' ' * padding)
+        for section_info, section in zip(header["sections"], sections):
+            f_.write(section)
+            f_.write(b'\0' * (-section_info["length"] % _ALIGNMENT))
+    os.replace(tmp_path, path)
+    logger.info('Saved snapshot of {} with {} buffers to: {}'.format(type(reasoner).__name__, len(buffers), path))
+
+def read_snapshot_header(path):
+    """ Header of the snapshot at path, None if there is no valid snapshot there.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f_:
+        if f_.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            return None
+        header_len = struct.unpack('<Q', f_.read(8))[0]
+        header = json.loads(f_.read(header_len).decode('utf-8'))
+    header["data_start"] = len(SNAPSHOT_MAGIC) + 8 + header_len
+    return header
+
+def get_stale_reason(header, reasoner):
+    """ Why a snapshot can not be restored into the reasoner, None if it can.
+    """
+    if header["format_version"] != SNAPSHOT_FORMAT_VERSION:
+        return 'format version {} is not {}'.format(header["format_version"], SNAPSHOT_FORMAT_VERSION)
+    if header["settings"] != _get_settings(reasoner):
+        return 'settings {} are not {}'.format(header["settings"], _get_settings(reasoner))
+    source_paths = [os.path.abspath(source_path) for source_path in reasoner._get_snapshot_sources()]
+    if source_paths != [source["path"] for source in header["sources"]]:
+        return 'it was taken from other source artifacts'
+    for source in header["sources"]:
+        if not source_matches(source):
+            return '{} changed'.format(source["path"])
+    return None
+
+def load_snapshot_state(path, header):
+    """ Maps the snapshot file copy-on-write and unpickles its state. Numpy arrays are views into the
+        mapping, only the python objects are rebuilt.
+
+        :return: The snapshotted attributes keyed by name.
+        :rtype: dict
+    """
+    with open(path, 'rb') as f_:
+        snapshot_mmap = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_COPY)
+    views = []
+    for section in header["sections"]:
+        start = header["data_start"] + section["offset"]
+        views.append(memoryview(snapshot_mmap)[start:start + section["length"]])
+    return pickle.loads(views[0], buffers=views[1:])
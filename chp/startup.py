@@ -0,0 +1,71 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupTimeline:
+    """ Records when every startup artifact started and finished loading, and on which thread, so that
+        concurrent loading can be checked at a glance.
+    """
+    def __init__(self):
+        self.origin = time.time()
+        self.entries = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, artifact):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            end_time = time.time()
+            with self._lock:
+                self.entries.append({
+                    "artifact": artifact,
+                    "start": start_time - self.origin,
+                    "end": end_time - self.origin,
+                    "duration": end_time - start_time,
+                    "thread": threading.current_thread().name,
+                })
+
+    def durations(self):
+        """ Load time in seconds of every artifact.
+        """
+        with self._lock:
+            return {entry["artifact"]: entry["duration"] for entry in self.entries}
+
+    def wall_time(self):
+        """ Seconds from the start of the timeline until the last artifact finished.
+        """
+        with self._lock:
+            return max([entry["end"] for entry in self.entries] + [0])
+
+    def report(self):
+        with self._lock:
+            entries = sorted(self.entries, key=lambda entry: entry["start"])
+        lines = ['Startup timeline ({:.3f}s wall, {:.3f}s summed):'.format(
+            self.wall_time(),
+            sum([entry["duration"] for entry in entries]),
+        )]
+        for entry in entries:
+            lines.append('  {:<28} {:>8.3f}s -> {:>8.3f}s {:>8.3f}s  [{}]'.format(
+                entry["artifact"],
+                entry["start"],
+                entry["end"],
+                entry["duration"],
+                entry["thread"],
+            ))
+        return '\n'.join(lines)
@@ -0,0 +1,244 @@
+"""
+    Source code developed by DI2AG.
+    Thayer School of Engineering at Dartmouth College
+    Authors:    Dr. Eugene Santos, Jr
+                Mr. Chase Yakaboski,
+                Mr. Gregory Hyde,
+                Mr. Luke Veenhuis,
+                Dr. Keum Joo Kim
+"""
+
+import os
+import json
+import pickle
+import logging
+import argparse
+
+import numpy as np
+
+from pybkb.python_base.utils import get_opposite_operator
+
+from chp.patient_matrix import PatientMatrix, popcount
+
+logger = logging.getLogger(__name__)
+
+SURVIVAL_TARGET = 'EFO:0000714'
+# The survival threshold the TRAPI handlers use when a query does not set one
+DEFAULT_SURVIVAL_THRESHOLDS = [('>=', 970)]
+# Number of genes expanded to dense rows at a time when counting gene and drug pairs
+_GENE_CHUNK_SIZE = 1024
+
+
+class SurvivalCubes:
+    """ Precomputed survival counts for a fixed set of survival thresholds.
+
+        For every threshold (op, days) the cubes hold the number of patients in each survival state,
+        i.e. survival_time op days and its opposite, for the whole cohort, for every gene and drug
+        curie and for every gene and drug pair. Simple queries on those thresholds are then answered
+        by table lookup.
+
+        :param thresholds: The (op, days) survival thresholds.
+        :type thresholds: list
+        :param genes: Gene curies of the pairwise rows.
+        :type genes: list
+        :param drugs: Drug curies of the pairwise columns.
+        :type drugs: list
+        :param totals: Cohort counts of shape (thresholds, 2).
+        :type totals: numpy.ndarray
+        :param marginals: Counts of shape (thresholds, 2, genes + drugs), genes first.
+        :type marginals: numpy.ndarray
+        :param pairwise: Counts of shape (thresholds, 2, genes, drugs).
+        :type pairwise: numpy.ndarray
+        :param num_patients: Size of the cohort.
+        :type num_patients: int
+        :param fingerprint: Fingerprint of the patient matrix the cubes were built from.
+        :type fingerprint: str
+    """
+    def __init__(self, thresholds, genes, drugs, totals, marginals, pairwise, num_patients, fingerprint):
+        self.thresholds = [(op, float(days)) for op, days in thresholds]
+        self.genes = list(genes)
+        self.drugs = list(drugs)
+        self.totals = totals
+        self.marginals = marginals
+        self.pairwise = pairwise
+        self.num_patients = num_patients
+        self.fingerprint = fingerprint
+        self._threshold_index = {threshold: idx for idx, threshold in enumerate(self.thresholds)}
+        self._gene_index = {gene: idx for idx, gene in enumerate(self.genes)}
+        self._drug_index = {drug: idx for idx, drug in enumerate(self.drugs)}
+
+    @classmethod
+    def build(cls, patient_matrix, thresholds=DEFAULT_SURVIVAL_THRESHOLDS):
+        """ Counts every survival state of every threshold from a patient matrix.
+
+            :param patient_matrix: The patient matrix to count.
+            :type patient_matrix: chp.patient_matrix.PatientMatrix
+            :param thresholds: The (op, days) survival thresholds.
+            :type thresholds: list
+        """
+        num_patients = patient_matrix.num_patients
+        genes = patient_matrix.gene_curies
+        drugs = patient_matrix.drug_curies
+        curie_bitsets = np.stack([patient_matrix.curie_bitset(curie) for curie in genes + drugs]) if len(genes + drugs) > 0 else None
+        drug_rows = np.stack([np.unpackbits(patient_matrix.curie_bitset(drug), count=num_patients) for drug in drugs]).astype(np.float32) if len(drugs) > 0 else None
+        totals = np.zeros((len(thresholds), 2), dtype=np.int32)
+        marginals = np.zeros((len(thresholds), 2, len(genes) + len(drugs)), dtype=np.int32)
+        pairwise = np.zeros((len(thresholds), 2, len(genes), len(drugs)), dtype=np.int32)
+        for threshold_idx, (op, days) in enumerate(thresholds):
+            for state_idx, state_op in enumerate([op, get_opposite_operator(op)]):
+                state_bitset = patient_matrix.feature_bitset(SURVIVAL_TARGET, state_op, days)
+                totals[threshold_idx, state_idx] = popcount(state_bitset)
+                if curie_bitsets is None:
+                    continue
+                marginals[threshold_idx, state_idx] = popcount(curie_bitsets & state_bitset, axis=1)
+                if drug_rows is None:
+                    continue
+                state_mask = np.unpackbits(state_bitset, count=num_patients).astype(np.float32)
+                # Pair counts are products of the gene rows restricted to the state and the drug rows
+                for start in range(0, len(genes), _GENE_CHUNK_SIZE):
+                    gene_rows = np.stack([
+                        np.unpackbits(patient_matrix.curie_bitset(gene), count=num_patients) for gene in genes[start:start + _GENE_CHUNK_SIZE]
+                    ]).astype(np.float32)
+                    pairwise[threshold_idx, state_idx, start:start + _GENE_CHUNK_SIZE] = (gene_rows * state_mask) @ drug_rows.T
+        logger.info('Built survival cubes for {} thresholds, {} genes and {} drugs.'.format(len(thresholds), len(genes), len(drugs)))
+        return cls(thresholds, genes, drugs, totals, marginals, pairwise, num_patients, patient_matrix.fingerprint())
+
+    def save(self, path):
+        with open(path, 'wb') as f_:
+            np.savez(
+                f_,
+                meta=np.array(json.dumps({
+                    "thresholds": self.thresholds,
+                    "num_patients": self.num_patients,
+                    "fingerprint": self.fingerprint,
+                })),
+                genes=np.array(self.genes, dtype=str),
+                drugs=np.array(self.drugs, dtype=str),
+                totals=self.totals,
+                marginals=self.marginals,
+                pairwise=self.pairwise,
+            )
+        logger.info('Saved survival cubes to: {}'.format(path))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as cubes:
+            meta = json.loads(str(cubes["meta"]))
+            return cls(
+                meta["thresholds"],
+                cubes["genes"].tolist(),
+                cubes["drugs"].tolist(),
+                cubes["totals"],
+                cubes["marginals"],
+                cubes["pairwise"],
+                meta["num_patients"],
+                meta["fingerprint"],
+            )
+
+    def nbytes(self):
+        return self.totals.nbytes + self.marginals.nbytes + self.pairwise.nbytes
+
+    def _get_threshold(self, continuous_targets):
+        if continuous_targets is None or len(continuous_targets) != 1 or SURVIVAL_TARGET not in continuous_targets:
+            return None
+        prop = continuous_targets[SURVIVAL_TARGET]
+        try:
+            days = float(prop["value"])
+        except (TypeError, ValueError):
+            return None
+        if (prop["op"], days) in self._threshold_index:
+            return self._threshold_index[(prop["op"], days)], False
+        # The opposite threshold is the same table with the states swapped
+        if (get_opposite_operator(prop["op"]), days) in self._threshold_index:
+            return self._threshold_index[(get_opposite_operator(prop["op"]), days)], True
+        return None
+
+    def lookup(self, evidence, targets, continuous_evidence=None, continuous_targets=None):
+        """ Answers a joint query by table lookup. Returns None if the query is not covered by the cubes,
+            i.e. it has discrete targets, continuous evidence, negated evidence, more than one gene or
+            drug, or a survival threshold that was not precomputed.
+
+            :return: The joint probability of every (target, state), as in PatientMatrix.compute_joint.
+            :rtype: dict
+        """
+        if (targets is not None and len(targets) > 0) or (continuous_evidence is not None and len(continuous_evidence) > 0):
+            return None
+        threshold = self._get_threshold(continuous_targets)
+        if threshold is None:
+            return None
+        threshold_idx, swap = threshold
+        genes = []
+        drugs = []
+        for curie, state in evidence.items():
+            if str(state) != 'True':
+                return None
+            if curie in self._gene_index:
+                genes.append(self._gene_index[curie])
+            elif curie in self._drug_index:
+                drugs.append(self._drug_index[curie])
+            else:
+                # No patient has the curie
+                genes.append(None)
+        if len(genes) > 1 or len(drugs) > 1:
+            return None
+        if None in genes:
+            counts = (0, 0)
+        elif len(genes) == 1 and len(drugs) == 1:
+            counts = self.pairwise[threshold_idx, :, genes[0], drugs[0]]
+        elif len(genes) == 1:
+            counts = self.marginals[threshold_idx, :, genes[0]]
+        elif len(drugs) == 1:
+            counts = self.marginals[threshold_idx, :, len(self.genes) + drugs[0]]
+        else:
+            counts = self.totals[threshold_idx]
+        if swap:
+            counts = (counts[1], counts[0])
+        prop = continuous_targets[SURVIVAL_TARGET]
+        return {
+            (SURVIVAL_TARGET, '{} {}'.format(prop["op"], prop["value"])): int(counts[0]) / self.num_patients,
+            (SURVIVAL_TARGET, '{} {}'.format(get_opposite_operator(prop["op"]), prop["value"])): int(counts[1]) / self.num_patients,
+        }
+
+
+def load_or_build_survival_cubes(patient_matrix, thresholds=None, path=None):
+    """ Loads the survival cubes saved at path if they were built from the same patients and cover the
+        thresholds, otherwise builds them and saves them to path.
+    """
+    if path is not None and os.path.exists(path):
+        cubes = SurvivalCubes.load(path)
+        if cubes.fingerprint != patient_matrix.fingerprint():
+            logger.info('Survival cubes at {} were built from other patient data, rebuilding.'.format(path))
+        elif thresholds is not None and not set([(op, float(days)) for op, days in thresholds]) <= set(cubes.thresholds):
+            logger.info('Survival cubes at {} do not cover all thresholds, rebuilding.'.format(path))
+        else:
+            return cubes
+    if thresholds is None:
+        thresholds = DEFAULT_SURVIVAL_THRESHOLDS
+    cubes = SurvivalCubes.build(patient_matrix, thresholds)
+    if path is not None:
+        cubes.save(path)
+    return cubes
+
+
+def _parse_threshold(threshold):
+    op, days = threshold.split(':')
+    return op, float(days)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute survival cubes from the raw patient data.')
+    parser.add_argument('patient_data_path', help='Path to the pickled raw patient data.')
+    parser.add_argument('output_path', help='Path of the survival cubes file.')
+    parser.add_argument(
+        '--thresholds',
+        nargs='+',
+        type=_parse_threshold,
+        default=DEFAULT_SURVIVAL_THRESHOLDS,
+        help='Survival thresholds as op:days, e.g. >=:970',
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with open(args.patient_data_path, 'rb') as patient_file:
+        raw_patient_data = pickle.load(patient_file)
+    SurvivalCubes.build(PatientMatrix(raw_patient_data), args.thresholds).save(args.output_path)
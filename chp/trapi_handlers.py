@@ -12,11 +12,13 @@ import copy
 import csv
 import sys
 import uuid
+import functools
 import json
 from collections import defaultdict
 
 from chp_data.bkb_handler import BkbDataHandler
 
+from chp.curie_registry import get_curie_registry
 from chp.mixins.trapi_handler.default_handler_mixin import DefaultHandlerMixin
 from chp.mixins.trapi_handler.wildcard_handler_mixin import WildCardHandlerMixin
 from chp.mixins.trapi_handler.one_hop_handler_mixin import OneHopHandlerMixin
@@ -37,6 +39,10 @@ class BaseHandler:
         :param max_results: specific to 1-hop queries, specifies the number of
             wildcard genes to return.
         :type max_results: int
+        :param budget: Optional latency budget in seconds for running the queries. Queries
+            that do not finish in time are answered approximately, see
+            chp.reasoner.ChpDynamicReasoner.run_queries.
+        :type budget: float
     """
 
     def __init__(self,
@@ -46,7 +52,8 @@ class BaseHandler:
                  max_results=100,
                  bkb_handler=None,
                  joint_reasoner=None,
-                 dynamic_reasoner=None):
+                 dynamic_reasoner=None,
+                 budget=None):
         # Save initial passed query(s)
         self.init_query = query
         # Instantiate handler is one was not passed
@@ -64,13 +71,13 @@ class BaseHandler:
         self.max_results = max_results
         self.joint_reasoner = joint_reasoner
         self.dynamic_reasoner = dynamic_reasoner
+        self.budget = budget
 
         # Run specific handler setup
         self._setup_handler()
 
-        # Read in curies
-        with open(self.bkb_data_handler.curies_path, 'r') as f_:
-            self.curies = json.load(f_)
+        # Curies are shared with every handler of the process
+        self.curies = get_curie_registry(self.bkb_data_handler.curies_path)
 
     def _handler_setup(self):
         pass
@@ -120,13 +127,67 @@ class BaseHandler:
         """
         pass
 
+    def _run_queries(self, chp_queries, query_type):
+        """ Runs all built queries of a query type. Can be overwritten by the specific handler
+            to run the queries as a batch.
+        """
+        return [self._run_query(chp_query, query_type) for chp_query in chp_queries]
+
+    def _get_run_tasks(self, chp_queries, query_type, chunk_size=None):
+        """ Splits running the queries of a query type into tasks that can run concurrently, each
+            returning its ran queries. Queries are independent by default, handlers that run their
+            queries as a batch should return a single task, see _get_batch_run_tasks.
+
+            :param chunk_size: Optional maximum number of queries of a batch task, e.g. to stream the
+                results of a large batch.
+            :type chunk_size: int
+        """
+        return [functools.partial(self._run_queries, [chp_query], query_type) for chp_query in chp_queries]
+
+    def _get_batch_run_tasks(self, chp_queries, query_type, chunk_size=None):
+        """ Runs the queries of a query type as a single batch task, or as one batch task per chunk of
+            at most chunk_size queries.
+        """
+        if chunk_size is None:
+            return [functools.partial(self._run_queries, chp_queries, query_type)]
+        return [
+            functools.partial(self._run_queries, chp_queries[start:start + chunk_size], query_type)
+            for start in range(0, len(chp_queries), chunk_size)
+        ]
+
     def run_queries(self):
         """ Runs built BKB query(s) in correspondence with the handlers _run_query function.
         """
         self.results = defaultdict(list)
         for query_type, chp_queries in self.chp_query_dict.items():
-            for chp_query in chp_queries:
-                self.results[query_type].append(self._run_query(chp_query, query_type))
+            self.results[query_type].extend(self._run_queries(chp_queries, query_type))
+        return self.results
+
+    def submit_queries(self, submit, chunk_size=None):
+        """ Schedules the built BKB query(s) without waiting for them to run, see _get_run_tasks.
+
+            :param submit: Schedules a callable and returns its future, e.g. the submit method of
+                a concurrent.futures.Executor.
+            :type submit: callable
+            :param chunk_size: Optional maximum number of queries of a batch task, see _get_run_tasks.
+            :type chunk_size: int
+            :return: The query type and future of every task, to be passed to collect_queries.
+            :rtype: list
+        """
+        futures = []
+        for query_type, chp_queries in self.chp_query_dict.items():
+            for task in self._get_run_tasks(chp_queries, query_type, chunk_size=chunk_size):
+                futures.append((query_type, submit(task)))
+        return futures
+
+    def collect_queries(self, futures):
+        """ Gathers the ran queries of submitted tasks in submission order, so that results are the same
+            as with run_queries.
+        """
+        self.results = defaultdict(list)
+        for query_type, future in futures:
+            self.results[query_type].extend(future.result())
+        return self.results
 
     def construct_trapi_response(self):
         """ Constructs the trapi responses for each query in correspondance with each handlers
@@ -7,21 +7,32 @@ Authors:    Dr. Eugene Santos, Jr
             Dr. Keum Joo Kim
 '''
 import json
+import time
+import asyncio
 import itertools
 import tqdm
 import numpy as np
 import logging
 import csv
 import uuid
+import copy
 from collections import defaultdict
+from concurrent.futures import as_completed
+
+from chp_data.bkb_handler import BkbDataHandler
 
 # Integrators
 from chp.trapi_handlers import DefaultHandler, WildCardHandler, OneHopHandler
+from chp.curie_registry import get_curie_registry, load_predicates
+from chp.query_validation import QueryValidationError, validate_query, validate_query_structure
 from chp_data.trapi_constants import *
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
+# Maximum number of queries of a batch task when streaming, so batched queries are answered and released in chunks
+STREAM_CHUNK_SIZE = 16
+
 # Helper functions
 
 def parse_query_graph(query_graph):
@@ -60,6 +71,89 @@ def parse_query_graph(query_graph):
     except:
         return None
 
+def _normalize_values(values):
+    """ A curie, category or predicate can be given as a single string or as a list of them.
+    """
+    if values is None:
+        return tuple()
+    if isinstance(values, str):
+        values = [values]
+    return tuple(sorted(set([value.strip() for value in values])))
+
+def _normalize_qualifiers(edge):
+    properties = dict(edge.get('properties', {}))
+    # A survival edge without properties is read by the handlers as the default survival query
+    if edge.get('predicate') == BIOLINK_DISEASE_TO_PHENOTYPIC_FEATURE_PREDICATE and not properties:
+        properties = {'qualifier': '>=', 'days': 970}
+    if 'qualifier' in properties:
+        properties['qualifier'] = str(properties['qualifier']).replace(' ', '')
+    if 'days' in properties:
+        properties['days'] = float(properties['days'])
+    return json.dumps(properties, sort_keys=True, default=str)
+
+def _get_extra_fields(item, fields):
+    return json.dumps({key: value for key, value in item.items() if key not in fields}, sort_keys=True, default=str)
+
+def _json_default(obj):
+    # Reasoning results can hold numpy scalars
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+def canonicalize_query_graph(query_graph):
+    """ Hashable representation of a TRAPI query graph that does not depend on the node and edge keys
+        the client picked: curies and categories are sorted, edge qualifiers are normalized and every
+        node and edge is described by its content instead of its key.
+
+        :return: The canonical form of the query graph and the key of every node and edge signature in it,
+            or None if two nodes or two edges have the same signature and so can not be told apart.
+        :rtype: tuple
+    """
+    node_signatures = {}
+    for node_key, node in query_graph["nodes"].items():
+        node_signatures[node_key] = (
+            _normalize_values(node.get('id')),
+            _normalize_values(node.get('category')),
+            _get_extra_fields(node, ['id', 'category']),
+        )
+    edge_signatures = {}
+    for edge_key, edge in query_graph["edges"].items():
+        edge_signatures[edge_key] = (
+            _normalize_values(edge.get('predicate')),
+            node_signatures.get(edge.get('subject')),
+            node_signatures.get(edge.get('object')),
+            _normalize_qualifiers(edge),
+            _get_extra_fields(edge, ['predicate', 'subject', 'object', 'properties']),
+        )
+    node_keys = {signature: node_key for node_key, signature in node_signatures.items()}
+    edge_keys = {signature: edge_key for edge_key, signature in edge_signatures.items()}
+    if len(node_keys) != len(node_signatures) or len(edge_keys) != len(edge_signatures):
+        return None
+    canonical = (tuple(sorted(node_keys, key=repr)), tuple(sorted(edge_keys, key=repr)))
+    return canonical, node_keys, edge_keys
+
+def rewrite_response_bindings(response, query_graph, node_map, edge_map):
+    """ Turns the response to one query into the response to an identical query that used other
+        node and edge keys.
+
+        :param response: The TRAPI response that was constructed for the original query.
+        :type response: dict
+        :param query_graph: The query graph of the identical query.
+        :type query_graph: dict
+        :param node_map: The node key of the identical query for every node key of the original one.
+        :type node_map: dict
+        :param edge_map: The edge key of the identical query for every edge key of the original one.
+        :type edge_map: dict
+    """
+    message = copy.deepcopy(response["message"])
+    message["query_graph"] = query_graph
+    for result in message["results"]:
+        result["node_bindings"] = {node_map.get(node_key, node_key): binding for node_key, binding in result["node_bindings"].items()}
+        result["edge_bindings"] = {edge_map.get(edge_key, edge_key): binding for edge_key, binding in result["edge_bindings"].items()}
+    return {'message': message}
+
 class TrapiInterface:
     def __init__(self,
                  query=None,
@@ -70,6 +164,8 @@ class TrapiInterface:
                  bkb_handler=None,
                  joint_reasoner=None,
                  dynamic_reasoner=None,
+                 budget=None,
+                 executor=None,
                 ):
         self.client_id = client_id
         self.hosts_filename = hosts_filename
@@ -78,10 +174,16 @@ class TrapiInterface:
         self.bkb_handler = bkb_handler
         self.joint_reasoner = joint_reasoner
         self.dynamic_reasoner = dynamic_reasoner
+        self.budget = budget
+        # Optional concurrent.futures.Executor shared by the handler groups, see run_chp_queries
+        self.executor = executor
 
         if query is not None:
             # Analyze queries
             self.query_dict, self.query_map = self._setup_query(query)
+            # Position of every query in the batch by its ID
+            if self.query_map is not None:
+                self.query_positions = {query_id: position for position, query_id in enumerate(self.query_map)}
 
             # Initialize necessary handlers
             self.handlers = {}
@@ -92,6 +194,8 @@ class TrapiInterface:
             self.handler = self._get_handler(None)
 
     def _setup_query(self, query):
+        # Malformed queries are rejected before any handler or reasoner is set up
+        self._validate_queries(query if type(query) == list else [query], batch=type(query) == list)
         if type(query) == list:
             logger.info('Detected batch queries,')
             query_dict, query_map = self._setup_batch_queries(query)
@@ -101,20 +205,77 @@ class TrapiInterface:
             query_dict = self._setup_single_query(query)
             return query_dict, None
 
+    def _validate_queries(self, queries, batch=True):
+        """ Validates and classifies every query, see chp.query_validation. Raises a QueryValidationError
+            with the structured errors of every invalid query.
+        """
+        # Curies are checked against the same bkb handler the handlers fall back to, see BaseHandler
+        bkb_handler = self.bkb_handler
+        if bkb_handler is None:
+            bkb_handler = BkbDataHandler(
+                bkb_major_version='coulomb',
+                bkb_minor_version='1.0'
+            )
+        curies = get_curie_registry(bkb_handler.curies_path)
+        errors = []
+        self._query_types = []
+        for position, query in enumerate(queries):
+            position = position if batch else None
+            query_errors = validate_query_structure(query, position)
+            query_type = None
+            if len(query_errors) == 0:
+                query_type = self._determine_query_type(query)
+                query_errors = validate_query(query, query_type, position, curies=curies)
+            self._query_types.append(query_type)
+            errors.extend(query_errors)
+        if len(errors) > 0:
+            logger.info('Rejected query(s) with {} validation errors.'.format(len(errors)))
+            raise QueryValidationError(errors)
+
     def _setup_batch_queries(self, queries):
         query_dict = defaultdict(list)
         query_map = []
+        # Queries identical to an earlier one in the batch up to their node and edge keys are not run,
+        # they get the response of that query
+        self.duplicate_queries = defaultdict(list)
+        canonical_queries = {}
         for query in queries:
             # Set a query ID for later reordering to match batch sequence
             _id = uuid.uuid4()
             query["query_id"] = _id
             query_map.append(_id)
-            query_type = self._determine_query_type(query)
+            canonical = self._canonicalize_query(query)
+            if canonical is not None and canonical[0] in canonical_queries:
+                original_id, node_keys, edge_keys = canonical_queries[canonical[0]]
+                node_map = {node_key: canonical[1][signature] for signature, node_key in node_keys.items()}
+                edge_map = {edge_key: canonical[2][signature] for signature, edge_key in edge_keys.items()}
+                self.duplicate_queries[original_id].append((_id, query["query_graph"], node_map, edge_map))
+                continue
+            if canonical is not None:
+                canonical_queries[canonical[0]] = (_id, canonical[1], canonical[2])
+            query_type = self._query_types[len(query_map) - 1]
             query_dict[query_type].append(query)
+        num_duplicates = sum([len(duplicates) for duplicates in self.duplicate_queries.values()])
+        if num_duplicates > 0:
+            logger.info('Running {} distinct queries for a batch of {}.'.format(len(queries) - num_duplicates, len(queries)))
         return query_dict, query_map
 
+    def _canonicalize_query(self, query):
+        """ Canonical form of a whole query, see canonicalize_query_graph, together with the key of every
+            node and edge signature in its query graph. None if the query can not be deduplicated.
+        """
+        canonical = canonicalize_query_graph(query["query_graph"])
+        if canonical is None:
+            return None
+        other_fields = json.dumps(
+            {key: value for key, value in query.items() if key not in ['query_graph', 'query_id']},
+            sort_keys=True,
+            default=str,
+        )
+        return (canonical[0], other_fields), canonical[1], canonical[2]
+
     def _setup_single_query(self, query):
-        query_type = self._determine_query_type(query)
+        query_type = self._query_types[0]
         _id = uuid.uuid4()
         query["query_id"] = _id
         return {query_type: [query]}
@@ -130,13 +291,26 @@ class TrapiInterface:
     def get_curies(self):
         """ Returns the available curies and their associated names.
         """
-        return self.handler.curies
+        return self.handler.curies.as_dict()
 
     def get_predicates(self):
         """ Returns the available predicates and their associated names.
         """
-        with open(self.handler.bkb_data_handler.predicates_path, 'r') as predicates_file:
-            return json.load(predicates_file)
+        return load_predicates(self.handler.bkb_data_handler.predicates_path)
+
+    def get_coalescing_stats(self):
+        """ In flight coalescing of identical queries by the dynamic reasoner of each handler, with the
+            number of callers waiting on every in flight query, see chp.coalescing.SingleFlight.
+        """
+        handlers = self.handlers if hasattr(self, 'handlers') else {None: self.handler}
+        stats = {}
+        for query_type, handler in handlers.items():
+            single_flight = getattr(handler.dynamic_reasoner, 'single_flight', None)
+            if single_flight is None:
+                continue
+            stats[query_type] = single_flight.stats()
+            stats[query_type]["waiter_counts"] = single_flight.waiter_counts()
+        return stats
 
     def checkQuery(self):
         return True
@@ -224,6 +398,7 @@ class TrapiInterface:
                 bkb_handler=self.bkb_handler,
                 joint_reasoner=self.joint_reasoner,
                 dynamic_reasoner=self.dynamic_reasoner,
+                budget=self.budget,
             )
         elif query_type == 'wildcard':
             return WildCardHandler(
@@ -233,6 +408,7 @@ class TrapiInterface:
                 max_results=self.max_results,
                 bkb_handler=self.bkb_handler,
                 dynamic_reasoner=self.dynamic_reasoner,
+                budget=self.budget,
             )
         elif query_type == 'onehop':
             return OneHopHandler(
@@ -241,6 +417,7 @@ class TrapiInterface:
                 num_processes_per_host=self.num_processes_per_host,
                 max_results=self.max_results,
                 dynamic_reasoner=self.dynamic_reasoner,
+                budget=self.budget,
             )
         elif query_type is None:
             return DefaultHandler(None)
@@ -256,10 +433,26 @@ class TrapiInterface:
                     if self.query_map is None:
                         return result
                     # Else put the results back in the appropriate order
-                    _unordered_response.append((self.query_map.index(query_id), result))
-        response = [result for _id, result in sorted(_unordered_response)]
+                    _unordered_response.extend(self._get_positioned_responses(query_type, query_id, result))
+        response = [result for _id, result in sorted(_unordered_response, key=lambda item: item[0])]
         return response
 
+    def _get_positioned_responses(self, query_type, query_id, result):
+        """ The position in the batch and response of a query and of every duplicate of it.
+        """
+        if self.query_map is None:
+            return [(0, result)]
+        # Handlers do not report the ID if they only got one query of the batch
+        if query_id is None:
+            query_id = self.query_dict[query_type][0]["query_id"]
+        positioned = [(self.query_positions[query_id], result)]
+        for duplicate_id, query_graph, node_map, edge_map in self.duplicate_queries[query_id]:
+            positioned.append((
+                self.query_positions[duplicate_id],
+                rewrite_response_bindings(result, query_graph, node_map, edge_map),
+            ))
+        return positioned
+
     def build_chp_queries(self):
         built_chp_queries = {}
         for query_type, handler in self.handlers.items():
@@ -268,15 +461,97 @@ class TrapiInterface:
         return built_chp_queries
 
     def run_chp_queries(self):
+        """ Runs the built queries of every handler. If the interface got an executor, the handler groups
+            and the independent queries inside them run concurrently on it, otherwise one after another.
+            Default and one hop queries are batched by their reasoner, so each of those groups stays one
+            serial task, see BaseHandler._get_run_tasks.
+        """
+        if self.executor is not None:
+            futures = self._submit_chp_queries(self.executor.submit)
+            return self._collect_chp_queries(futures)
         ran_chp_queries = {}
+        if self.budget is not None:
+            deadline = time.time() + self.budget
         for query_type, handler in self.handlers.items():
             logger.info('Running queries for {} type query(s).'.format(query_type))
+            # Handlers share the budget so each gets whatever the previous ones left
+            if self.budget is not None:
+                handler.budget = max(0, deadline - time.time())
             ran_chp_queries[query_type] = handler.run_queries()
         return ran_chp_queries
 
+    async def arun_chp_queries(self):
+        """ Awaitable version of run_chp_queries for asyncio servers. Queries run concurrently on the
+            executor of the interface, or the default executor of the event loop, without blocking the loop.
+        """
+        loop = asyncio.get_running_loop()
+        futures = self._submit_chp_queries(lambda task: loop.run_in_executor(self.executor, task))
+        await asyncio.gather(*[future for handler_futures in futures.values() for _, future in handler_futures])
+        return self._collect_chp_queries(futures)
+
+    def _submit_chp_queries(self, submit, chunk_size=None):
+        futures = {}
+        for query_type, handler in self.handlers.items():
+            logger.info('Submitting queries for {} type query(s).'.format(query_type))
+            # Handler groups run side by side so each gets the whole budget
+            handler.budget = self.budget
+            futures[query_type] = handler.submit_queries(submit, chunk_size=chunk_size)
+        return futures
+
+    def _collect_chp_queries(self, futures):
+        ran_chp_queries = {}
+        for query_type, handler_futures in futures.items():
+            ran_chp_queries[query_type] = self.handlers[query_type].collect_queries(handler_futures)
+        return ran_chp_queries
+
     def construct_trapi_response(self):
         results = {}
         for query_type, handler in self.handlers.items():
             logger.info('Constructing TRAPI response(s) for {} type query(s).'.format(query_type))
             results[query_type] = handler.construct_trapi_response()
         return self._order_response(results)
+
+    def stream_trapi_responses(self):
+        """ Runs the built queries and yields (position, response) for every query as soon as it is
+            answered, where position is the index of the query in the batch (0 for a single query).
+            With an executor queries run concurrently and are yielded in the order they finish,
+            otherwise in the order they run. Batched default and one hop queries run in tasks of at most
+            STREAM_CHUNK_SIZE queries, and the ran queries of a task are released once its responses
+            have been yielded. Closing the generator cancels the tasks that have not started yet.
+        """
+        if self.executor is None:
+            if self.budget is not None:
+                deadline = time.time() + self.budget
+            for query_type, handler in self.handlers.items():
+                for task_type, chp_queries in handler.chp_query_dict.items():
+                    for task in handler._get_run_tasks(chp_queries, task_type, chunk_size=STREAM_CHUNK_SIZE):
+                        # Tasks share the budget so each gets whatever the previous ones left
+                        if self.budget is not None:
+                            handler.budget = max(0, deadline - time.time())
+                        yield from self._iter_task_responses(query_type, task_type, task())
+            return
+        futures = {}
+        for query_type, task_futures in self._submit_chp_queries(self.executor.submit, chunk_size=STREAM_CHUNK_SIZE).items():
+            for task_type, future in task_futures:
+                futures[future] = (query_type, task_type)
+        try:
+            for future in as_completed(futures):
+                query_type, task_type = futures.pop(future)
+                yield from self._iter_task_responses(query_type, task_type, future.result())
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def _iter_task_responses(self, query_type, task_type, chp_queries):
+        handler = self.handlers[query_type]
+        for chp_query in chp_queries:
+            query_id, result = handler._construct_trapi_response(chp_query, task_type)
+            yield from self._get_positioned_responses(query_type, query_id, result)
+
+    def stream_ndjson(self):
+        """ stream_trapi_responses as newline delimited JSON, one encoded line per query of the form
+            {"position": position, "response": response}.
+        """
+        for position, response in self.stream_trapi_responses():
+            line = json.dumps({"position": position, "response": response}, default=_json_default)
+            yield (line + '\n').encode('utf-8')
@@ -1,12 +1,31 @@
+import copy
 import json
 import unittest
 import pickle
 import logging
+import os
+import tempfile
+import threading
+import time
 
 from chp_data.bkb_handler import BkbDataHandler
+from chp_data.patient_bkb_builder import PatientBkbBuilder
+from pybkb.common.bayesianKnowledgeBase import BKB_S_node
+from pybkb.common.bayesianKnowledgeBase import bayesianKnowledgeBase as BKB
+from pybkb.python_base.reasoning.joint_reasoner import JointReasoner
 
 from chp.reasoner import ChpDynamicReasoner, ChpJointReasoner
 from chp.query import Query
+from chp.cache import LinkedBkbCache, ResultCache, canonicalize_feature_properties
+from chp.coalescing import SingleFlight, FlightAbandoned
+from chp.reasoner_registry import ReasonerRegistry
+from chp.patient_store import PatientStore
+from chp.patient_matrix import PatientMatrix
+from chp.posting_index import get_shared_posting_index
+from chp.metrics import span, CallbackMetricsSink, HistogramMetricsSink, LoggingMetricsSink
+from chp.bkb_overlay import BkbOverlay
+from chp.compact_bkb import CompactBkb, save_compact_bkb, is_compact_bkb_of, read_compact_bkb_header
+from chp.mixins.reasoner.chp_dynamic_reasoner_mixin import _worker_ping, _worker_run_query
 
 logging.basicConfig(level=logging.INFO)
 
@@ -56,6 +75,157 @@ class TestJointReasoner(unittest.TestCase):
         )
         query =  self.joint_reasoner.run_query(query)
 
+    def test_joint_reasoner_patient_matrix(self):
+        gene = 'ENSEMBL:ENSG00000155657'
+        query = Query(
+            evidence={gene: 'True'},
+            dynamic_targets={
+                "EFO:0000714": {
+                    "op": '>=',
+                    "value": 1000
+                }
+            }
+        )
+        query = self.joint_reasoner.run_query(query)
+        # Check the matrix against counting the patients directly
+        raw_patient_data = self.joint_reasoner.raw_patient_data
+        num_survived = 0
+        for pat_dict in raw_patient_data.values():
+            if gene in pat_dict["gene_curies"] and pat_dict["survival_time"] >= 1000:
+                num_survived += 1
+        self.assertAlmostEqual(query.result[('EFO:0000714', '>= 1000')], num_survived / len(raw_patient_data))
+
+    def _assert_joint_equal(self, patient_matrix, joint_reasoner, evidence, continuous_targets):
+        res, contrib = patient_matrix.compute_joint(evidence, continuous_targets=continuous_targets)
+        expected_res, expected_contrib = joint_reasoner.compute_joint(evidence, None, continuous_targets=continuous_targets)
+        self.assertEqual(set(res), set(expected_res))
+        for target_state, prob in expected_res.items():
+            self.assertAlmostEqual(res[target_state], prob)
+        self.assertEqual(set(contrib), set(expected_contrib))
+        for target_state, patient_contribs in expected_contrib.items():
+            self.assertEqual(set(contrib[target_state]), set(patient_contribs))
+            for patient, patient_contrib in patient_contribs.items():
+                self.assertAlmostEqual(contrib[target_state][patient], patient_contrib)
+
+    def test_joint_reasoner_patient_matrix_matches_joint_reasoner(self):
+        evidences = [
+            {'ENSEMBL:ENSG00000155657': 'True'},
+            {'ENSEMBL:ENSG00000155657': 'False'},
+            {'ENSEMBL:ENSG00000155657': 'True', 'CHEMBL:CHEMBL83': 'True'},
+            {'ENSEMBL:ENSG00000241973': 'True', 'CHEMBL:CHEMBL83': 'False'},
+        ]
+        continuous_targets = {
+            "EFO:0000714": {
+                "op": '>=',
+                "value": 1000
+            }
+        }
+        with open(self.bkb_handler.patient_data_pk_path, 'rb') as patient_file:
+            raw_patient_data = pickle.load(patient_file)
+        # Patients without a survival time are in neither survival state
+        for pat_dict in list(raw_patient_data.values())[::10]:
+            pat_dict["survival_time"] = float('nan')
+        patient_matrix = PatientMatrix(raw_patient_data)
+        joint_reasoner = JointReasoner(PatientBkbBuilder(raw_patient_data, self.bkb_handler).patient_data)
+        for evidence in evidences:
+            self._assert_joint_equal(self.joint_reasoner.patient_matrix, self.joint_reasoner.joint_reasoner, evidence, continuous_targets)
+            self._assert_joint_equal(patient_matrix, joint_reasoner, evidence, continuous_targets)
+
+    def test_joint_reasoner_run_queries(self):
+        evidences = [
+            {'ENSEMBL:ENSG00000155657': 'True'},
+            {'ENSEMBL:ENSG00000155657': 'True', 'CHEMBL:CHEMBL83': 'True'},
+            {'ENSEMBL:ENSG00000241973': 'True', 'CHEMBL:CHEMBL83': 'False'},
+        ]
+        dynamic_targets = {
+            "EFO:0000714": {
+                "op": '>=',
+                "value": 1000
+            }
+        }
+        queries = [Query(evidence=evidence, dynamic_targets=dynamic_targets) for evidence in evidences]
+        ran_queries = self.joint_reasoner.run_queries(queries)
+        self.assertEqual(len(ran_queries), len(queries))
+        # Batched results should match running every query on its own
+        for evidence, ran_query in zip(evidences, ran_queries):
+            query = self.joint_reasoner.run_query(Query(evidence=evidence, dynamic_targets=dynamic_targets))
+            self.assertEqual(ran_query.result, query.result)
+
+    def test_joint_reasoner_survival_cubes(self):
+        joint_reasoner = ChpJointReasoner(self.bkb_handler, survival_thresholds=[('>=', 1000)])
+        for evidence in [{'ENSEMBL:ENSG00000155657': 'True'}, {'ENSEMBL:ENSG00000155657': 'True', 'CHEMBL:CHEMBL83': 'True'}]:
+            for op in ['>=', '<']:
+                dynamic_targets = {
+                    "EFO:0000714": {
+                        "op": op,
+                        "value": 1000
+                    }
+                }
+                # Lookups should match the live computation
+                query = joint_reasoner.run_query(Query(evidence=evidence, dynamic_targets=dynamic_targets))
+                live_query = self.joint_reasoner.run_query(Query(evidence=evidence, dynamic_targets=dynamic_targets))
+                self.assertEqual(query.result, live_query.result)
+
+    def test_joint_reasoner_snapshot_settings(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'joint_reasoner.snapshot')
+        ChpJointReasoner(self.bkb_handler, snapshot_path=snapshot_path)
+        restored_reasoner = ChpJointReasoner(self.bkb_handler, snapshot_path=snapshot_path)
+        self.assertIn('snapshot_restore', restored_reasoner.artifact_load_times)
+        # Snapshots are only restored with the survival cubes and patient store they were taken with
+        for settings in [
+            {"survival_cubes_path": os.path.join(tempfile.mkdtemp(), 'survival_cubes')},
+            {"patient_store_path": tempfile.mkdtemp()},
+        ]:
+            joint_reasoner = ChpJointReasoner(self.bkb_handler, snapshot_path=snapshot_path, **settings)
+            self.assertNotIn('snapshot_restore', joint_reasoner.artifact_load_times)
+
+    def test_joint_reasoner_patient_store_records(self):
+        raw_patient_data = {
+            1: {'gene_curies': ('ENSEMBL:ENSG00000155657',), 'drug_curies': [], 'survival_time': 100, 'age': 61.5},
+            2: {'gene_curies': ('ENSEMBL:ENSG00000241973', 'ENSEMBL:ENSG00000155657'), 'drug_curies': ['CHEMBL:CHEMBL83'], 'survival_time': 250.5},
+        }
+        store = PatientStore.from_records(raw_patient_data)
+        # A store built in memory hands out the pickled dicts
+        self.assertIs(store[1], raw_patient_data[1])
+        store_path = tempfile.mkdtemp()
+        store.save(store_path)
+        loaded_store = PatientStore.load(store_path)
+        for patient, pat_dict in raw_patient_data.items():
+            self.assertEqual(loaded_store[patient], pat_dict)
+            for name, value in pat_dict.items():
+                self.assertIs(type(loaded_store[patient][name]), type(value))
+        # Records are built once so changes to them are kept
+        loaded_store[1]['age'] = 62
+        self.assertIs(loaded_store[1], loaded_store[1])
+        self.assertEqual(loaded_store[1]['age'], 62)
+
+    def test_joint_reasoner_patient_store(self):
+        with open(self.bkb_handler.patient_data_pk_path, 'rb') as patient_file:
+            raw_patient_data = pickle.load(patient_file)
+        store_path = tempfile.mkdtemp()
+        joint_reasoner = ChpJointReasoner(self.bkb_handler, patient_store_path=store_path)
+        store = PatientStore.load(store_path)
+        # The compatibility view holds the same patients and values as the pickled patient data
+        self.assertEqual(list(store), list(raw_patient_data))
+        for patient, pat_dict in list(raw_patient_data.items())[:10]:
+            for name, value in pat_dict.items():
+                if isinstance(value, (list, tuple, set)):
+                    self.assertEqual(set(store[patient][name]), set(value))
+                else:
+                    self.assertEqual(store[patient][name], value)
+        query = Query(
+            evidence={'ENSEMBL:ENSG00000155657': 'True'},
+            dynamic_targets={
+                "EFO:0000714": {
+                    "op": '>=',
+                    "value": 1000
+                }
+            }
+        )
+        query = joint_reasoner.run_query(query)
+        live_query = self.joint_reasoner.run_query(Query(evidence=query.evidence, dynamic_targets=query.dynamic_targets))
+        self.assertEqual(query.result, live_query.result)
+
 class TestDynamicReasoner(unittest.TestCase):
 
     def setUp(self):
@@ -166,3 +336,597 @@ class TestDynamicReasoner(unittest.TestCase):
         )
         query =  self.dynamic_reasoner.run_query(query, bkb_type='drug')
         query.result.summary(include_contributions=False)
+
+    def test_dynamic_reasoner_prelinked_bkb_not_mutated(self):
+        # Specify evidence
+        evidence = {'_ENSEMBL:ENSG00000155657': 'True'}
+        # Specify targets
+        dynamic_targets = {
+            "EFO:0000714": {
+                "op": '>=',
+                "value": 1000
+            }
+        }
+        num_components = len(self.dynamic_reasoner.gene_prelinked_bkb.getAllComponentIndices())
+        num_snodes = len(self.dynamic_reasoner.gene_prelinked_bkb.getAllSNodes())
+        # Setup query
+        query = Query(
+            evidence=evidence,
+            dynamic_targets=dynamic_targets
+        )
+        query =  self.dynamic_reasoner.run_query(query)
+        self.assertEqual(num_components, len(self.dynamic_reasoner.gene_prelinked_bkb.getAllComponentIndices()))
+        self.assertEqual(num_snodes, len(self.dynamic_reasoner.gene_prelinked_bkb.getAllSNodes()))
+
+    def test_dynamic_reasoner_overlay_read_only(self):
+        prelinked_bkb = self.dynamic_reasoner.gene_prelinked_bkb
+        num_components = len(prelinked_bkb.getAllComponentIndices())
+        overlay = BkbOverlay(prelinked_bkb)
+        comp_idx = overlay.addComponent('_Overlay_Test_Component')
+        self.assertEqual(comp_idx, num_components)
+        self.assertEqual(overlay.getComponentIndex('_Overlay_Test_Component'), comp_idx)
+        self.assertEqual(len(prelinked_bkb.getAllComponentIndices()), num_components)
+        self.assertEqual(prelinked_bkb.getComponentIndex('_Overlay_Test_Component'), -1)
+        # Mutators the overlay does not implement are not forwarded to the base
+        with self.assertRaises(AttributeError):
+            overlay.removeComponentState
+        self.assertEqual(overlay.getName(), prelinked_bkb.getName())
+        # Whole bkb reads include the delta layer
+        self.assertEqual(overlay.to_bkb().getAllComponentNames(), overlay.getAllComponentNames())
+        self.assertNotEqual(overlay.to_str(), prelinked_bkb.to_str())
+
+    def _run_query_deepcopy(self, query, bkb_type):
+        # Links into a deep copy of the prelinked bkb as the reasoner did before overlays
+        query, feature_properties, features_not_to_format = self.dynamic_reasoner._prepare_query(query, bkb_type)
+        bkb = copy.deepcopy(self.dynamic_reasoner._get_prelinked_bkb(bkb_type))
+        self.dynamic_reasoner.linker_builder.link(feature_properties, bkb)
+        return self.dynamic_reasoner._update(query, bkb, features_not_to_format)
+
+    def test_dynamic_reasoner_overlay_matches_deepcopy(self):
+        dynamic_targets = {
+            "EFO:0000714": {
+                "op": '>=',
+                "value": 1000
+            }
+        }
+        queries = [
+            ('gene', {'_ENSEMBL:ENSG00000155657': 'True'}, None),
+            ('gene', {'_ENSEMBL:ENSG00000155657': 'True', 'CHEMBL:CHEMBL83': 'True'}, None),
+            ('gene', {'_ENSEMBL:ENSG00000155657': 'True'}, {'Age_of_Diagnosis': {'op': '>=', 'value': 20000}}),
+            ('drug', {'_CHEMBL:CHEMBL83': 'True', '_CHEMBL:CHEMBL1201247': 'True'}, None),
+        ]
+        for bkb_type, evidence, dynamic_evidence in queries:
+            query = self.dynamic_reasoner._run_query_local(
+                Query(evidence=evidence, dynamic_evidence=dynamic_evidence, dynamic_targets=dynamic_targets),
+                bkb_type,
+            )
+            deepcopy_query = self._run_query_deepcopy(
+                Query(evidence=evidence, dynamic_evidence=dynamic_evidence, dynamic_targets=dynamic_targets),
+                bkb_type,
+            )
+            self.assertEqual(query.result.process_updates(), deepcopy_query.result.process_updates())
+            self.assertEqual(query.result.process_inode_contributions(), deepcopy_query.result.process_inode_contributions())
+
+    def test_dynamic_reasoner_linked_bkb_cache(self):
+        dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler, linked_bkb_cache=LinkedBkbCache())
+        # Specify targets
+        dynamic_targets = {
+            "EFO:0000714": {
+                "op": '>=',
+                "value": 1000
+            }
+        }
+        for _ in range(2):
+            query = Query(
+                evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+                dynamic_targets=dynamic_targets
+            )
+            query = dynamic_reasoner.run_query(query)
+        stats = dynamic_reasoner.linked_bkb_cache.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 1)
+
+    def test_dynamic_reasoner_run_queries(self):
+        evidences = [
+            {'_ENSEMBL:ENSG00000155657': 'True'},
+            {'_ENSEMBL:ENSG00000241973': 'True'},
+            {'_ENSEMBL:ENSG00000155657': 'True'},
+        ]
+        survival_days = [1000, 1000, 500]
+        queries = []
+        for evidence, days in zip(evidences, survival_days):
+            queries.append(
+                Query(
+                    evidence=evidence,
+                    dynamic_targets={
+                        "EFO:0000714": {
+                            "op": '>=',
+                            "value": days,
+                        }
+                    }
+                )
+            )
+        ran_queries = self.dynamic_reasoner.run_queries(queries)
+        self.assertEqual(len(ran_queries), len(queries))
+        for query, ran_query in zip(queries, ran_queries):
+            self.assertIs(query, ran_query)
+            self.assertIsNotNone(ran_query.result)
+        self.assertEqual(sum([timing["num_queries"] for timing in self.dynamic_reasoner.run_queries_timings]), len(queries))
+
+    def test_dynamic_reasoner_run_queries_timings_per_thread(self):
+        num_queries = {}
+        def _run(days):
+            queries = [
+                Query(
+                    evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+                    dynamic_targets={
+                        "EFO:0000714": {
+                            "op": '>=',
+                            "value": days + i
+                        }
+                    }
+                ) for i in range(days // 100)
+            ]
+            self.dynamic_reasoner.run_queries(queries)
+            num_queries[days] = sum([timing["num_queries"] for timing in self.dynamic_reasoner.run_queries_timings])
+        # Concurrent calls only see the timings of their own groups
+        threads = [threading.Thread(target=_run, args=(days,)) for days in [100, 300]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(num_queries, {100: 1, 300: 3})
+
+    def test_dynamic_reasoner_executor(self):
+        dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler)
+        dynamic_reasoner.start_executor(2, bkb_types=('gene',))
+        try:
+            # Every worker was forked with the reasoner loaded
+            self.assertTrue(all(dynamic_reasoner.executor.map(_worker_ping, [id(dynamic_reasoner)] * 2)))
+            evidences = [
+                {'_ENSEMBL:ENSG00000155657': 'True'},
+                {'_ENSEMBL:ENSG00000241973': 'True'},
+                {'_ENSEMBL:ENSG00000155657': 'True'},
+            ]
+            queries = [
+                Query(
+                    evidence=evidence,
+                    dynamic_targets={
+                        "EFO:0000714": {
+                            "op": '>=',
+                            "value": 1000
+                        }
+                    }
+                ) for evidence in evidences
+            ]
+            # Single queries and batches are both answered by the workers
+            query = dynamic_reasoner.run_query(queries[0])
+            local_query = self.dynamic_reasoner.run_query(Query(evidence=evidences[0], dynamic_targets=queries[0].dynamic_targets))
+            self.assertEqual(query.result.process_updates(normalize=True), local_query.result.process_updates(normalize=True))
+            ran_queries = dynamic_reasoner.run_queries(queries[1:])
+            self.assertEqual(len(ran_queries), 2)
+            for ran_query in ran_queries:
+                self.assertIsNotNone(ran_query.result)
+            # Workers send results back with a reference to the prelinked bkb instead of the bkb itself
+            data = _worker_run_query(id(dynamic_reasoner), Query(evidence=evidences[0], dynamic_targets=queries[0].dynamic_targets), 'gene')
+            self.assertLessEqual(len(data), len(pickle.dumps(local_query)))
+        finally:
+            dynamic_reasoner.shutdown_executor()
+        self.assertIsNone(dynamic_reasoner.executor)
+
+    def test_dynamic_reasoner_executor_after_startup(self):
+        # Workers are only forked once the startup threads are gone
+        with self.assertLogs('chp.mixins.reasoner.chp_dynamic_reasoner_mixin', level='INFO') as logs:
+            dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler, startup_workers=2, executor_processes=1)
+        try:
+            self.assertIsNotNone(dynamic_reasoner.executor)
+            self.assertFalse(any(['other threads are alive' in message for message in logs.output]))
+        finally:
+            dynamic_reasoner.shutdown_executor()
+
+    def test_dynamic_reasoner_executor_metrics(self):
+        metrics_sink = HistogramMetricsSink()
+        dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler, metrics_sink=metrics_sink)
+        dynamic_reasoner.start_executor(1, bkb_types=('gene',))
+        try:
+            query = dynamic_reasoner.run_query(
+                Query(
+                    evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+                    dynamic_targets={
+                        "EFO:0000714": {
+                            "op": '>=',
+                            "value": 1000
+                        }
+                    }
+                )
+            )
+        finally:
+            dynamic_reasoner.shutdown_executor()
+        # Phases timed in the worker reach the sink of the parent and the returned query
+        self.assertEqual(metrics_sink.summary()["updating"]["count"], 1)
+        self.assertIn('updating', query.phase_times)
+
+    def test_dynamic_reasoner_lazy_prelinked_bkbs(self):
+        dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler)
+        self.assertNotIn('gene_prelinked_bkb', dynamic_reasoner.artifact_load_times)
+        self.assertNotIn('drug_prelinked_bkb', dynamic_reasoner.artifact_load_times)
+        query = Query(
+            evidence={'_CHEMBL:CHEMBL83': 'True'},
+            dynamic_targets={
+                "EFO:0000714": {
+                    "op": '>=',
+                    "value": 1000
+                }
+            }
+        )
+        query = dynamic_reasoner.run_query(query, bkb_type='drug')
+        self.assertIn('drug_prelinked_bkb', dynamic_reasoner.artifact_load_times)
+        self.assertNotIn('gene_prelinked_bkb', dynamic_reasoner.artifact_load_times)
+        load_times = dynamic_reasoner.preload()
+        self.assertIn('gene_prelinked_bkb', load_times)
+
+    def test_dynamic_reasoner_budget(self):
+        query = Query(
+            evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+            dynamic_targets={
+                "EFO:0000714": {
+                    "op": '>=',
+                    "value": 1000
+                }
+            }
+        )
+        # No reasoning finishes in a zero budget so the approximate answer is returned
+        query = self.dynamic_reasoner.run_query(query, budget=0)
+        self.assertTrue(query.partial)
+        self.assertIsNotNone(query.approximation_error)
+        probs = query.result.process_updates(normalize=True)["EFO:0000714"]
+        self.assertAlmostEqual(probs[">= 1000"] + probs["< 1000"], 1)
+
+    def test_dynamic_reasoner_budget_late_result(self):
+        started = threading.Event()
+        release = threading.Event()
+        def _hold_background_link(phase, duration, query):
+            # Keeps the background job running until the budget has run out
+            if phase == 'link' and threading.current_thread() is not threading.main_thread():
+                started.set()
+                release.wait()
+        dynamic_reasoner = ChpDynamicReasoner(
+            self.bkb_handler,
+            result_cache=ResultCache(),
+            metrics_sink=CallbackMetricsSink(_hold_background_link),
+        )
+        query = Query(
+            evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+            dynamic_targets={
+                "EFO:0000714": {
+                    "op": '>=',
+                    "value": 1000
+                }
+            }
+        )
+        cache_key = dynamic_reasoner._get_result_cache_key(query, 'gene')
+        ran_query = dynamic_reasoner.run_queries([query], budget=5)[0]
+        self.assertTrue(started.is_set())
+        self.assertIs(ran_query, query)
+        self.assertTrue(ran_query.partial)
+        approximate_result = ran_query.result
+        release.set()
+        dynamic_reasoner.background_executor.shutdown(wait=True)
+        # The late exact result was computed on a detached copy and only lands in the result cache
+        self.assertIs(ran_query.result, approximate_result)
+        self.assertTrue(ran_query.partial)
+        cached_result, _ = dynamic_reasoner.result_cache.get(cache_key)
+        self.assertIsNot(cached_result, approximate_result)
+
+    def test_dynamic_reasoner_posting_index(self):
+        gene = 'ENSEMBL:ENSG00000155657'
+        drug = 'CHEMBL:CHEMBL83'
+        posting_index = self.dynamic_reasoner.posting_index
+        raw_patient_data = self.dynamic_reasoner.raw_patient_data
+        patients = set(posting_index.patient_hashes_of(posting_index.intersect(gene, drug)).tolist())
+        expected = set([
+            patient for patient, pat_dict in raw_patient_data.items()
+            if gene in pat_dict["gene_curies"] and drug in pat_dict["drug_curies"]
+        ])
+        self.assertEqual(patients, expected)
+        # Reasoners that load the same patient data share the index
+        self.assertIs(ChpJointReasoner(self.bkb_handler).posting_index, posting_index)
+
+    def test_shared_posting_index_versions(self):
+        raw_patient_data = self.dynamic_reasoner.raw_patient_data
+        posting_index = get_shared_posting_index(raw_patient_data, key='v1', scope='patient_data')
+        self.assertIs(get_shared_posting_index(raw_patient_data, key='v1', scope='patient_data'), posting_index)
+        # A new version of the same patient data replaces the old index
+        new_posting_index = get_shared_posting_index(raw_patient_data, key='v2', scope='patient_data')
+        self.assertIsNot(new_posting_index, posting_index)
+        self.assertIs(get_shared_posting_index(raw_patient_data, key='v2', scope='patient_data'), new_posting_index)
+        self.assertIsNot(get_shared_posting_index(raw_patient_data, key='v1', scope='patient_data'), posting_index)
+
+    def test_dynamic_reasoner_feature_index(self):
+        feature_index = self.dynamic_reasoner.get_feature_index('gene')
+        self.assertEqual(feature_index, frozenset(self.dynamic_reasoner.gene_prelinked_bkb.getAllComponentNames()))
+        query = Query(
+            evidence={
+                '_ENSEMBL:ENSG00000155657': 'True',
+                '_ENSEMBL:NOT_IN_BKB': 'True',
+            },
+        )
+        # Interpolated features that are not in the bkb are dropped from the evidence
+        query = self.dynamic_reasoner._check_evidence(query, 'gene')
+        self.assertNotIn('_ENSEMBL:NOT_IN_BKB', query.evidence)
+        self.assertEqual(
+            '_ENSEMBL:ENSG00000155657' in query.evidence,
+            '_ENSEMBL:ENSG00000155657' in feature_index,
+        )
+        # Components an overlay adds while linking are found on top of the index
+        overlay = BkbOverlay(self.dynamic_reasoner.gene_prelinked_bkb, feature_index=feature_index)
+        self.assertEqual(overlay.getComponentIndex('_ENSEMBL:NOT_IN_BKB'), -1)
+        comp_idx = overlay.addComponent('_ENSEMBL:NOT_IN_BKB')
+        self.assertEqual(overlay.getComponentIndex('_ENSEMBL:NOT_IN_BKB'), comp_idx)
+
+    def test_dynamic_reasoner_registry(self):
+        registry = ReasonerRegistry()
+        reasoner = registry.get(ChpDynamicReasoner, self.bkb_handler)
+        self.assertIs(registry.get(ChpDynamicReasoner, self.bkb_handler), reasoner)
+        self.assertIsNot(registry.get(ChpJointReasoner, self.bkb_handler), reasoner)
+        self.assertEqual(len(registry), 2)
+
+    def test_dynamic_reasoner_startup_workers(self):
+        dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler, startup_workers=2)
+        # The prelinked bkbs are loaded during setup, alongside the patient data
+        self.assertIn('gene_prelinked_bkb', dynamic_reasoner.artifact_load_times)
+        self.assertIn('drug_prelinked_bkb', dynamic_reasoner.artifact_load_times)
+        self.assertIn('patient_data', dynamic_reasoner.artifact_load_times)
+        self.assertEqual(len(dynamic_reasoner._startup_futures), 0)
+        self.assertIn('gene_prelinked_bkb', dynamic_reasoner.startup_timeline.report())
+
+    def test_dynamic_reasoner_snapshot(self):
+        snapshot_path = os.path.join(tempfile.mkdtemp(), 'dynamic_reasoner.snapshot')
+        dynamic_reasoner = ChpDynamicReasoner(self.bkb_handler, snapshot_path=snapshot_path)
+        self.assertIn('snapshot_save', dynamic_reasoner.artifact_load_times)
+        restored_reasoner = ChpDynamicReasoner(self.bkb_handler, snapshot_path=snapshot_path)
+        self.assertIn('snapshot_restore', restored_reasoner.artifact_load_times)
+        self.assertNotIn('linker_builder', restored_reasoner.artifact_load_times)
+        query = Query(
+            evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+            dynamic_targets={
+                "EFO:0000714": {
+                    "op": '>=',
+                    "value": 1000
+                }
+            }
+        )
+        probs = dynamic_reasoner.run_query(query).result.process_updates(normalize=True)
+        restored_query = Query(evidence=query.evidence, dynamic_targets=query.dynamic_targets)
+        restored_probs = restored_reasoner.run_query(restored_query).result.process_updates(normalize=True)
+        self.assertEqual(probs["EFO:0000714"], restored_probs["EFO:0000714"])
+
+    def test_dynamic_reasoner_coalescing(self):
+        queries = [
+            Query(
+                evidence={'_ENSEMBL:ENSG00000155657': 'True'},
+                dynamic_targets={
+                    "EFO:0000714": {
+                        "op": '>=',
+                        "value": 1000
+                    }
+                }
+            ) for _ in range(2)
+        ]
+        # The second query waits on the first instead of being reasoned over again
+        ran_queries = self.dynamic_reasoner.run_queries(queries)
+        self.assertFalse(ran_queries[0].coalesced)
+        self.assertTrue(ran_queries[1].coalesced)
+        self.assertIs(ran_queries[0].result, ran_queries[1].result)
+        self.assertEqual(self.dynamic_reasoner.single_flight.stats()["in_flight"], 0)
+
+class TestMetrics(unittest.TestCase):
+
+    def test_span_disabled(self):
+        query = Query(evidence={})
+        with span(None, 'updating', query):
+            pass
+        self.assertIs(span(None, 'updating'), span(None, 'link'))
+        self.assertEqual(query.phase_times, {})
+
+    def test_span_callback_sink(self):
+        records = []
+        metrics_sink = CallbackMetricsSink(lambda phase, duration, query: records.append((phase, query)))
+        query = Query(evidence={})
+        for _ in range(2):
+            with span(metrics_sink, 'updating', query):
+                pass
+        with span(metrics_sink, 'link'):
+            pass
+        self.assertEqual(records, [('updating', query), ('updating', query), ('link', None)])
+        # Repeated phases add up on the query
+        self.assertEqual(list(query.phase_times), ['updating'])
+        self.assertGreaterEqual(query.phase_times["updating"], 0)
+
+    def test_histogram_sink(self):
+        metrics_sink = HistogramMetricsSink(bucket_bounds=[0.1, 1])
+        for duration in [0.05, 0.5, 5]:
+            metrics_sink.record('updating', duration)
+        summary = metrics_sink.summary()["updating"]
+        self.assertEqual(summary["count"], 3)
+        self.assertAlmostEqual(summary["total"], 5.55)
+        self.assertEqual(summary["buckets"], {0.1: 1, 1: 1, float('inf'): 1})
+
+    def test_logging_sink(self):
+        with self.assertLogs('chp.metrics', level='INFO') as logs:
+            LoggingMetricsSink().record('updating', 0.5)
+        self.assertIn('phase=updating duration=0.500000', logs.output[0])
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+
+    def test_single_flight_resolve(self):
+        future, leader = self.single_flight.join('query')
+        self.assertTrue(leader)
+        waiter_future, waiter_leader = self.single_flight.join('query')
+        self.assertFalse(waiter_leader)
+        self.assertIs(waiter_future, future)
+        self.assertEqual(self.single_flight.waiter_counts(), {'query': 1})
+        self.single_flight.resolve('query', 'result')
+        self.assertEqual(waiter_future.result(), 'result')
+        # Resolved keys are forgotten
+        self.assertTrue(self.single_flight.join('query')[1])
+
+    def test_single_flight_fail(self):
+        self.single_flight.join('query')
+        waiter_future, _ = self.single_flight.join('query')
+        self.single_flight.fail('query', ValueError('failed'))
+        with self.assertRaises(ValueError):
+            waiter_future.result()
+        self.assertEqual(self.single_flight.stats()["in_flight"], 0)
+        # Failing a key that is not in flight is a no-op
+        self.single_flight.fail('query', ValueError('failed'))
+
+    def test_single_flight_batch_duplicates(self):
+        # Identical queries of one batch join the same flight, only the first one leads
+        joined = [self.single_flight.join(key) for key in ['a', 'b', 'a', 'a']]
+        self.assertEqual([leader for _, leader in joined], [True, True, False, False])
+        self.single_flight.resolve('a', 'result_a')
+        self.assertEqual([future.result() for future, _ in joined if future.done()], ['result_a', 'result_a', 'result_a'])
+        self.assertEqual(self.single_flight.stats()["num_coalesced"], 2)
+
+    def test_single_flight_do_abandoned(self):
+        # A waiter of an abandoned flight runs the computation itself
+        self.single_flight.join('query')
+        ran = []
+        def _abandon():
+            while self.single_flight.waiter_counts().get('query', 0) == 0:
+                time.sleep(0.01)
+            self.single_flight.fail('query', FlightAbandoned())
+        thread = threading.Thread(target=_abandon)
+        thread.start()
+        result, shared = self.single_flight.do('query', lambda: ran.append(True) or 'result')
+        thread.join()
+        self.assertEqual((result, shared, ran), ('result', False, [True]))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'results.sqlite')
+
+    def test_result_cache_disk_fallback(self):
+        result_cache = ResultCache(self.path, max_entries=1)
+        key = ResultCache.make_key('gene', 'v1', 'query0')
+        result_cache.put(key, {'result': 0}, 'v1', scope='artifacts')
+        # The second entry evicts the first from memory so it is read back from disk
+        result_cache.put(ResultCache.make_key('gene', 'v1', 'query1'), {'result': 1}, 'v1', scope='artifacts')
+        self.assertEqual(result_cache.get(key), {'result': 0})
+        self.assertEqual(result_cache.stats()["disk_hits"], 1)
+        self.assertEqual(result_cache.get(key), {'result': 0})
+        self.assertEqual(result_cache.stats()["hits"], 1)
+        # Entries survive a restart
+        self.assertEqual(ResultCache(self.path).get(key), {'result': 0})
+
+    def test_result_cache_version_invalidation(self):
+        result_cache = ResultCache(self.path)
+        result_cache.put(ResultCache.make_key('gene', 'v1', 'query0'), {'result': 0}, 'v1', scope='artifacts')
+        self.assertIsNone(result_cache.get(ResultCache.make_key('gene', 'v2', 'query0')))
+        self.assertEqual(result_cache.stats()["misses"], 1)
+
+    def test_result_cache_prune(self):
+        result_cache = ResultCache(self.path)
+        stale_key = ResultCache.make_key('gene', 'v1', 'query0')
+        valid_key = ResultCache.make_key('gene', 'v2', 'query0')
+        other_key = ResultCache.make_key('gene', 'v1', 'query1')
+        result_cache.put(stale_key, {'result': 0}, 'v1', scope='artifacts')
+        result_cache.put(valid_key, {'result': 1}, 'v2', scope='artifacts')
+        result_cache.put(other_key, {'result': 2}, 'v1', scope='other_artifacts')
+        result_cache.prune('artifacts', ['v2'])
+        # Only the stale entries of the pruned scope are removed, from memory and from disk
+        for cache in [result_cache, ResultCache(self.path)]:
+            self.assertIsNone(cache.get(stale_key))
+            self.assertEqual(cache.get(valid_key), {'result': 1})
+            self.assertEqual(cache.get(other_key), {'result': 2})
+
+    def test_canonicalize_feature_properties(self):
+        def canonicalize(value):
+            return canonicalize_feature_properties({'Age_of_Diagnosis': {'op': '>=', 'value': value}})
+        # Equal numbers share a key, numbers and strings do not
+        self.assertEqual(canonicalize(970), canonicalize(970.0))
+        self.assertNotEqual(canonicalize(970), canonicalize('970'))
+        self.assertNotEqual(canonicalize(970), canonicalize(971))
+        self.assertEqual(
+            canonicalize_feature_properties({'a': {'op': '<', 'value': 1}, 'b': {'op': '>=', 'value': 'x'}}),
+            canonicalize_feature_properties({'b': {'op': '>=', 'value': 'x'}, 'a': {'op': '<', 'value': 1.0}}),
+        )
+
+
+class TestCompactBkb(unittest.TestCase):
+
+    def setUp(self):
+        self.bkb = BKB(name='compact_test')
+        gene_idx = self.bkb.addComponent('ENSEMBL:ENSG00000155657')
+        true_idx = self.bkb.addComponentState(gene_idx, 'True')
+        false_idx = self.bkb.addComponentState(gene_idx, 'False')
+        survival_idx = self.bkb.addComponent('EFO:0000714')
+        long_idx = self.bkb.addComponentState(survival_idx, '>= 1000')
+        self.bkb.addSNode(BKB_S_node(init_component_index=gene_idx, init_state_index=true_idx, init_probability=0.4))
+        self.bkb.addSNode(BKB_S_node(init_component_index=gene_idx, init_state_index=false_idx, init_probability=0.6))
+        self.bkb.addSNode(BKB_S_node(init_component_index=survival_idx, init_state_index=long_idx, init_probability=0.7, init_tail=[(gene_idx, true_idx)]))
+        self.compact_path = os.path.join(tempfile.mkdtemp(), 'compact_test.cbkb')
+        save_compact_bkb(self.bkb, self.compact_path)
+
+    def _snode_tuples(self, snodes):
+        return sorted([
+            (snode.getHead(), snode.probability, tuple([tuple(snode.getTail(tail_idx)) for tail_idx in range(snode.getNumberTail())]))
+            for snode in snodes
+        ])
+
+    def test_compact_bkb_round_trip(self):
+        compact_bkb = CompactBkb(self.compact_path)
+        self.assertEqual(compact_bkb.getAllComponentNames(), self.bkb.getAllComponentNames())
+        self.assertEqual(compact_bkb.getComponentIndex('EFO:0000714'), 1)
+        self.assertEqual(compact_bkb.getComponentINodeIndex(0, 'False'), 1)
+        self.assertEqual(compact_bkb.getComponentINodeIndex(0, 'Missing'), -1)
+        # S-nodes are built once and then shared by every access
+        self.assertIs(compact_bkb.getAllSNodes()[0], list(compact_bkb.getAllSNodes())[0])
+        bkb = compact_bkb.to_bkb()
+        self.assertEqual(bkb.getAllComponentNames(), self.bkb.getAllComponentNames())
+        for comp_idx in self.bkb.getAllComponentIndices():
+            self.assertEqual(
+                [bkb.getComponentINodeName(comp_idx, state_idx) for state_idx in bkb.getAllComponentINodeIndices(comp_idx)],
+                [self.bkb.getComponentINodeName(comp_idx, state_idx) for state_idx in self.bkb.getAllComponentINodeIndices(comp_idx)],
+            )
+        self.assertEqual(self._snode_tuples(bkb.getAllSNodes()), self._snode_tuples(self.bkb.getAllSNodes()))
+        # Unpickling maps the same file again
+        self.assertEqual(pickle.loads(pickle.dumps(compact_bkb)).getAllComponentNames(), self.bkb.getAllComponentNames())
+
+    def test_compact_bkb_overlay(self):
+        compact_bkb = CompactBkb(self.compact_path)
+        overlay = BkbOverlay(compact_bkb)
+        snode = list(overlay.getAllSNodes())[0]
+        overlay.removeSNode(snode)
+        self.assertEqual(len(overlay.getAllSNodes()), 2)
+        self.assertNotIn(compact_bkb.getAllSNodes()[0], overlay.getAllSNodes())
+        self.assertIn(compact_bkb.getAllSNodes()[1], overlay.getAllSNodes())
+        self.assertEqual(self._snode_tuples(overlay.getAllSNodes()), self._snode_tuples(list(self.bkb.getAllSNodes())[1:]))
+        # The base is left as is
+        self.assertEqual(len(compact_bkb.getAllSNodes()), 3)
+
+    def test_compact_bkb_source(self):
+        source_path = os.path.join(tempfile.mkdtemp(), 'compact_test.pk')
+        with open(source_path, 'wb') as f_:
+            pickle.dump(self.bkb, f_)
+        save_compact_bkb(self.bkb, self.compact_path, source_path=source_path)
+        self.assertTrue(is_compact_bkb_of(self.compact_path, source_path))
+        # A changed source invalidates the compact file whatever its modification time
+        with open(source_path, 'ab') as f_:
+            f_.write(b'changed')
+        self.assertFalse(is_compact_bkb_of(self.compact_path, source_path))
+        # So does a partially written compact file
+        with open(self.compact_path, 'rb') as f_:
+            data = f_.read()
+        with open(self.compact_path, 'wb') as f_:
+            f_.write(data[:-8])
+        self.assertIsNone(read_compact_bkb_header(self.compact_path))
+        with self.assertRaises(ValueError):
+            CompactBkb(self.compact_path)
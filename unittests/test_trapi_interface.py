@@ -2,8 +2,13 @@ import unittest
 import logging
 import pickle
 import json
+import copy
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from chp.trapi_interface import TrapiInterface
+from chp.trapi_interface import TrapiInterface, STREAM_CHUNK_SIZE
+from chp.async_trapi_interface import AsyncTrapiInterface
+from chp.query_validation import QueryValidationError
 
 logging.basicConfig(level=logging.INFO)
 
@@ -23,6 +28,30 @@ class TestDefaultHandler(unittest.TestCase):
         curies = interface.get_curies()
         self.assertIsInstance(curies, dict)
 
+    def test_curies_shared(self):
+        # Every handler of the process shares one curie registry
+        interface = TrapiInterface()
+        other_interface = TrapiInterface()
+        self.assertIs(interface.handler.curies, other_interface.handler.curies)
+        curies = interface.get_curies()
+        for category, names_by_curie in curies.items():
+            for curie, names in names_by_curie.items():
+                self.assertEqual(interface.handler.curies[category][curie][0], names[0])
+                break
+
+    def test_curies_copies(self):
+        # Callers get their own JSON serializable copy of the shared curies
+        interface = TrapiInterface()
+        curies = interface.get_curies()
+        json.dumps(curies)
+        for category in curies:
+            self.assertNotIsInstance(curies[category], tuple)
+            curies[category] = None
+        self.assertNotIn(None, interface.get_curies().values())
+        predicates = interface.get_predicates()
+        predicates.clear()
+        self.assertNotEqual(interface.get_predicates(), {})
+
     def test_predicates(self):
         interface = TrapiInterface()
         predicates = interface.get_predicates()
@@ -71,6 +100,112 @@ class TestDefaultHandler(unittest.TestCase):
         interface.run_chp_queries()
         response = interface.construct_trapi_response()
 
+    def test_mix_batch_query_executor(self):
+        # Handler groups and their queries run concurrently on the executor
+        queries = [message["message"] for message in self.queries]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            interface = TrapiInterface(query=queries, client_id='default', executor=executor)
+            interface.build_chp_queries()
+            interface.run_chp_queries()
+            response = interface.construct_trapi_response()
+        self.assertEqual(len(response), len(queries))
+        for query, _response in zip(queries, response):
+            self.assertEqual(_response["message"]["query_graph"], query["query_graph"])
+
+    def test_mix_batch_query_async(self):
+        queries = [message["message"] for message in self.queries]
+        interface = TrapiInterface(query=queries, client_id='default')
+        interface.build_chp_queries()
+        asyncio.run(interface.arun_chp_queries())
+        response = interface.construct_trapi_response()
+        self.assertEqual(len(response), len(queries))
+
+    def test_mix_batch_query_stream(self):
+        # Responses are streamed as queries finish and carry their position in the batch
+        queries = [message["message"] for message in self.queries]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            interface = TrapiInterface(query=queries, client_id='default', executor=executor)
+            interface.build_chp_queries()
+            lines = [json.loads(line) for line in interface.stream_ndjson()]
+        self.assertEqual(sorted([line["position"] for line in lines]), list(range(len(queries))))
+        for line in lines:
+            self.assertEqual(line["response"]["message"]["query_graph"], queries[line["position"]]["query_graph"])
+
+    def test_batch_query_stream_chunks(self):
+        # Batched default queries are streamed in chunks instead of one task per batch
+        queries = [message["message"] for message in self.queries[:4]] * STREAM_CHUNK_SIZE
+        interface = TrapiInterface(query=queries, client_id='default')
+        interface.build_chp_queries()
+        for query_type, handler in interface.handlers.items():
+            for task_type, chp_queries in handler.chp_query_dict.items():
+                tasks = handler._get_run_tasks(chp_queries, task_type, chunk_size=STREAM_CHUNK_SIZE)
+                self.assertTrue(all([len(task.args[0]) <= STREAM_CHUNK_SIZE for task in tasks]))
+        positions = [position for position, _ in interface.stream_trapi_responses()]
+        self.assertEqual(sorted(positions), list(range(len(queries))))
+
+    def test_async_interface(self):
+        # Requests share one async interface and run concurrently without blocking the loop
+        queries = [message["message"] for message in self.queries[2:8]]
+
+        async def run_requests(interface):
+            return await asyncio.gather(
+                interface.query(queries[0]),
+                interface.query(queries[1:]),
+            )
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            interface = AsyncTrapiInterface(executor=executor)
+            single_response, batch_response = asyncio.run(run_requests(interface))
+        self.assertIn('message', single_response)
+        self.assertEqual(len(batch_response), len(queries) - 1)
+
+    def test_invalid_batch_query(self):
+        # Malformed queries are rejected with structured errors before any reasoner is set up
+        queries = [copy.deepcopy(message["message"]) for message in self.queries[2:4]]
+        for node in queries[1]["query_graph"]["nodes"].values():
+            if node["category"] == 'biolink:Gene':
+                node["id"] = 'HGNC:0000'
+        queries[1]["query_graph"]["edges"]["extra_edge"] = {"subject": "missing_node", "object": "missing_node"}
+        with self.assertRaises(QueryValidationError) as context:
+            TrapiInterface(query=queries, client_id='default')
+        self.assertEqual(set([error["query"] for error in context.exception.errors]), {1})
+        for error in context.exception.errors:
+            self.assertIn('location', error)
+            self.assertIn('message', error)
+
+    def test_unknown_curie_query(self):
+        # Well formed curies are also checked against the curies of the default bkb handler
+        query = copy.deepcopy(self.queries[3]["message"])
+        for node in query["query_graph"]["nodes"].values():
+            if node["category"] == 'biolink:Gene':
+                node["id"] = 'ENSEMBL:UNKNOWN'
+        with self.assertRaises(QueryValidationError) as context:
+            TrapiInterface(query=query, client_id='default')
+        self.assertIn('Unknown curie', str(context.exception))
+
+    def test_duplicate_batch_query(self):
+        # The same query with other node and edge keys is only run once
+        query = self.queries[3]["message"]
+        node_keys = {node_key: 'renamed_{}'.format(node_key) for node_key in query["query_graph"]["nodes"]}
+        duplicate = copy.deepcopy(query)
+        duplicate["query_graph"]["nodes"] = {node_keys[node_key]: node for node_key, node in query["query_graph"]["nodes"].items()}
+        duplicate["query_graph"]["edges"] = {}
+        for edge_key, edge in query["query_graph"]["edges"].items():
+            edge = copy.deepcopy(edge)
+            edge["subject"] = node_keys[edge["subject"]]
+            edge["object"] = node_keys[edge["object"]]
+            duplicate["query_graph"]["edges"]['renamed_{}'.format(edge_key)] = edge
+        interface = TrapiInterface(query=[query, duplicate], client_id='default')
+        self.assertEqual(sum([len(queries) for queries in interface.query_dict.values()]), 1)
+        interface.build_chp_queries()
+        interface.run_chp_queries()
+        response = interface.construct_trapi_response()
+        self.assertEqual(len(response), 2)
+        for _query, _response in zip([query, duplicate], response):
+            for result in _response["message"]["results"]:
+                self.assertTrue(set(result["node_bindings"]).issubset(_query["query_graph"]["nodes"]))
+                self.assertTrue(set(result["edge_bindings"]).issubset(_query["query_graph"]["edges"]))
+
     def test_mix_batch_reasoner_test_queries(self):
         with open('query_samples/test_reasoner_coulomb_queries.pk', 'rb') as f_:
             _queries = pickle.load(f_)
@@ -145,6 +280,16 @@ class TestOneHopHandler(unittest.TestCase):
         response = interface.construct_trapi_response()
         #print(json.dumps(response, indent=2))
 
+    def test_onehop_handler_invalid_query(self):
+        # Handlers raise instead of exiting the process on queries they can not extract
+        query = self.gene_queries[0]["message"]
+        interface = TrapiInterface(query=query, client_id='default', max_results=10)
+        invalid_query = copy.deepcopy(query)
+        invalid_query["query_graph"]["nodes"]["extra_node"] = {"category": 'biolink:Gene'}
+        for handler in interface.handlers.values():
+            with self.assertRaises(QueryValidationError):
+                handler._extract_chp_query(invalid_query, 'gene')
+
     def test_single_drug_onehop_query(self):
         message = self.drug_queries[0]
         query = message["message"]